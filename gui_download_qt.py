@@ -5,25 +5,41 @@
 封面/字幕/弹幕下载、暂停/继续/取消/重试、系统通知。
 """
 
+import atexit
+import contextlib
 import csv
+import glob
 import concurrent.futures
+import gzip
+import hashlib
+import heapq
 import json
+import logging
+import logging.handlers
 import math
+import multiprocessing
 import os
+import queue
 import random
 import re
+import shutil
 import subprocess
 import sys
 import threading
 import time
 import traceback
+from collections import OrderedDict, deque
+from enum import IntEnum
 from pathlib import Path
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import parse_qs, urljoin, urlparse
 
 import requests
 import yt_dlp
-from PyQt5.QtCore import QEasingCurve, QPropertyAnimation, QThread, QTimer, Qt, QUrl, pyqtSignal
-from PyQt5.QtGui import QColor, QIcon, QPainter, QPainterPath, QPen, QPixmap, QKeySequence
+from PyQt5.QtCore import (
+    QBuffer, QByteArray, QEasingCurve, QFileSystemWatcher, QObject, QPoint, QPropertyAnimation, QSize, QThread,
+    QTimer, Qt, QUrl, pyqtSignal,
+)
+from PyQt5.QtGui import QColor, QIcon, QImage, QImageReader, QPainter, QPainterPath, QPen, QPixmap, QKeySequence
 from PyQt5.QtMultimedia import QSoundEffect
 from PyQt5.QtWidgets import (
     QAbstractItemView,
@@ -41,6 +57,7 @@ from PyQt5.QtWidgets import (
     QLabel,
     QLineEdit,
     QListWidget,
+    QListView,
     QListWidgetItem,
     QMainWindow,
     QMenu,
@@ -71,22 +88,56 @@ DEFAULT_DOWNLOAD_DIR = BASE_DIR / "download"
 HISTORY_PATH = DEFAULT_DOWNLOAD_DIR / "history.json"
 CRASH_LOG_PATH = BASE_DIR / "crash.log"
 RUNTIME_LOG_PATH = DEFAULT_DOWNLOAD_DIR / "runtime.log"
+RUNTIME_LOG_MAX_BYTES = 5 * 1024 * 1024
+RUNTIME_LOG_BACKUP_COUNT = 5
+QUEUE_JOURNAL_PATH = DEFAULT_DOWNLOAD_DIR / "queue.journal"
+# 媒体信息探测结果缓存：按 (路径, 大小, 修改时间) 命中，最多保留 MEDIA_CACHE_MAX_ENTRIES 个文件
+MEDIA_CACHE_PATH = DEFAULT_DOWNLOAD_DIR / "media_cache.json"
+MEDIA_CACHE_MAX_ENTRIES = 5000
+# 同时运行的 ffprobe/ffmpeg 探测进程数
+PROBE_WORKERS = 2
+# 封面磁盘缓存：按 URL 存放，总大小超过 COVER_CACHE_MAX_BYTES 时删除最久未用的
+COVER_CACHE_DIR = DEFAULT_DOWNLOAD_DIR / "covers"
+COVER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+COVER_WORKERS = 4
+# b23.tv 短链接解析结果缓存，以及并发解析的线程数
+SHORT_LINK_CACHE_PATH = DEFAULT_DOWNLOAD_DIR / "short_links.json"
+SHORT_LINK_CACHE_MAX_ENTRIES = 20000
+SHORT_LINK_WORKERS = 16
+SHORT_LINK_HOSTS = ("b23.tv", "bili2233.cn")
+# 下载存档：yt-dlp 兼容的 archive.txt（每行 "站点 ID"），画质等附加信息存在同名 .json
+ARCHIVE_PATH = DEFAULT_DOWNLOAD_DIR / "archive.txt"
+# 重复文件去重：摘要缓存和节省空间的记录；只处理这些扩展名、不小于 DEDUPE_MIN_BYTES 的文件
+DEDUPE_INDEX_PATH = DEFAULT_DOWNLOAD_DIR / "dedupe.json"
+DEDUPE_EXTENSIONS = (".mp4", ".mkv", ".flv", ".webm", ".mov", ".m4a", ".mp3", ".aac", ".opus", ".flac")
+DEDUPE_MIN_BYTES = 1024 * 1024
+DEDUPE_SAMPLE_BYTES = 64 * 1024
+# 从文件导入链接时每批加入队列的条数
+IMPORT_BATCH_SIZE = 500
+# 历史封面网格最多在内存中保留的封面数
+HISTORY_GRID_CACHE_LIMIT = 120
+# 队列日志的批量写入间隔（秒），以及触发压缩重写的记录数
+QUEUE_JOURNAL_FLUSH_INTERVAL = 0.5
+QUEUE_JOURNAL_COMPACT_RECORDS = 20000
+
+# 日志区最多保留的行数，以及批量追加的间隔（毫秒）
+LOG_VIEW_MAX_LINES = 2000
+LOG_VIEW_FLUSH_MS = 200
 
 FFMPEG_EXE = Path()
+FFPROBE_EXE = Path()
 
 
 def resolve_ffmpeg_path():
-    """优先使用 exe 同级 ffmpeg.exe，其次打包内置。"""
-    global FFMPEG_EXE
-    exe_level = BASE_DIR / "ffmpeg.exe"
-    if exe_level.exists():
-        FFMPEG_EXE = exe_level
-        return
-    bundled = RESOURCE_DIR / "ffmpeg.exe"
-    if bundled.exists():
-        FFMPEG_EXE = bundled
-        return
+    """优先使用 exe 同级 ffmpeg.exe，其次打包内置；ffprobe.exe 按同样顺序查找（可选）。"""
+    global FFMPEG_EXE, FFPROBE_EXE
     FFMPEG_EXE = Path()
+    FFPROBE_EXE = Path()
+    for folder in (BASE_DIR, RESOURCE_DIR):
+        if not FFMPEG_EXE.name and (folder / "ffmpeg.exe").exists():
+            FFMPEG_EXE = folder / "ffmpeg.exe"
+        if not FFPROBE_EXE.name and (folder / "ffprobe.exe").exists():
+            FFPROBE_EXE = folder / "ffprobe.exe"
 
 
 resolve_ffmpeg_path()
@@ -97,6 +148,31 @@ BILIBILI_NAV_API = "https://api.bilibili.com/x/web-interface/nav"
 BILIBILI_QRCODE_GENERATE_API = "https://passport.bilibili.com/x/passport-login/web/qrcode/generate"
 BILIBILI_QRCODE_POLL_API = "https://passport.bilibili.com/x/passport-login/web/qrcode/poll"
 BILIBILI_DM_LIST_API = "https://api.bilibili.com/x/v1/dm/list.so"
+BILI_API_HOST = urlparse(BILIBILI_VIEW_API).hostname
+
+# 下载线程向界面批量推送进度的间隔（秒），即 10 Hz
+PROGRESS_FLUSH_INTERVAL = 0.1
+# 同时下载任务数上限（设置页可选范围）
+MAX_CONCURRENT_DOWNLOADS = 8
+# 低速重连：统计最近 STALL_WINDOW_SECONDS 秒的平均速度，低于设置的下限即断开重连
+STALL_WINDOW_SECONDS = 20
+STALL_MAX_RECONNECTS = 5
+# 接口熔断：同一主机连续 BREAKER_THRESHOLD 次风控响应后暂停所有新请求 BREAKER_COOLDOWN 秒
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 60.0
+# 每个主机的并发连接上限：接口主机（api.*）受频率限制，CDN 主机只受带宽限制
+MAX_HOST_CONNECTIONS = 32
+# 流水线：提前解析排在前面的 RESOLVE_LOOKAHEAD 个任务；合并/探测等后处理在单独的线程池中进行，
+# 排队的后处理任务超过 POST_QUEUE_LIMIT 个时下载线程等待（背压）
+RESOLVE_LOOKAHEAD = 3
+RESOLVE_WORKERS = 2
+POST_WORKERS = os.cpu_count() or 2
+POST_QUEUE_LIMIT = POST_WORKERS * 2
+# ffmpeg 后处理：以较低的 CPU/IO 优先级运行，避免合并时拖慢正在进行的下载和界面；
+# 超时按输入大小估算：FFMPEG_TIMEOUT_BASE 秒起步，再按不低于 FFMPEG_MIN_THROUGHPUT 字节/秒的处理速度加时
+FFMPEG_NICE = 10
+FFMPEG_TIMEOUT_BASE = 120
+FFMPEG_MIN_THROUGHPUT = 5 * 1024 * 1024
 
 QUALITY_LABELS = {
     "best": "最高画质（推荐）",
@@ -144,6 +220,20 @@ BILI_ERROR_CATEGORIES = [
     (-799, "会员限制", "需要大会员才能观看，请配置大会员 Cookie。"),
 ]
 
+# 自动重试：风控/限频等待更久，网络错误很快重试；权限、不存在等错误不重试。
+# 单个任务最多重试 RETRY_MAX_ATTEMPTS 次，每一批任务合计最多 RETRY_BATCH_BUDGET 次
+RETRY_BASE_DELAYS = {"risk": 30.0, "network": 5.0}
+RETRY_MAX_DELAY = 600.0
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BATCH_BUDGET = 20
+RETRYABLE_BILI_CODES = {-352: "risk", -509: "risk"}
+FATAL_BILI_CODES = (-404, -403, -799)
+NETWORK_ERROR_MARKERS = (
+    "timed out", "Connection reset", "Connection aborted", "Connection refused",
+    "Remote end closed", "IncompleteRead", "Temporary failure in name resolution",
+    "HTTP Error 502", "HTTP Error 503", "HTTP Error 504",
+)
+
 DEFAULT_SETTINGS = {
     "download_dir": str(DEFAULT_DOWNLOAD_DIR),
     "quality": "best",
@@ -159,6 +249,14 @@ DEFAULT_SETTINGS = {
     "download_thumbnail": False,
     "download_subtitle": False,
     "download_danmaku": False,
+    "ytdlp_subprocess": False,
+    "keep_partial_on_cancel": False,
+    "skip_archived": True,
+    "dedupe_downloads": False,
+    "stall_speed_floor_kb": 20,
+    "api_concurrency": 2,
+    "cdn_concurrency": 16,
+    "ffmpeg_workers": 0,
     "fx_sakura": True,
     "fx_neon": True,
     "fx_sound": True,
@@ -237,13 +335,73 @@ def apply_cookie_and_proxy_options(opts, settings):
     return opts
 
 
+_runtime_logger = None
+_runtime_log_listener = None
+_runtime_log_lock = threading.Lock()
+
+
+def _gzip_log_namer(name):
+    return f"{name}.gz"
+
+
+def _gzip_log_rotator(source, dest):
+    """轮转时把旧日志压缩为 .gz。"""
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def get_runtime_logger():
+    """返回运行日志 logger。
+
+    调用方只把消息放进内存队列，由后台 QueueListener 线程写入 runtime.log；
+    文件超过 RUNTIME_LOG_MAX_BYTES 后轮转，旧文件压缩为 runtime.log.N.gz。
+    """
+    global _runtime_logger, _runtime_log_listener
+    with _runtime_log_lock:
+        if _runtime_logger is not None:
+            return _runtime_logger
+        RUNTIME_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            RUNTIME_LOG_PATH,
+            maxBytes=RUNTIME_LOG_MAX_BYTES,
+            backupCount=RUNTIME_LOG_BACKUP_COUNT,
+            encoding="utf-8",
+            delay=True,
+        )
+        file_handler.namer = _gzip_log_namer
+        file_handler.rotator = _gzip_log_rotator
+        file_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+        log_queue = queue.SimpleQueue()
+        _runtime_log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+        _runtime_log_listener.start()
+        atexit.register(shutdown_runtime_log)
+        logger = logging.getLogger("downbili.runtime")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        _runtime_logger = logger
+        return logger
+
+
+def shutdown_runtime_log():
+    """停止后台日志线程，写完队列中剩余的消息。"""
+    global _runtime_log_listener
+    with _runtime_log_lock:
+        listener, _runtime_log_listener = _runtime_log_listener, None
+    if listener is not None:
+        try:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+        except Exception:
+            pass
+
+
 def write_runtime_log(msg):
-    """将运行日志追加到 runtime.log（自动创建目录）。"""
+    """将运行日志追加到 runtime.log（异步写入，自动创建目录）。"""
     try:
-        RUNTIME_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
-        ts = time.strftime("%Y-%m-%d %H:%M:%S")
-        with open(RUNTIME_LOG_PATH, "a", encoding="utf-8") as f:
-            f.write(f"[{ts}] {msg}\n")
+        get_runtime_logger().info(msg)
     except Exception:
         pass
 
@@ -279,6 +437,25 @@ def split_inputs(text):
     return [p.strip() for p in parts if p.strip()]
 
 
+def extract_links(text):
+    """从一段文本中取出看起来像链接或 BV/av 号的部分，BV/av 号补全为完整链接。
+
+    浏览器拖拽、分享文案和链接列表文件常带标题等多余文字，这里只保留可下载的部分。
+    """
+    links = []
+    for c in split_inputs(text):
+        if c.startswith("http://") or c.startswith("https://"):
+            links.append(c)
+        elif re.fullmatch(r"BV[0-9A-Za-z]{10,}", c) or re.fullmatch(r"[aA][vV]\d+", c):
+            links.append(normalize_input(c))
+        else:
+            # 尝试从一行文本中提取 URL
+            m = re.search(r"(https?://\S+)", c)
+            if m:
+                links.append(m.group(1))
+    return links
+
+
 def extract_bvid(url):
     """从链接中提取 BV 号。"""
     m = re.search(r"(BV[0-9A-Za-z]{10,})", url)
@@ -302,6 +479,214 @@ def extract_video_id(url):
     return (None, None)
 
 
+# av 号与 BV 号互转（B站 2024 年起的新算法），不需要请求接口
+BV_TABLE = "FcwAPNKTMug3GV5Lj7EJnHpWsx4tb8haYeviqBz6rkCy12mUSDQX9RdoZf"
+BV_XOR = 23442827791579
+BV_MASK = 2251799813685247
+BV_MAX_AID = 1 << 51
+BV_BASE = 58
+
+
+def av_to_bv(aid):
+    """av 号（整数或数字字符串）转 BV 号。超出 1..2^51-1 范围时抛出 ValueError。"""
+    aid = int(aid)
+    if not 0 < aid < BV_MAX_AID:
+        raise ValueError(f"无效的 av 号: {aid}")
+    chars = list("BV1000000000")
+    pos = len(chars) - 1
+    tmp = (BV_MAX_AID | aid) ^ BV_XOR
+    while tmp > 0:
+        chars[pos] = BV_TABLE[tmp % BV_BASE]
+        tmp //= BV_BASE
+        pos -= 1
+    chars[3], chars[9] = chars[9], chars[3]
+    chars[4], chars[7] = chars[7], chars[4]
+    return "".join(chars)
+
+
+def bv_to_av(bvid):
+    """BV 号转 av 号（整数）。格式不对时抛出 ValueError。"""
+    if not re.fullmatch(r"BV1[%s]{9}" % BV_TABLE, bvid or ""):
+        raise ValueError(f"无效的 BV 号: {bvid}")
+    chars = list(bvid)
+    chars[3], chars[9] = chars[9], chars[3]
+    chars[4], chars[7] = chars[7], chars[4]
+    tmp = 0
+    for c in chars[3:]:
+        tmp = tmp * BV_BASE + BV_TABLE.index(c)
+    return (tmp & BV_MASK) ^ BV_XOR
+
+
+def canonical_video_key(url):
+    """B站视频的规范键 (BV 号, 分 P)，av 号链接会先换算成 BV 号；其他链接返回 None。
+
+    用于去重和缓存：同一个视频的 av/BV 链接、短 ID 和完整链接得到相同的键。
+    只认 B站域名（含短链接域名）下的链接和单独的 av/BV 号，其他网站路径里的 "av123" 不算。
+    """
+    url = normalize_input(url)
+    host = (urlparse(url if "//" in url else "//" + url).hostname or "").lower()
+    if not (host == "bilibili.com" or host.endswith(".bilibili.com") or host in SHORT_LINK_HOSTS):
+        return None
+    id_type, id_value = extract_video_id(url)
+    if id_type == "aid":
+        try:
+            bvid = av_to_bv(id_value)
+        except ValueError:
+            return None
+    elif id_type == "bvid" and re.fullmatch(r"BV1[%s]{9}" % BV_TABLE, id_value):
+        bvid = id_value
+    else:
+        return None
+    return (bvid, selected_page_number(url))
+
+
+def input_key(url):
+    """输入去重用的键：B站视频用规范键，其他链接用规范化后的地址。"""
+    return canonical_video_key(url) or normalize_input(url)
+
+
+def is_short_link(url):
+    host = (urlparse(url).hostname or "").lower()
+    return any(host == h or host.endswith("." + h) for h in SHORT_LINK_HOSTS)
+
+
+def clean_bili_url(url):
+    """去掉分享链接里的跟踪参数：视频链接改写为 https://www.bilibili.com/video/BV...[?p=N]，其他原样返回。"""
+    key = canonical_video_key(url)
+    if key is None:
+        return url
+    bvid, page = key
+    return f"https://www.bilibili.com/video/{bvid}" + (f"?p={page}" if page > 1 else "")
+
+
+class ShortLinkResolver:
+    """b23.tv 等短链接的解析器：只请求跳转地址（HEAD，不跟随跳转），多个链接并发解析。
+
+    结果按短链接持久缓存到 SHORT_LINK_CACHE_PATH（path 为空时），同一个短链接只请求一次。线程安全。
+    """
+
+    def __init__(self, path=None, follow=None):
+        self._path = path
+        self._follow = follow or self.follow_redirects
+        self._lock = threading.Lock()
+        self._cache = None
+        self._dirty = False
+        self._pool = None
+        self._futures = {}
+
+    @property
+    def path(self):
+        return Path(self._path or SHORT_LINK_CACHE_PATH)
+
+    @staticmethod
+    def cache_key(url):
+        parsed = urlparse(url)
+        return f"{(parsed.hostname or '').lower()}{parsed.path.rstrip('/')}"
+
+    def _load(self):
+        if self._cache is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self._cache = data if isinstance(data, dict) else {}
+            except Exception:
+                self._cache = {}
+        return self._cache
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            cache = self._load()
+            for key in list(cache)[:max(0, len(cache) - SHORT_LINK_CACHE_MAX_ENTRIES)]:
+                del cache[key]
+            self._dirty = False
+            data = dict(cache)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except Exception:
+            pass
+
+    def cached(self, url):
+        with self._lock:
+            return self._load().get(self.cache_key(url))
+
+    @staticmethod
+    def follow_redirects(url, proxy=""):
+        """逐跳请求 Location（最多 5 跳），离开短链接域名即停止，返回清理后的目标地址。"""
+        proxies = {"http": proxy, "https": proxy} if proxy else None
+        for _ in range(5):
+            resp = requests.head(url, headers=std_headers(), allow_redirects=False, timeout=5, proxies=proxies)
+            if resp.status_code == 405:
+                resp = requests.get(url, headers=std_headers(), allow_redirects=False, timeout=5,
+                                    proxies=proxies, stream=True)
+                resp.close()
+            location = resp.headers.get("Location")
+            if resp.status_code not in (301, 302, 303, 307, 308) or not location:
+                break
+            url = urljoin(url, location)
+            if not is_short_link(url):
+                break
+        if is_short_link(url):
+            raise RuntimeError(f"短链接没有跳转到视频页: {url}")
+        return clean_bili_url(url)
+
+    def _resolve(self, url, proxy):
+        key = self.cache_key(url)
+        try:
+            target = self._follow(url, proxy)
+        except Exception:
+            # 失败不缓存，下次输入时再试
+            with self._lock:
+                self._futures.pop(key, None)
+            raise
+        with self._lock:
+            self._load()[key] = target
+            self._dirty = True
+            self._futures.pop(key, None)
+        return target
+
+    def prefetch(self, urls, proxy=""):
+        """在后台开始解析还没有缓存的短链接，返回对应的 Future 列表（不等待）。"""
+        futures = []
+        with self._lock:
+            cache = self._load()
+            for url in urls:
+                if not is_short_link(url):
+                    continue
+                key = self.cache_key(url)
+                if key in cache:
+                    continue
+                future = self._futures.get(key)
+                if future is None:
+                    if self._pool is None:
+                        self._pool = concurrent.futures.ThreadPoolExecutor(
+                            max_workers=SHORT_LINK_WORKERS, thread_name_prefix="shortlink")
+                    future = self._pool.submit(self._resolve, url, proxy)
+                    self._futures[key] = future
+                futures.append(future)
+        return futures
+
+    def expand(self, urls, proxy="", timeout=10):
+        """把列表中的短链接换成目标地址；解析失败或超时的保持原样。"""
+        futures = self.prefetch(urls, proxy)
+        if futures:
+            concurrent.futures.wait(futures, timeout=timeout)
+            self.save()
+        result = []
+        for url in urls:
+            target = self.cached(url) if is_short_link(url) else None
+            result.append(target or url)
+        return result
+
+
+SHORT_LINKS = ShortLinkResolver()
+
+
 def normalize_input(text):
     """规范化输入：BV/av 号补全为完整链接，其他原样返回。"""
     text = (text or "").strip()
@@ -333,17 +718,122 @@ def sanitize_filename(name, max_len=120):
     return name[:max_len].strip() or "video"
 
 
+class LibraryIndex:
+    """下载目录的内存索引：每个目录第一次用到时 os.scandir 扫描一遍，之后由程序自己的写入和目录监视保持更新。
+
+    存在性判断、分配不重名的文件名都只查内存里的集合，不再逐个 stat；文件名按 os.path.normcase 比较，
+    Windows 下不区分大小写。分配出去但还没写入磁盘的文件名单独记为预留，重新扫描时不会丢。
+    """
+
+    def __init__(self, scan=None):
+        self._scan_dir = scan or self.scan_dir
+        self._lock = threading.Lock()
+        self._dirs = {}  # 目录键 -> {规范化文件名: (文件名, 大小, 修改时间)}，子目录的大小记为 -1
+        self._reserved = {}  # 目录键 -> 已分配还没落盘的规范化文件名
+
+    @staticmethod
+    def folder_key(folder):
+        return os.path.normcase(os.path.abspath(str(folder)))
+
+    @staticmethod
+    def scan_dir(folder):
+        entries = {}
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            st = entry.stat()
+                            entries[os.path.normcase(entry.name)] = (entry.name, st.st_size, st.st_mtime_ns)
+                        else:
+                            entries[os.path.normcase(entry.name)] = (entry.name, -1, 0)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return entries
+
+    def _entries(self, folder):
+        """调用方需持有锁；目录还没建索引时先扫描一遍。"""
+        key = self.folder_key(folder)
+        entries = self._dirs.get(key)
+        if entries is None:
+            entries = self._dirs[key] = self._scan_dir(folder)
+        return key, entries
+
+    def rescan(self, folder):
+        """重新扫描目录（目录监视发现外部改动时调用），扫描在锁外进行。"""
+        entries = self._scan_dir(folder)
+        with self._lock:
+            self._dirs[self.folder_key(folder)] = entries
+
+    def indexed(self, folder):
+        with self._lock:
+            return self.folder_key(folder) in self._dirs
+
+    def exists(self, path):
+        path = Path(path)
+        name = os.path.normcase(path.name)
+        with self._lock:
+            key, entries = self._entries(path.parent)
+            return name in entries or name in self._reserved.get(key, ())
+
+    def files(self, folder):
+        """返回目录下文件的 (文件名, 大小, 修改时间) 列表。"""
+        with self._lock:
+            _, entries = self._entries(folder)
+            return [v for v in entries.values() if v[1] >= 0]
+
+    def add(self, path):
+        """登记程序刚写好的文件，同时解除它的预留。"""
+        path = Path(path)
+        try:
+            st = path.stat()
+        except OSError:
+            self.discard(path)
+            return
+        name = os.path.normcase(path.name)
+        with self._lock:
+            key, entries = self._entries(path.parent)
+            entries[name] = (path.name, st.st_size, st.st_mtime_ns)
+            self._reserved.get(key, set()).discard(name)
+
+    def discard(self, path):
+        path = Path(path)
+        name = os.path.normcase(path.name)
+        with self._lock:
+            key = self.folder_key(path.parent)
+            if key in self._dirs:
+                self._dirs[key].pop(name, None)
+            self._reserved.get(key, set()).discard(name)
+
+    def release(self, path):
+        """撤销 allocate 的预留（下载失败、文件没有写出来时调用）。"""
+        path = Path(path)
+        with self._lock:
+            self._reserved.get(self.folder_key(path.parent), set()).discard(os.path.normcase(path.name))
+
+    def allocate(self, path):
+        """返回不与已有文件或其它预留冲突的路径（必要时加 " (n)" 后缀）并预留下来。"""
+        path = Path(path)
+        with self._lock:
+            key, entries = self._entries(path.parent)
+            reserved = self._reserved.setdefault(key, set())
+            name = path.name
+            for i in range(1, 10001):
+                norm = os.path.normcase(name)
+                if norm not in entries and norm not in reserved:
+                    reserved.add(norm)
+                    return path.with_name(name)
+                name = f"{path.stem} ({i}){path.suffix}"
+        raise RuntimeError(f"无法生成唯一文件名: {path}")
+
+
+LIBRARY = LibraryIndex()
+
+
 def unique_path(path):
-    if not path.exists():
-        return path
-    stem = path.stem
-    suffix = path.suffix
-    parent = path.parent
-    for i in range(1, 10000):
-        candidate = parent / f"{stem} ({i}){suffix}"
-        if not candidate.exists():
-            return candidate
-    raise RuntimeError(f"无法生成唯一文件名: {path}")
+    return LIBRARY.allocate(path)
 
 
 def format_duration(seconds):
@@ -406,8 +896,74 @@ def format_fps(fps):
     return f"{fps:.0f}"
 
 
+def format_media_duration(seconds):
+    """秒数 -> ffmpeg 风格的 HH:MM:SS.xx，与文本解析得到的时长格式一致。"""
+    try:
+        seconds = float(seconds)
+    except (TypeError, ValueError):
+        return ""
+    if seconds <= 0:
+        return ""
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{secs:05.2f}"
+
+
+def parse_frame_rate(value):
+    """解析 '30000/1001' 或 '25' 形式的帧率，无效时返回 0。"""
+    try:
+        num, _, den = str(value).partition("/")
+        rate = float(num) / float(den or 1)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return 0
+    return rate if rate > 0 else 0
+
+
+def parse_ffprobe_json(data):
+    """解析 ffprobe -print_format json 的输出，字段与 parse_media_info_text 相同。
+
+    有多条视频流时取默认流，没有默认流时取分辨率最高的一条（跳过封面图）。
+    """
+    info = {}
+    if not isinstance(data, dict):
+        return info
+    fmt = data.get("format") or {}
+    duration = format_media_duration(fmt.get("duration"))
+    if duration:
+        info["duration"] = duration
+    try:
+        info["bitrate"] = int(fmt.get("bit_rate")) // 1000
+    except (TypeError, ValueError):
+        pass
+    streams = data.get("streams") or []
+    videos = [st for st in streams if st.get("codec_type") == "video"
+              and not (st.get("disposition") or {}).get("attached_pic")]
+    if videos:
+        video = max(videos, key=lambda st: ((st.get("disposition") or {}).get("default", 0),
+                                            (st.get("width") or 0) * (st.get("height") or 0)))
+        info["video_codec"] = video.get("codec_name", "")
+        if video.get("width") and video.get("height"):
+            info["width"] = int(video["width"])
+            info["height"] = int(video["height"])
+        fps = parse_frame_rate(video.get("avg_frame_rate")) or parse_frame_rate(video.get("r_frame_rate"))
+        if fps:
+            info["fps"] = fps
+    audios = [st for st in streams if st.get("codec_type") == "audio"]
+    if audios:
+        audio = max(audios, key=lambda st: (st.get("disposition") or {}).get("default", 0))
+        info["audio_codec"] = audio.get("codec_name", "")
+        try:
+            info["audio_sample_rate"] = int(audio.get("sample_rate"))
+        except (TypeError, ValueError):
+            pass
+    return info
+
+
 def parse_media_info_text(text):
-    """解析 ffmpeg -i stderr 文本。"""
+    """解析 ffmpeg -i stderr 文本（没有 ffprobe 时的兜底）。
+
+    逐行匹配流信息，视频流取分辨率最高的一条；帧率优先取 fps，其次 tbr。
+    """
     info = {}
     if not text:
         return info
@@ -417,41 +973,228 @@ def parse_media_info_text(text):
     m = re.search(r"bitrate:\s*(\d+)", text)
     if m:
         info["bitrate"] = int(m.group(1))
-    video_match = re.search(
-        r"Stream #\d+:\d+.*Video:\s*(\w+)[^,]*,\s*(\d+)x(\d+)[^,]*,?\s*([\d.]+)?\s*tbr?",
-        text,
-    )
-    if video_match:
-        info["video_codec"] = video_match.group(1)
-        info["width"] = int(video_match.group(2))
-        info["height"] = int(video_match.group(3))
-        if video_match.group(4):
-            info["fps"] = float(video_match.group(4))
-    audio_match = re.search(r"Stream #\d+:\d+.*Audio:\s*(\w+)[^,]*,\s*(\d+)\s*Hz", text)
-    if audio_match:
-        info["audio_codec"] = audio_match.group(1)
-        info["audio_sample_rate"] = int(audio_match.group(2))
+    best_area = -1
+    for line in text.splitlines():
+        video_match = re.search(r"Stream #\d+:\d+.*?Video:\s*(\w+)", line)
+        if video_match and "attached pic" not in line:
+            size = re.search(r"\b(\d{2,5})x(\d{2,5})\b", line)
+            width, height = (int(size.group(1)), int(size.group(2))) if size else (0, 0)
+            if width * height <= best_area:
+                continue
+            best_area = width * height
+            info["video_codec"] = video_match.group(1)
+            if size:
+                info["width"], info["height"] = width, height
+            rate = re.search(r"([\d.]+)\s*fps", line) or re.search(r"([\d.]+k?)\s*tbr", line)
+            if rate and not rate.group(1).endswith("k"):
+                info["fps"] = float(rate.group(1))
+            continue
+        audio_match = re.search(r"Stream #\d+:\d+.*?Audio:\s*(\w+)", line)
+        if audio_match and "audio_codec" not in info:
+            info["audio_codec"] = audio_match.group(1)
+            rate = re.search(r"(\d+)\s*Hz", line)
+            if rate:
+                info["audio_sample_rate"] = int(rate.group(1))
     return info
 
 
+def probe_media_file(path):
+    """探测媒体信息：优先 ffprobe JSON，没有 ffprobe 或解析失败时退回 ffmpeg -i 文本。"""
+    flags = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+    if FFPROBE_EXE.exists():
+        try:
+            proc = subprocess.run(
+                [str(FFPROBE_EXE), "-v", "error", "-print_format", "json",
+                 "-show_format", "-show_streams", str(path)],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=15, creationflags=flags,
+            )
+            info = parse_ffprobe_json(json.loads(proc.stdout.decode("utf-8", errors="ignore") or "{}"))
+            if info:
+                return info
+        except Exception:
+            pass
+    if FFMPEG_EXE.exists():
+        try:
+            proc = subprocess.run(
+                [str(FFMPEG_EXE), "-hide_banner", "-i", str(path)],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=15, creationflags=flags,
+            )
+            return parse_media_info_text(proc.stderr.decode("utf-8", errors="ignore"))
+        except Exception:
+            pass
+    return {}
+
+
+class MediaProbeCache:
+    """媒体信息的持久缓存，文件大小或修改时间变化后自动失效。
+
+    每个路径只保留最新一条结果；探测在调用线程进行，同时运行的探测进程数受 PROBE_WORKERS 限制。
+    path 为空时使用 MEDIA_CACHE_PATH。
+    """
+
+    def __init__(self, path=None, probe=None):
+        self._path = path
+        self._probe = probe or probe_media_file
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(PROBE_WORKERS)
+        self._entries = None
+
+    @property
+    def path(self):
+        return Path(self._path or MEDIA_CACHE_PATH)
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self._entries = data if isinstance(data, dict) else {}
+            except Exception:
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        entries = self._entries
+        if len(entries) > MEDIA_CACHE_MAX_ENTRIES:
+            # dict 保持插入顺序，最早写入的在前
+            for key in list(entries)[:len(entries) - MEDIA_CACHE_MAX_ENTRIES]:
+                del entries[key]
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except Exception:
+            pass
+
+    def lookup(self, path):
+        """返回缓存中仍然有效的结果，没有时返回 None。"""
+        try:
+            st = Path(path).stat()
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._load().get(str(Path(path).resolve()))
+        if entry and entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime_ns:
+            return dict(entry.get("info") or {})
+        return None
+
+    def info(self, path):
+        """返回媒体信息（含 file_size），未命中缓存时探测并写入缓存；文件不存在时返回 {}。"""
+        cached = self.lookup(path)
+        if cached is not None:
+            return cached
+        try:
+            st = Path(path).stat()
+        except OSError:
+            return {}
+        with self._slots:
+            info = self._probe(path)
+        if not info:
+            # 探测不到（没有 ffmpeg 或文件还不完整）时不缓存，下次再试
+            return {"file_size": st.st_size}
+        info["file_size"] = st.st_size
+        key = str(Path(path).resolve())
+        with self._lock:
+            entries = self._load()
+            entries.pop(key, None)
+            entries[key] = {"size": st.st_size, "mtime": st.st_mtime_ns, "info": info}
+            self._save()
+        return dict(info)
+
+
+MEDIA_PROBE_CACHE = MediaProbeCache()
+
+
 def media_info_for_file(path):
-    """用 ffmpeg -i 解析媒体信息。"""
-    if not FFMPEG_EXE.exists() or not Path(path).exists():
-        return {}
+    """返回文件的媒体信息，同一文件（大小、修改时间不变）只探测一次。"""
+    return MEDIA_PROBE_CACHE.info(path)
+
+
+def ffmpeg_timeout(input_bytes):
+    """按输入大小估算 ffmpeg 的超时秒数。"""
+    return FFMPEG_TIMEOUT_BASE + max(0, int(input_bytes or 0)) / FFMPEG_MIN_THROUGHPUT
+
+
+def parse_ffmpeg_progress_line(line):
+    """解析 ffmpeg -progress 输出的一行，返回已处理的秒数；不是时间行或值为 N/A 时返回 None。"""
+    key, _, value = line.strip().partition("=")
+    # out_time_ms 历史上实际单位也是微秒
+    if key in ("out_time_us", "out_time_ms") and value.isdigit():
+        return int(value) / 1_000_000
+    return None
+
+
+def _lower_process_priority():
+    """在 ffmpeg 子进程里执行（POSIX）：降低 CPU 调度优先级。"""
     try:
-        proc = subprocess.run(
-            [str(FFMPEG_EXE), "-hide_banner", "-i", str(path)],
-            stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            timeout=15,
-            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
-        )
-        text = proc.stderr.decode("utf-8", errors="ignore")
-        info = parse_media_info_text(text)
-        info["file_size"] = Path(path).stat().st_size
-        return info
-    except Exception:
-        return {}
+        os.nice(FFMPEG_NICE)
+    except OSError:
+        pass
+
+
+def run_ffmpeg(args, input_bytes=0, on_progress=None, abort=None):
+    """以较低的 CPU/IO 优先级运行 ffmpeg，并通过 -progress 输出回报已处理的秒数。
+
+    超时按 input_bytes 估算；abort() 返回真时结束进程。失败、超时或被中止时抛出 RuntimeError。
+    """
+    cmd = [str(FFMPEG_EXE), "-hide_banner", "-nostdin", "-loglevel", "error",
+           "-progress", "pipe:1", "-nostats", *args]
+    kwargs = {}
+    if os.name == "nt":
+        kwargs["creationflags"] = (getattr(subprocess, "CREATE_NO_WINDOW", 0)
+                                   | getattr(subprocess, "BELOW_NORMAL_PRIORITY_CLASS", 0))
+    else:
+        kwargs["preexec_fn"] = _lower_process_priority
+        ionice = shutil.which("ionice")
+        if ionice:
+            cmd = [ionice, "-c", "2", "-n", "7", *cmd]
+    deadline = time.monotonic() + ffmpeg_timeout(input_bytes)
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, **kwargs)
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True)
+    reader.start()
+    killed = []
+
+    def watch():
+        while proc.poll() is None:
+            if time.monotonic() > deadline:
+                killed.append("ffmpeg 处理超时")
+            elif abort and abort():
+                killed.append("用户取消")
+            if killed:
+                proc.kill()
+                return
+            time.sleep(0.2)
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+    try:
+        for raw in proc.stdout:
+            seconds = parse_ffmpeg_progress_line(raw.decode("utf-8", errors="ignore"))
+            if seconds is not None and on_progress:
+                on_progress(seconds)
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+    reader.join(1)
+    watcher.join(1)
+    if killed:
+        raise RuntimeError(killed[0])
+    if proc.returncode != 0:
+        tail = b"".join(stderr).decode("utf-8", errors="ignore").strip().splitlines()[-3:]
+        raise RuntimeError(f"ffmpeg 退出码 {proc.returncode}: {' '.join(tail)}")
+
+
+def ffmpeg_worker_count(settings):
+    """后处理中同时运行的 ffmpeg 进程数；设置为 0 时按 CPU 核数。"""
+    count = int(settings.get("ffmpeg_workers", 0) or 0)
+    return min(count, POST_WORKERS) if count > 0 else POST_WORKERS
 
 
 def format_error(exc):
@@ -636,8 +1379,1574 @@ def update_history_record(index, updates):
         save_history(records)
 
 
+# ==================== 下载存档 ====================
+
+# 画质档位的高低，用于判断是否需要重新下载更高画质；自定义格式按最高画质处理
+QUALITY_RANK = {"audio": 0, "360": 360, "480": 480, "720": 720, "1080": 1080,
+                "1440": 1440, "2160": 2160, "best": 100000}
+ARCHIVE_NAME_ID_RE = re.compile(r"\[(BV1[0-9A-Za-z]{9})(?:_p(\d+))?\]")
+
+
+def requested_quality_rank(settings):
+    if (settings.get("custom_format") or "").strip():
+        return QUALITY_RANK["best"]
+    return QUALITY_RANK.get(settings.get("quality", "best"), QUALITY_RANK["best"])
+
+
+def archive_key(url):
+    """存档键 "站点 ID 分P"：B站视频用 BV 号（av 号先换算），其他链接用规范化后的地址。"""
+    key = canonical_video_key(url)
+    if key is not None:
+        return f"bilibili {key[0]} {key[1]}"
+    return f"url {normalize_input(url)} 1"
+
+
+def ytdlp_archive_line(key):
+    """存档键对应的 yt-dlp download_archive 行；非 B站链接没有固定的 ID，返回空串。"""
+    site, vid, page = key.rsplit(" ", 2)
+    if site != "bilibili":
+        return ""
+    return f"bilibili {vid}" if page == "1" else f"bilibili {vid}_p{page}"
+
+
+def parse_resolution_height(resolution):
+    m = re.search(r"x(\d+)", resolution or "")
+    return int(m.group(1)) if m else 0
+
+
+class DownloadArchive:
+    """已下载视频的索引，下载前查询：同一视频已下载且画质不低于这次请求的画质时跳过。
+
+    索引值记录实际下载到的分辨率高度和文件路径；请求"最高画质"时已有的下载都算满足，
+    只有明确要求的画质高于记录的实际高度时才重新下载。首次使用时从历史记录和下载目录里
+    文件名带 [BV…] 的文件建立（默认文件名模板 "[%(id)s]" 的形式）；archive.txt 与 yt-dlp
+    的 --download-archive 格式相同，可以互相使用。path 为空时使用 ARCHIVE_PATH。
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = None
+        self._history_seeded = False
+        self._seeded_dirs = set()
+
+    @property
+    def path(self):
+        return Path(self._path or ARCHIVE_PATH)
+
+    @property
+    def meta_path(self):
+        return self.path.with_suffix(".json")
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        entries = {}
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                entries.update(data)
+        except Exception:
+            pass
+        try:
+            # yt-dlp 或其他程序写入的行：没有画质信息，视为已下载最高画质
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    m = re.fullmatch(r"bilibili (BV1[0-9A-Za-z]{9})(?:_p(\d+))?", line.strip())
+                    if m:
+                        entries.setdefault(f"bilibili {m.group(1)} {m.group(2) or 1}", {})
+        except OSError:
+            pass
+        self._entries = entries
+        return entries
+
+    def _save(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.meta_path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp, self.meta_path)
+        except Exception:
+            pass
+
+    def _append_line(self, key):
+        line = ytdlp_archive_line(key)
+        if not line:
+            return
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError:
+            pass
+
+    def seed(self, load_history_records, download_dir=None):
+        """从历史记录和下载目录的文件名补充索引；历史只读一次，同一目录只扫描一次。"""
+        with self._lock:
+            if self._history_seeded and str(download_dir or "") in self._seeded_dirs:
+                return
+            entries = self._load()
+            added = []
+            history = [] if self._history_seeded else load_history_records()
+            self._history_seeded = True
+            for record in history:
+                if record.get("status") != "completed" or not record.get("url"):
+                    continue
+                key = archive_key(record["url"])
+                if key not in entries:
+                    entries[key] = {
+                        "height": parse_resolution_height(record.get("resolution")),
+                        "path": record.get("output_path") or "",
+                    }
+                    added.append(key)
+            folder = str(download_dir or "")
+            if folder and folder not in self._seeded_dirs:
+                self._seeded_dirs.add(folder)
+                for name, _size, _mtime in LIBRARY.files(folder):
+                    m = ARCHIVE_NAME_ID_RE.search(name)
+                    if not m or name.endswith((".part", ".ytdl")) or ".part-Frag" in name:
+                        continue
+                    key = f"bilibili {m.group(1)} {m.group(2) or 1}"
+                    if key not in entries:
+                        entries[key] = {"path": os.path.join(folder, name)}
+                        added.append(key)
+            if added:
+                for key in added:
+                    self._append_line(key)
+                self._save()
+
+    def lookup(self, url):
+        with self._lock:
+            return self._load().get(archive_key(url))
+
+    @staticmethod
+    def _satisfies(entry, settings):
+        wanted = requested_quality_rank(settings)
+        height = entry.get("height") or 0
+        # 不知道实际高度（只有文件名或 yt-dlp 的存档行）时视为已满足
+        return wanted >= QUALITY_RANK["best"] or not height or wanted <= height
+
+    def match(self, url, settings):
+        """已下载且画质足够时返回索引项，否则返回 None。"""
+        entry = self.lookup(url)
+        if entry is None or not self._satisfies(entry, settings):
+            return None
+        return entry
+
+    def needs_upgrade(self, url, settings):
+        """已下载过，但这次明确要求的画质高于记录的实际高度。"""
+        entry = self.lookup(url)
+        return entry is not None and not self._satisfies(entry, settings)
+
+    def record(self, url, height=0, path=""):
+        """记录一次完成的下载，height 为实际下载到的分辨率高度（未知时为 0）。"""
+        key = archive_key(url)
+        with self._lock:
+            entries = self._load()
+            is_new = key not in entries
+            entries[key] = {"height": height or 0, "path": path}
+            if is_new:
+                self._append_line(key)
+            self._save()
+
+
+DOWNLOAD_ARCHIVE = DownloadArchive()
+
+
+# ==================== 重复文件去重 ====================
+
+def sample_file_hash(path, size, block=DEDUPE_SAMPLE_BYTES):
+    """读取文件开头、中间、结尾各一块计算摘要，用来快速排除大小相同但内容不同的文件。"""
+    digest = hashlib.blake2b(str(size).encode("ascii"), digest_size=16)
+    with open(path, "rb") as f:
+        for offset in sorted({0, max(0, size // 2 - block // 2), max(0, size - block)}):
+            f.seek(offset)
+            digest.update(f.read(block))
+    return digest.hexdigest()
+
+
+def full_file_hash(path, chunk=1024 * 1024):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(chunk), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _reflink(source, target):
+    """Linux 上用 FICLONE 做写时复制克隆（btrfs、xfs 等支持），其它系统返回 False。"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno())  # FICLONE
+        return True
+    except OSError:
+        try:
+            os.unlink(target)
+        except OSError:
+            pass
+        return False
+
+
+def link_duplicate(duplicate, original):
+    """把 duplicate 原子地替换为 original 的硬链接，文件系统不支持硬链接时尝试 reflink。
+
+    返回使用的方式 "hardlink" / "reflink"，都不支持时返回 ""，duplicate 保持不变。
+    """
+    duplicate = Path(duplicate)
+    tmp = duplicate.with_name(duplicate.name + ".dedupe")
+    try:
+        os.link(original, tmp)
+        method = "hardlink"
+    except OSError:
+        if not _reflink(original, tmp):
+            return ""
+        method = "reflink"
+    try:
+        os.replace(tmp, duplicate)
+    except OSError:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        return ""
+    return method
+
+
+class FileDeduper:
+    """按内容合并下载目录里的重复文件：大小相同再比抽样摘要，抽样也相同才计算完整摘要，一致时换成硬链接。
+
+    候选文件的大小直接取自 LIBRARY 索引，摘要按 (路径, 大小, 修改时间) 缓存在 path（为空时用 DEDUPE_INDEX_PATH），
+    所以重复运行只会读新增或改动过的文件。已经合并过的文件在缓存里标记为 shared（reflink 之后链接数仍是 1，
+    只能靠这个标记识别），之后不会再次合并或重复计入节省的空间。累计节省的空间和合并的文件数也记录在这个文件里。
+    """
+
+    def __init__(self, path=None, link=None):
+        self._path = path
+        self._link = link or link_duplicate
+        self._lock = threading.Lock()
+        self._data = None
+        self._dirty = False
+
+    @property
+    def path(self):
+        return Path(self._path or DEDUPE_INDEX_PATH)
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception:
+                data = {}
+            if not isinstance(data, dict) or not isinstance(data.get("files"), dict):
+                data = {"files": {}}
+            data.setdefault("saved_bytes", 0)
+            data.setdefault("linked", 0)
+            self._data = data
+        return self._data
+
+    def _save(self):
+        if not self._dirty:
+            return
+        files = self._data["files"]
+        if len(files) > MEDIA_CACHE_MAX_ENTRIES:
+            for key in list(files)[:len(files) - MEDIA_CACHE_MAX_ENTRIES]:
+                del files[key]
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._dirty = False
+        except Exception:
+            pass
+
+    @staticmethod
+    def eligible(name, size):
+        return size >= DEDUPE_MIN_BYTES and os.path.splitext(name)[1].lower() in DEDUPE_EXTENSIONS
+
+    def _fingerprint(self, path, st, full=False):
+        files = self._load()["files"]
+        key = str(path)
+        entry = files.get(key)
+        if not entry or entry.get("size") != st.st_size or entry.get("mtime") != st.st_mtime_ns:
+            entry = {"size": st.st_size, "mtime": st.st_mtime_ns, "sample": sample_file_hash(path, st.st_size)}
+            files.pop(key, None)
+            files[key] = entry
+            self._dirty = True
+        if full and not entry.get("full"):
+            entry["full"] = full_file_hash(path)
+            self._dirty = True
+        return entry
+
+    def _shared(self, path, st):
+        entry = self._load()["files"].get(str(path))
+        return bool(entry and entry.get("shared")
+                    and entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime_ns)
+
+    def _dedupe(self, path, files):
+        try:
+            st = path.stat()
+        except OSError:
+            return 0, ""
+        # 已经是硬链接（链接数大于 1）或合并过的文件不会再省出空间
+        if not self.eligible(path.name, st.st_size) or st.st_nlink > 1 or self._shared(path, st):
+            return 0, ""
+        own_name = os.path.normcase(path.name)
+        mine = None
+        for name, size, _mtime in files:
+            if size != st.st_size or os.path.normcase(name) == own_name:
+                continue
+            other = path.parent / name
+            try:
+                other_st = other.stat()
+            except OSError:
+                continue
+            if other_st.st_size != st.st_size:
+                continue
+            mine = mine or self._fingerprint(path, st)
+            theirs = self._fingerprint(other, other_st)
+            if mine["sample"] != theirs["sample"]:
+                continue
+            if self._fingerprint(path, st, full=True)["full"] != self._fingerprint(other, other_st, full=True)["full"]:
+                continue
+            method = self._link(path, other)
+            if not method:
+                return 0, ""
+            LIBRARY.add(path)
+            data = self._load()
+            data["files"].pop(str(path), None)
+            try:
+                new_st = path.stat()
+                data["files"][str(path)] = dict(theirs, size=new_st.st_size, mtime=new_st.st_mtime_ns, shared=True)
+            except OSError:
+                pass
+            theirs["shared"] = True
+            data["saved_bytes"] += st.st_size
+            data["linked"] += 1
+            self._dirty = True
+            return st.st_size, str(other)
+        return 0, ""
+
+    def dedupe_file(self, path):
+        """下载完成后的钩子：和同目录下内容相同的文件合并。返回 (节省字节数, 保留的文件路径)，没有重复时为 (0, "")。"""
+        path = Path(os.path.abspath(str(path)))
+        with self._lock:
+            try:
+                return self._dedupe(path, LIBRARY.files(path.parent))
+            finally:
+                self._save()
+
+    def dedupe_folder(self, folder, should_stop=None, on_progress=None):
+        """整理整个目录，只处理大小和别的文件相同的文件；返回统计 {"checked", "linked", "saved_bytes"}。"""
+        folder = Path(os.path.abspath(str(folder)))
+        files = LIBRARY.files(folder)
+        by_size = {}
+        for name, size, _mtime in files:
+            if self.eligible(name, size):
+                by_size.setdefault(size, []).append(name)
+        candidates = [name for names in by_size.values() if len(names) > 1 for name in names]
+        stats = {"checked": 0, "linked": 0, "saved_bytes": 0}
+        for name in candidates:
+            if should_stop and should_stop():
+                break
+            with self._lock:
+                try:
+                    saved, _ = self._dedupe(folder / name, files)
+                finally:
+                    self._save()
+            stats["checked"] += 1
+            if saved:
+                stats["linked"] += 1
+                stats["saved_bytes"] += saved
+            if on_progress:
+                on_progress(stats["checked"], len(candidates))
+        return stats
+
+    def totals(self):
+        """累计合并的文件数和节省的字节数。"""
+        with self._lock:
+            data = self._load()
+            return data["linked"], data["saved_bytes"]
+
+
+DEDUPER = FileDeduper()
+
+
+# ==================== 任务状态 ====================
+
+SCHEDULER_IDLE = -1
+
+
+class TaskStatus(IntEnum):
+    WAITING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    CANCELLED = 4
+    REMOVED = 5
+
+
+TASK_STATUS_LABELS = {
+    TaskStatus.WAITING: "等待",
+    TaskStatus.RUNNING: "下载中",
+    TaskStatus.DONE: "完成",
+    TaskStatus.FAILED: "失败",
+    TaskStatus.CANCELLED: "已取消",
+    TaskStatus.REMOVED: "已删除",
+}
+
+TASK_FINAL_STATUSES = frozenset({
+    TaskStatus.DONE, TaskStatus.FAILED, TaskStatus.CANCELLED, TaskStatus.REMOVED,
+})
+
+# 任务优先级：数值越大越先下载；"置顶"会取当前最高优先级
+TASK_PRIORITY_LEVELS = {"高": 1, "普通": 0, "低": -1}
+
+
+class TaskState:
+    """单个下载任务的状态记录。用 __slots__ 保持紧凑，大队列也不会占用太多内存。"""
+
+    __slots__ = (
+        "index", "url", "title", "status", "note", "percent", "detail",
+        "downloaded", "total", "speed", "output_path", "output_detail",
+        "error", "started_at", "finished_at", "priority", "order", "settings",
+        "restored", "temp_files", "stalls", "attempts", "thumbnail",
+    )
+
+    def __init__(self, index, url):
+        self.index = index
+        self.url = url
+        self.title = ""
+        self.status = TaskStatus.WAITING
+        self.note = ""
+        self.percent = 0.0
+        self.detail = ""
+        self.downloaded = 0
+        self.total = 0
+        self.speed = 0.0
+        self.output_path = ""
+        self.output_detail = ""
+        self.error = ""
+        self.started_at = 0
+        self.finished_at = 0
+        self.priority = 0
+        self.order = index
+        # 加入队列时的下载设置快照；None 表示沿用下载线程的默认设置
+        self.settings = None
+        # 从队列日志恢复的任务：允许接着上次的 .part 文件续传
+        self.restored = False
+        # 下载过程中创建的临时文件：路径 -> 是否可续传（.part 等）
+        self.temp_files = {}
+        # 低速重连次数
+        self.stalls = 0
+        # 已自动重试的次数
+        self.attempts = 0
+        # 封面地址，下载开始后从解析结果中取得
+        self.thumbnail = ""
+
+    @property
+    def finished(self):
+        return self.status in TASK_FINAL_STATUSES
+
+    def status_label(self):
+        label = TASK_STATUS_LABELS.get(self.status, "-")
+        if self.note:
+            return f"{label}（{self.note}）"
+        if self.status == TaskStatus.WAITING and self.priority:
+            return f"{label}（{'优先' if self.priority > 0 else '靠后'}）"
+        return label
+
+
+class TaskStore:
+    """下载队列的任务状态表，由下载调度方写入、界面读取渲染。
+
+    各状态数量和字节数增量维护，状态查询和总进度都是 O(1)，不再逐行扫描
+    表格文字。总进度按已知字节数加权；大小未知的任务按已知任务的平均大小
+    估算权重，全部未知时退化为每个任务等分。所有方法都是线程安全的。
+    传入 journal（QueueJournal）时，每次状态切换和进度都会记入队列日志。
+    """
+
+    def __init__(self, urls=(), journal=None):
+        self._lock = threading.RLock()
+        self.journal = None
+        self.reset(urls)
+        # 构造时不清空日志：启动时先读出上次未完成的任务，再由 restore_queue 重新加入
+        self.journal = journal
+
+    def reset(self, urls):
+        with self._lock:
+            self.tasks = [TaskState(i, url) for i, url in enumerate(urls)]
+            if self.journal is not None:
+                self.journal.reset()
+                self.journal.add(self.tasks)
+            self.counts = {s: 0 for s in TaskStatus}
+            self.counts[TaskStatus.WAITING] = len(self.tasks)
+            # 已知大小任务：字节数累计
+            self.known_count = 0
+            self.known_total = 0
+            self.known_done = 0
+            # 未知大小任务：完成比例累计（0~1）
+            self.unknown_count = len(self.tasks)
+            self.unknown_fraction = 0.0
+
+    def add(self, urls, settings=None):
+        """追加任务（运行期间也可以），返回新任务的序号列表。settings 为这些任务的设置快照。"""
+        with self._lock:
+            start = len(self.tasks)
+            new_tasks = [TaskState(start + i, url) for i, url in enumerate(urls)]
+            for task in new_tasks:
+                task.settings = settings
+            self.tasks.extend(new_tasks)
+            if self.journal is not None:
+                self.journal.add(new_tasks)
+            self.counts[TaskStatus.WAITING] += len(new_tasks)
+            self.unknown_count += len(new_tasks)
+            return [task.index for task in new_tasks]
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def get(self, index):
+        if 0 <= index < len(self.tasks):
+            return self.tasks[index]
+        return None
+
+    def status(self, index):
+        task = self.get(index)
+        return task.status if task else None
+
+    def _fraction(self, task):
+        if task.finished:
+            return 1.0
+        return max(0.0, min(100.0, task.percent)) / 100.0
+
+    def _detach(self, task):
+        """从汇总值中移除该任务的贡献。"""
+        if task.total > 0:
+            self.known_count -= 1
+            self.known_total -= task.total
+            self.known_done -= task.total if task.finished else min(task.downloaded, task.total)
+        else:
+            self.unknown_count -= 1
+            self.unknown_fraction -= self._fraction(task)
+
+    def _attach(self, task):
+        """把该任务的当前值加回汇总值。"""
+        if task.total > 0:
+            self.known_count += 1
+            self.known_total += task.total
+            self.known_done += task.total if task.finished else min(task.downloaded, task.total)
+        else:
+            self.unknown_count += 1
+            self.unknown_fraction += self._fraction(task)
+
+    def set_status(self, index, status, note=""):
+        """切换任务状态，返回是否发生了变化。"""
+        with self._lock:
+            task = self.get(index)
+            if task is None or task.status == status:
+                return False
+            self._detach(task)
+            self.counts[task.status] -= 1
+            self.counts[status] += 1
+            task.status = status
+            task.note = note
+            if status == TaskStatus.RUNNING:
+                task.percent = 0.0
+                task.downloaded = 0
+                task.speed = 0.0
+                task.stalls = 0
+                task.error = ""
+                task.started_at = int(time.time())
+            elif status in TASK_FINAL_STATUSES:
+                task.speed = 0.0
+                task.finished_at = int(time.time())
+                if status == TaskStatus.DONE:
+                    task.percent = 100.0
+                    task.temp_files.clear()
+            self._attach(task)
+            if self.journal is not None:
+                self.journal.stage(index, JOURNAL_STAGES[status])
+            return True
+
+    def mark_stage(self, index, stage):
+        """记录不对应状态切换的阶段（如 "postprocessing"），只写入队列日志。"""
+        if self.journal is not None and self.status(index) == TaskStatus.RUNNING:
+            self.journal.stage(index, stage)
+
+    def register_temp_file(self, index, path, resumable=True):
+        """登记任务创建的临时文件，并记入队列日志，崩溃恢复后也能准确清理。"""
+        with self._lock:
+            task = self.get(index)
+            if task is None or not path:
+                return
+            path = str(path)
+            if task.temp_files.get(path) == resumable:
+                return
+            task.temp_files[path] = resumable
+            if self.journal is not None:
+                self.journal.temp_file(index, path, resumable)
+
+    def record_stall(self, index):
+        """记一次低速重连，返回该任务累计的次数。"""
+        with self._lock:
+            task = self.get(index)
+            if task is None:
+                return 0
+            task.stalls += 1
+            return task.stalls
+
+    def pop_temp_files(self, index):
+        """取出并清空任务登记的临时文件，返回 {路径: 是否可续传}。"""
+        with self._lock:
+            task = self.get(index)
+            if task is None:
+                return {}
+            files, task.temp_files = task.temp_files, {}
+            return files
+
+    def start(self, index, title=""):
+        """把等待中的任务切换为下载中；任务不在等待状态（如已删除）时返回 False。"""
+        with self._lock:
+            if self.status(index) != TaskStatus.WAITING:
+                return False
+            self.set_status(index, TaskStatus.RUNNING)
+            if title:
+                self.tasks[index].title = title
+            return True
+
+    def finish(self, index, output_detail, output_path="", note=""):
+        with self._lock:
+            task = self.get(index)
+            if task is None:
+                return False
+            task.output_detail = output_detail
+            if output_path:
+                task.output_path = output_path
+            return self.set_status(index, TaskStatus.DONE, note)
+
+    def fail(self, index, error, status=TaskStatus.FAILED):
+        with self._lock:
+            task = self.get(index)
+            if task is None or task.finished:
+                return False
+            task.error = error
+            return self.set_status(index, status)
+
+    def requeue(self, index):
+        """把已结束的任务恢复为等待状态并清空进度，用于重试。返回是否成功。"""
+        with self._lock:
+            task = self.get(index)
+            if task is None or not task.finished:
+                return False
+            self._detach(task)
+            self.counts[task.status] -= 1
+            self.counts[TaskStatus.WAITING] += 1
+            task.status = TaskStatus.WAITING
+            task.note = ""
+            task.percent = 0.0
+            task.detail = ""
+            task.downloaded = 0
+            task.total = 0
+            task.speed = 0.0
+            task.output_path = ""
+            task.output_detail = ""
+            task.error = ""
+            task.finished_at = 0
+            task.attempts = 0
+            self._attach(task)
+            if self.journal is not None:
+                self.journal.add([task])
+            return True
+
+    def retry_later(self, index, error, note):
+        """把下载中失败的任务放回等待状态，稍后自动重试。返回是否成功。"""
+        with self._lock:
+            task = self.get(index)
+            if task is None or task.status != TaskStatus.RUNNING:
+                return False
+            task.attempts += 1
+            task.error = error
+            return self.set_status(index, TaskStatus.WAITING, note)
+
+    def remove_waiting(self, index):
+        """仅当任务还在等待时标记为已删除，返回是否成功。"""
+        with self._lock:
+            if self.status(index) != TaskStatus.WAITING:
+                return False
+            return self.set_status(index, TaskStatus.REMOVED)
+
+    def update_progress(self, index, percent, detail="", downloaded=0, total=0, speed=0):
+        """记录单个任务的进度。percent < 0 表示只更新说明文字；字节数为 0 表示未知。"""
+        with self._lock:
+            task = self.get(index)
+            if task is None or task.finished:
+                return
+            if detail:
+                task.detail = detail
+            if percent < 0:
+                return
+            self._detach(task)
+            task.percent = float(percent)
+            if total > 0:
+                task.total = int(total)
+            if downloaded > 0:
+                task.downloaded = int(downloaded)
+            task.speed = float(speed or 0)
+            self._attach(task)
+            if self.journal is not None and (task.downloaded or task.total):
+                self.journal.progress(index, task.downloaded, task.total)
+
+    def set_output_path(self, index, path):
+        task = self.get(index)
+        if task is not None and path:
+            task.output_path = path
+
+    def set_thumbnail(self, index, url):
+        task = self.get(index)
+        if task is not None and url:
+            task.thumbnail = url
+
+    def count(self, status):
+        return self.counts.get(status, 0)
+
+    def finished_count(self):
+        """已结束（完成/失败/取消/删除）的任务数。"""
+        return sum(self.counts[s] for s in TASK_FINAL_STATUSES)
+
+    def overall_percent(self):
+        with self._lock:
+            if not self.tasks:
+                return 0.0
+            avg = self.known_total / self.known_count if self.known_count else 1.0
+            denominator = self.known_total + avg * self.unknown_count
+            if denominator <= 0:
+                return 0.0
+            numerator = self.known_done + avg * self.unknown_fraction
+            return max(0.0, min(100.0, numerator / denominator * 100))
+
+
+class TaskScheduler:
+    """常驻的下载调度队列，运行期间可以随时加入任务、调整优先级和顺序。
+
+    等待中的任务按（优先级从高到低，排队顺序）出队。堆中条目带版本号，调整
+    优先级或顺序时直接压入新条目，旧条目出队时按版本号丢弃，不必重建堆。
+    自动重试的任务先放进按到期时间排序的延迟堆，到期后才进入队列，等待期间
+    不占用下载名额。
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._cond = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        """清空队列并重新开放，只在没有任务运行时调用。"""
+        with self._cond:
+            self._heap = []
+            self._versions = {}
+            self._delayed = []
+            self._delayed_due = {}
+            self.retry_budget = RETRY_BATCH_BUDGET
+            self._next_order = 0
+            self._front_order = 0
+            self.running = 0
+            self.postprocessing = 0
+            self._closed = False
+            self._idle_reported = True
+            self._batch_ok = True
+            self.last_batch_ok = True
+            self._cond.notify_all()
+
+    @property
+    def busy(self):
+        """是否还有任务在等待或运行（队列清空并通知过空闲后为 False）。"""
+        with self._cond:
+            return not self._idle_reported
+
+    def _waiting_task(self, index):
+        task = self.store.get(index)
+        if task is None or task.status != TaskStatus.WAITING:
+            return None
+        return task
+
+    def _push(self, task):
+        self._delayed_due.pop(task.index, None)
+        version = self._versions.get(task.index, 0) + 1
+        self._versions[task.index] = version
+        heapq.heappush(self._heap, (-task.priority, task.order, version, task.index))
+        self._idle_reported = False
+        self._cond.notify_all()
+
+    def submit(self, index, priority=None):
+        """把等待中的任务排到同优先级的队尾，返回是否成功。"""
+        with self._cond:
+            task = self._waiting_task(index)
+            if task is None or self._closed:
+                return False
+            if priority is not None:
+                task.priority = priority
+            task.order = self._next_order
+            self._next_order += 1
+            self._push(task)
+            return True
+
+    def submit_later(self, index, delay):
+        """delay 秒后再把等待中的任务排入队尾（自动重试），返回是否成功。"""
+        with self._cond:
+            task = self._waiting_task(index)
+            if task is None or self._closed:
+                return False
+            due = time.monotonic() + delay
+            self._delayed_due[index] = due
+            heapq.heappush(self._delayed, (due, index))
+            self._idle_reported = False
+            self._cond.notify_all()
+            return True
+
+    def take_retry(self):
+        """从本批的重试预算中扣一次，预算用完返回 False。"""
+        with self._cond:
+            if self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+            return True
+
+    def _promote_due(self):
+        """把到期的延迟任务排入队列，返回下一个到期时间（没有则为 None）。"""
+        now = time.monotonic()
+        while self._delayed:
+            due, index = self._delayed[0]
+            if self._delayed_due.get(index) != due or self._waiting_task(index) is None:
+                heapq.heappop(self._delayed)
+                if self._delayed_due.get(index) == due:
+                    del self._delayed_due[index]
+                continue
+            if due > now:
+                return due
+            heapq.heappop(self._delayed)
+            task = self._waiting_task(index)
+            task.order = self._next_order
+            self._next_order += 1
+            self._push(task)
+        return None
+
+    def set_priority(self, index, priority):
+        with self._cond:
+            task = self._waiting_task(index)
+            if task is None or task.priority == priority:
+                return False
+            task.priority = priority
+            if index not in self._delayed_due:
+                self._push(task)
+            return True
+
+    def _queued_tasks(self):
+        tasks = (self._waiting_task(i) for i in self._versions)
+        return [t for t in tasks if t is not None]
+
+    def move_to_top(self, index):
+        """移到队首：提升到当前最高优先级，并排在同优先级所有任务之前。"""
+        with self._cond:
+            task = self._waiting_task(index)
+            if task is None:
+                return False
+            task.priority = max([t.priority for t in self._queued_tasks()] + [task.priority])
+            self._front_order -= 1
+            task.order = self._front_order
+            self._push(task)
+            return True
+
+    def move_to_bottom(self, index):
+        """移到队尾：降到当前最低优先级，并排在同优先级所有任务之后。"""
+        with self._cond:
+            task = self._waiting_task(index)
+            if task is None:
+                return False
+            task.priority = min([t.priority for t in self._queued_tasks()] + [task.priority])
+            task.order = self._next_order
+            self._next_order += 1
+            self._push(task)
+            return True
+
+    def peek(self, n):
+        """按出队顺序返回排在最前面的 n 个等待任务（不出队），用于提前解析。"""
+        with self._cond:
+            result = []
+            seen = set()
+            for _, _, version, index in sorted(self._heap):
+                if len(result) >= n:
+                    break
+                if (index not in seen and self._versions.get(index) == version
+                        and self._waiting_task(index) is not None):
+                    seen.add(index)
+                    result.append(index)
+            return result
+
+    def _pop(self):
+        while self._heap:
+            _, _, version, index = heapq.heappop(self._heap)
+            if self._versions.get(index) == version and self._waiting_task(index) is not None:
+                return index
+        return None
+
+    def acquire(self, limit):
+        """阻塞取出下一个要运行的任务，同时运行的任务数不超过 limit。
+
+        队列刚变为空闲（没有等待也没有运行的任务）时返回一次 SCHEDULER_IDLE，
+        同时把这一批是否全部成功写入 last_batch_ok；调用 close() 后返回 None。
+        取到的任务结束后必须调用 release()。
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                next_due = self._promote_due()
+                if self.running < limit:
+                    index = self._pop()
+                    if index is not None:
+                        self.running += 1
+                        return index
+                if (self.running == 0 and self.postprocessing == 0 and next_due is None
+                        and not self._idle_reported):
+                    self._idle_reported = True
+                    self.last_batch_ok = self._batch_ok
+                    self._batch_ok = True
+                    self.retry_budget = RETRY_BATCH_BUDGET
+                    return SCHEDULER_IDLE
+                self._cond.wait(None if next_due is None else max(0.0, next_due - time.monotonic()))
+
+    def release(self, ok=True, handoff=False):
+        """归还名额；ok=False 表示该任务失败或被取消，会记入本批结果。
+
+        handoff=True 表示下载已完成、任务转入后处理：名额立即让给下一个任务，
+        但这一批要等 finish_post() 之后才算结束。
+        """
+        with self._cond:
+            self.running -= 1
+            if handoff:
+                self.postprocessing += 1
+            if not ok:
+                self._batch_ok = False
+            self._cond.notify_all()
+
+    def finish_post(self, ok=True):
+        with self._cond:
+            self.postprocessing -= 1
+            if not ok:
+                self._batch_ok = False
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class ProgressAggregator:
+    """在下载线程一侧合并进度通知，按固定频率批量推送给界面。
+
+    进度数值直接写入 TaskStore，这里只记录哪些任务有变化；一个周期内同一
+    任务无论变化多少次都只推送一次。开始/完成/失败等状态切换不经过这里，
+    由调用方立即发送，并先调用 discard() 丢弃该任务尚未推送的通知。
+    """
+
+    def __init__(self, flush_callback, interval=PROGRESS_FLUSH_INTERVAL):
+        self.flush_callback = flush_callback
+        self.interval = interval
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="ProgressAggregator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        self.flush()
+
+    def _loop(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as exc:
+                write_crash_log(type(exc), exc, exc.__traceback__, source="ProgressAggregator")
+
+    def mark(self, index):
+        with self._lock:
+            self._pending.add(index)
+
+    def discard(self, index):
+        with self._lock:
+            self._pending.discard(index)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            batch = sorted(self._pending)
+            self._pending.clear()
+        self.flush_callback(batch)
+
+
+class PauseGate:
+    """暂停/继续/取消的共享闸门。
+
+    等待中的线程阻塞在条件变量上，继续或取消时统一唤醒，不再轮询。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._paused = False
+        self._cancelled = False
+
+    @property
+    def paused(self):
+        return self._paused
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def pause(self):
+        """进入暂停状态。已暂停或已取消时返回 False。"""
+        with self._cond:
+            if self._paused or self._cancelled:
+                return False
+            self._paused = True
+            return True
+
+    def resume(self):
+        """解除暂停并唤醒所有等待线程。未暂停时返回 False。"""
+        with self._cond:
+            if not self._paused:
+                return False
+            self._paused = False
+            self._cond.notify_all()
+            return True
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._paused = False
+            self._cond.notify_all()
+
+    def interrupt(self):
+        """不改变状态，只唤醒等待线程重新检查 abort 条件（如单个任务被取消）。"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, timeout=None, abort=None):
+        """暂停期间阻塞，返回 True 表示可以继续，False 表示已取消、被 abort 中止或超时仍在暂停。"""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: not self._paused or self._cancelled or (abort is not None and abort()),
+                timeout,
+            )
+            return not self._paused and not self._cancelled
+
+
+class StallWatchdog:
+    """按滑动窗口统计单个下载流的吞吐量，判断连接是否“活着但几乎不动”。
+
+    requests 的 timeout 只能发现完全没有数据的连接；被限速到几 KB/s 的连接
+    需要看一段时间内的平均速度。floor 为字节/秒，<= 0 表示关闭。
+    """
+
+    def __init__(self, floor, window=None):
+        self.floor = floor
+        self.window = STALL_WINDOW_SECONDS if window is None else window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """重新连接或暂停恢复后调用：清空样本，从收到第一块数据起重新计时。"""
+        with self._lock:
+            self._started = None
+            self._total = 0
+            self._samples = deque()
+
+    def feed(self, nbytes, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._started is None:
+                self._started = now
+                self._samples.append((now, 0))
+            self._total += nbytes
+            self._samples.append((now, self._total))
+
+    def stalled(self, now=None):
+        if self.floor <= 0:
+            return False
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            start = now - self.window
+            if self._started is None or self._started > start:
+                return False
+            # 保留窗口起点之前的最后一个样本作为基准
+            while len(self._samples) > 1 and self._samples[1][0] <= start:
+                self._samples.popleft()
+            return (self._total - self._samples[0][1]) / self.window < self.floor
+
+
+class CircuitBreaker:
+    """按 API 主机统计风控响应的熔断器，所有下载线程共用一个。
+
+    连续 threshold 次风控（412/-352/-509）后打开：冷却 cooldown 秒内新的接口
+    请求全部等待；冷却结束进入半开状态，只放行一个试探请求，成功则关闭，
+    再次风控则重新打开。状态变化时调用 on_change(host, state, 剩余秒数)。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold=None, cooldown=None, on_change=None):
+        self.threshold = BREAKER_THRESHOLD if threshold is None else threshold
+        self.cooldown = BREAKER_COOLDOWN if cooldown is None else cooldown
+        self.on_change = on_change
+        self._cond = threading.Condition()
+        self._hosts = {}
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = {"state": self.CLOSED, "failures": 0, "until": 0.0, "probe": None}
+        return state
+
+    def state(self, host):
+        with self._cond:
+            return self._host(host)["state"]
+
+    def _notify(self, host, h):
+        self._cond.notify_all()
+        if self.on_change is not None:
+            return (host, h["state"], max(0.0, h["until"] - time.monotonic()))
+        return None
+
+    def acquire(self, host, abort=None):
+        """请求前调用：熔断打开期间阻塞，半开时只放行一个线程试探。abort() 为真时返回 False。"""
+        while True:
+            change = None
+            with self._cond:
+                if abort is not None and abort():
+                    return False
+                h = self._host(host)
+                now = time.monotonic()
+                if h["state"] == self.OPEN and now >= h["until"]:
+                    h["state"] = self.HALF_OPEN
+                    h["probe"] = None
+                    change = self._notify(host, h)
+                if h["state"] == self.CLOSED:
+                    return True
+                if h["state"] == self.HALF_OPEN and h["probe"] is None:
+                    h["probe"] = threading.get_ident()
+                    acquired = True
+                else:
+                    acquired = False
+                    timeout = h["until"] - now if h["state"] == self.OPEN else 0.5
+                    if change is None:
+                        self._cond.wait(min(0.5, max(0.01, timeout)))
+            if change is not None:
+                self.on_change(*change)
+            if acquired:
+                return True
+
+    def record(self, host, exc=None):
+        """记录一次请求结果：exc 为 None 表示成功，风控错误计入失败，其他错误不计。"""
+        risk = exc is not None and classify_retry(exc) == "risk"
+        change = None
+        with self._cond:
+            h = self._host(host)
+            is_probe = h["probe"] == threading.get_ident()
+            if is_probe:
+                h["probe"] = None
+            if risk:
+                h["failures"] += 1
+                if is_probe or (h["state"] == self.CLOSED and h["failures"] >= self.threshold):
+                    h["state"] = self.OPEN
+                    h["until"] = time.monotonic() + self.cooldown
+                    h["failures"] = 0
+                    change = self._notify(host, h)
+            elif exc is None:
+                h["failures"] = 0
+                if h["state"] == self.HALF_OPEN:
+                    h["state"] = self.CLOSED
+                    change = self._notify(host, h)
+            if is_probe and change is None:
+                self._cond.notify_all()
+        if change is not None:
+            self.on_change(*change)
+
+
+class HostLimiter:
+    """按主机限制并发请求数，接口主机和 CDN 主机分别使用各自的上限。
+
+    每个主机一个信号量，首次用到时按主机类别创建。只在没有请求进行时调用
+    configure() 修改上限。
+    """
+
+    def __init__(self, api_limit, cdn_limit):
+        self._lock = threading.Lock()
+        self.configure(api_limit, cdn_limit)
+
+    def configure(self, api_limit, cdn_limit):
+        with self._lock:
+            self.limits = {"api": max(1, int(api_limit)), "cdn": max(1, int(cdn_limit))}
+            self._semaphores = {}
+
+    @staticmethod
+    def kind(host):
+        return "api" if (host or "").startswith("api.") else "cdn"
+
+    def _semaphore(self, host):
+        with self._lock:
+            sem = self._semaphores.get(host)
+            if sem is None:
+                sem = self._semaphores[host] = threading.Semaphore(self.limits[self.kind(host)])
+            return sem
+
+    def acquire(self, host, abort=None):
+        """取得该主机的一个名额；等待期间 abort() 为真时返回 False。"""
+        sem = self._semaphore(host)
+        while not sem.acquire(timeout=0.5):
+            if abort is not None and abort():
+                return False
+        return sem
+
+    @staticmethod
+    def release(sem):
+        sem.release()
+
+
+class StageMetrics:
+    """流水线单个阶段的统计：排队、进行中、完成/失败数和累计耗时。线程安全。"""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.done = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    def enqueue(self):
+        with self._lock:
+            self.queued += 1
+
+    @contextlib.contextmanager
+    def run(self):
+        with self._lock:
+            self.queued = max(0, self.queued - 1)
+            self.active += 1
+        started = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.busy_seconds += time.monotonic() - started
+                if ok:
+                    self.done += 1
+                else:
+                    self.failed += 1
+
+    def average_seconds(self):
+        with self._lock:
+            count = self.done + self.failed
+            return self.busy_seconds / count if count else 0.0
+
+    def summary(self):
+        with self._lock:
+            text = f"{self.name} {self.active}/{self.limit}"
+            if self.queued:
+                text += f" 排队 {self.queued}"
+            return text
+
+
+# 任务状态 → 队列日志中的阶段名；"downloading"/"postprocessing" 由下载线程单独记录
+JOURNAL_STAGES = {
+    TaskStatus.WAITING: "queued",
+    TaskStatus.RUNNING: "resolving",
+    TaskStatus.DONE: "done",
+    TaskStatus.FAILED: "failed",
+    TaskStatus.CANCELLED: "cancelled",
+    TaskStatus.REMOVED: "removed",
+}
+JOURNAL_FINAL_STAGES = frozenset({"done", "failed", "cancelled", "removed"})
+
+
+def fold_queue_journal(records, tasks=None, settings=None):
+    """按顺序合并队列日志记录，返回 (未完成任务 {序号: 信息}, 设置快照 {key: 设置})。
+
+    传入 tasks/settings 时在其基础上增量合并。
+    """
+    tasks = {} if tasks is None else tasks
+    settings = {} if settings is None else settings
+    for rec in records:
+        op = rec.get("op")
+        index = rec.get("i")
+        if op == "settings":
+            settings[rec.get("key")] = rec.get("value") or {}
+        elif op == "add":
+            tasks[index] = {
+                "url": rec.get("url") or "",
+                "settings": rec.get("s"),
+                "priority": rec.get("p") or 0,
+                "stage": "queued",
+                "downloaded": 0,
+                "total": 0,
+                "temp_files": {},
+            }
+        elif index in tasks:
+            task = tasks[index]
+            if op == "stage":
+                if rec.get("stage") in JOURNAL_FINAL_STAGES:
+                    del tasks[index]
+                else:
+                    task["stage"] = rec.get("stage")
+            elif op == "progress":
+                task["downloaded"] = rec.get("done") or 0
+                task["total"] = rec.get("total") or 0
+                if task["stage"] in ("queued", "resolving"):
+                    task["stage"] = "downloading"
+            elif op == "temp":
+                task["temp_files"][rec.get("path")] = bool(rec.get("r"))
+    return tasks, settings
+
+
+def load_queue_journal(path=None):
+    """读取队列日志，返回未完成任务列表（按序号排序，设置已展开）。
+
+    崩溃时最后一行可能只写了一半，解析失败的行直接跳过。
+    """
+    path = Path(path or QUEUE_JOURNAL_PATH)
+    records = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        return []
+    tasks, settings = fold_queue_journal(records)
+    entries = []
+    for index in sorted(tasks):
+        entry = dict(tasks[index])
+        entry["settings"] = settings.get(entry["settings"])
+        entries.append(entry)
+    return entries
+
+
+class QueueJournal:
+    """下载队列的追加式日志（JSON Lines），崩溃或断电后据此恢复未完成任务。
+
+    调用方只往内存里记一笔，由后台线程每 QUEUE_JOURNAL_FLUSH_INTERVAL 秒批量
+    追加一次：同一任务在一个周期内的进度只保留最新一条，含状态切换的批次写完
+    后 fsync。记录数超过 QUEUE_JOURNAL_COMPACT_RECORDS 时按当前状态重写为快照。
+    """
+
+    def __init__(self, path=None, interval=QUEUE_JOURNAL_FLUSH_INTERVAL):
+        self.path = Path(path or QUEUE_JOURNAL_PATH)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._records = []
+        self._progress = {}
+        self._settings_keys = {}
+        self._written_settings = set()
+        self._state = {}
+        self._settings = {}
+        self._count = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="QueueJournal", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        self.flush()
+
+    def _loop(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as exc:
+                write_crash_log(type(exc), exc, exc.__traceback__, source="QueueJournal")
+
+    def _settings_key(self, settings):
+        """同一份设置快照只写一次，任务记录里只引用它的 key。"""
+        if not settings:
+            return None
+        cached = self._settings_keys.get(id(settings))
+        if cached and cached[0] is settings:
+            return cached[1]
+        value = json.dumps(settings, ensure_ascii=False, sort_keys=True)
+        key = hashlib.sha1(value.encode("utf-8")).hexdigest()[:12]
+        self._settings_keys[id(settings)] = (settings, key)
+        if key not in self._written_settings:
+            self._written_settings.add(key)
+            self._records.append({"op": "settings", "key": key, "value": settings})
+        return key
+
+    def reset(self):
+        """开始新的一批：清空日志文件和内存状态。"""
+        with self._lock:
+            self._records = []
+            self._progress = {}
+            self._settings_keys = {}
+            self._written_settings = set()
+        with self._io_lock:
+            self._state = {}
+            self._settings = {}
+            self._count = 0
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, "w", encoding="utf-8"):
+                    pass
+            except OSError:
+                pass
+
+    def add(self, tasks):
+        with self._lock:
+            for task in tasks:
+                self._progress.pop(task.index, None)
+                self._records.append({
+                    "op": "add", "i": task.index, "url": task.url,
+                    "s": self._settings_key(task.settings), "p": task.priority,
+                })
+                for path, resumable in task.temp_files.items():
+                    self._records.append({"op": "temp", "i": task.index, "path": path,
+                                          "r": int(resumable)})
+
+    def stage(self, index, stage):
+        with self._lock:
+            if stage in JOURNAL_FINAL_STAGES:
+                self._progress.pop(index, None)
+            self._records.append({"op": "stage", "i": index, "stage": stage})
+
+    def temp_file(self, index, path, resumable):
+        with self._lock:
+            self._records.append({"op": "temp", "i": index, "path": path, "r": int(resumable)})
+
+    def progress(self, index, downloaded, total):
+        with self._lock:
+            self._progress[index] = {"op": "progress", "i": index, "done": downloaded, "total": total}
+
+    def flush(self):
+        with self._lock:
+            records = self._records
+            progress = list(self._progress.values())
+            self._records = []
+            self._progress = {}
+        if not records and not progress:
+            return
+        lines = records + progress
+        with self._io_lock:
+            fold_queue_journal(lines, self._state, self._settings)
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n"
+                                    for r in lines))
+                    f.flush()
+                    if records:
+                        os.fsync(f.fileno())
+            except OSError:
+                return
+            self._count += len(lines)
+            if self._count > QUEUE_JOURNAL_COMPACT_RECORDS:
+                self._compact()
+
+    def _snapshot_records(self):
+        records = []
+        for index, task in sorted(self._state.items()):
+            records.append({"op": "add", "i": index, "url": task["url"],
+                            "s": task["settings"], "p": task["priority"]})
+            if task["stage"] != "queued":
+                records.append({"op": "stage", "i": index, "stage": task["stage"]})
+            if task["downloaded"] or task["total"]:
+                records.append({"op": "progress", "i": index,
+                                "done": task["downloaded"], "total": task["total"]})
+            for path, resumable in task["temp_files"].items():
+                records.append({"op": "temp", "i": index, "path": path, "r": int(resumable)})
+        return records
+
+    def _compact(self):
+        used = {task["settings"] for task in self._state.values()}
+        records = [{"op": "settings", "key": k, "value": v}
+                   for k, v in self._settings.items() if k in used]
+        records.extend(self._snapshot_records())
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write("".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n"
+                                for r in records))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._count = len(records)
+        except OSError:
+            pass
+
+
+class DownloadPaused(yt_dlp.utils.DownloadCancelled):
+    """在 yt-dlp 进度回调中抛出，用于暂停时中断当前连接。"""
+
+    msg = "下载已暂停"
+
+
+class DownloadStalled(yt_dlp.utils.DownloadCancelled):
+    """在 yt-dlp 进度回调中抛出，速度持续低于下限时断开连接重新下载。"""
+
+    msg = "下载速度过低"
+
+
+class PreviewCancelled(yt_dlp.utils.DownloadCancelled):
+    """预览被新的请求取代后，在下一次 HTTP 请求前抛出，中断 yt-dlp 解析。"""
+
+    msg = "预览已取消"
+
+
 # ==================== Bilibili API ====================
 
+class BiliApiError(RuntimeError):
+    """B站接口返回了非 0 的 code。消息里带上错误码，便于分类提示和自动重试。"""
+
+    def __init__(self, code, message):
+        self.code = code
+        super().__init__(f"{message}（错误码 {code}）")
+
+
 def _build_bili_session(settings):
     """构建带 Cookie 和代理的 B站请求 session。"""
     session = requests.Session()
@@ -690,7 +2999,7 @@ def bili_view(video_id, settings):
     resp.raise_for_status()
     payload = resp.json()
     if payload.get("code") != 0:
-        raise RuntimeError(payload.get("message") or "B站视频信息接口返回失败。")
+        raise BiliApiError(payload.get("code"), payload.get("message") or "B站视频信息接口返回失败。")
     return payload["data"]
 
 
@@ -719,7 +3028,7 @@ def bili_playurl(video_id, cid, qn, settings, page=None, fnval=None):
     resp.raise_for_status()
     payload = resp.json()
     if payload.get("code") != 0:
-        raise RuntimeError(payload.get("message") or "B站下载地址接口返回失败。")
+        raise BiliApiError(payload.get("code"), payload.get("message") or "B站下载地址接口返回失败。")
     return payload["data"]
 
 
@@ -734,6 +3043,10 @@ def save_cookies_to_netscape_file(cookies, path):
 
 def classify_bili_error(exc):
     """对 B站错误进行分类，返回 (类别, 说明) 或 None。"""
+    if isinstance(exc, BiliApiError):
+        for code, category, hint in BILI_ERROR_CATEGORIES:
+            if code == exc.code:
+                return (category, hint)
     msg = str(exc)
     if "HTTP Error 412" in msg or "Precondition Failed" in msg:
         return ("风控拦截", "B站 412 风控，请配置 Cookie 或稍后再试。")
@@ -747,6 +3060,32 @@ def classify_bili_error(exc):
     return None
 
 
+def classify_retry(exc):
+    """判断失败是否值得自动重试：返回 "risk"（风控/限频）、"network"（网络错误）或 None。"""
+    if isinstance(exc, BiliApiError):
+        return RETRYABLE_BILI_CODES.get(exc.code)
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return "network"
+    msg = str(exc)
+    if "HTTP Error 412" in msg or "Precondition Failed" in msg:
+        return "risk"
+    if "HTTP Error 403" in msg or "HTTP Error 404" in msg:
+        return None
+    if any(str(code) in msg for code in FATAL_BILI_CODES):
+        return None
+    if any(str(code) in msg for code in RETRYABLE_BILI_CODES):
+        return "risk"
+    if any(marker in msg for marker in NETWORK_ERROR_MARKERS):
+        return "network"
+    return None
+
+
+def retry_delay(kind, attempt):
+    """第 attempt 次重试前的等待秒数：指数退避，取 [一半, 全部] 之间的随机值避免同时重试。"""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAYS[kind] * 2 ** max(0, attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
 def download_bili_danmaku(cid, output_path, settings):
     """下载 B站弹幕 XML。成功返回 True，失败返回 False。"""
     try:
@@ -818,25 +3157,48 @@ class PreviewWorker(QThread):
         self.request_id = request_id
         self.url = normalize_input(url)
         self.settings = settings
+        self._aborted = threading.Event()
+
+    def abort(self):
+        """放弃这次预览：正在进行的请求结束后不再发出新请求，也不再发出结果信号。"""
+        self._aborted.set()
+
+    @property
+    def aborted(self):
+        return self._aborted.is_set()
+
+    def matches(self, url, settings):
+        """是否是同一链接、同一设置的预览（用于合并重复请求）。"""
+        return not self.aborted and input_key(self.url) == input_key(url) and self.settings == settings
+
+    def check_aborted(self):
+        if self.aborted:
+            raise PreviewCancelled()
 
     def run(self):
         if not self.url:
             self.failed.emit(self.request_id, "没有可解析的链接。")
             return
+        if is_short_link(self.url):
+            self.url = SHORT_LINKS.expand([self.url], (self.settings.get("proxy") or "").strip())[0]
         try:
             info = self.fetch_with_ytdlp()
             self.info_ready.emit(self.request_id, info)
         except Exception as exc:
+            if self.aborted:
+                return
             try:
                 if is_bilibili_url(self.url) and (
                     "HTTP Error 412" in str(exc) or "Precondition Failed" in str(exc)
                 ):
                     try:
                         info = self.fetch_bili_legacy_preview(str(exc))
+                        self.check_aborted()
                         self.info_ready.emit(self.request_id, info)
                         return
                     except Exception as fallback_exc:
-                        self.failed.emit(self.request_id, format_bili_error(fallback_exc))
+                        if not self.aborted:
+                            self.failed.emit(self.request_id, format_bili_error(fallback_exc))
                         return
                 self.failed.emit(self.request_id, format_bili_error(exc))
             except Exception as top_exc:
@@ -859,7 +3221,16 @@ class PreviewWorker(QThread):
 
     def fetch_with_ytdlp(self):
         with yt_dlp.YoutubeDL(self.ytdlp_options()) as ydl:
+            urlopen = ydl.urlopen
+
+            def checked_urlopen(req):
+                # 提取器的每个 HTTP 请求都经过这里，被取代后在下一个请求前停下
+                self.check_aborted()
+                return urlopen(req)
+
+            ydl.urlopen = checked_urlopen
             info = ydl.extract_info(self.url, download=False)
+        self.check_aborted()
         return self.normalize_ytdlp_info(info)
 
     def normalize_ytdlp_info(self, info):
@@ -906,6 +3277,7 @@ class PreviewWorker(QThread):
         id_type, id_value = extract_video_id(self.url)
         if not id_value:
             raise RuntimeError("无法从链接中识别 BV 号或 av 号。")
+        self.check_aborted()
         data = bili_view(self.url, self.settings)
         pages = []
         for p in data.get("pages", []):
@@ -933,191 +3305,636 @@ class PreviewWorker(QThread):
         }
 
 
+# ==================== 封面加载 ====================
+
+class CoverCache:
+    """封面图片的磁盘 LRU 缓存，文件名为 URL 的 SHA-1。线程安全。
+
+    首次使用时扫描一次目录建立索引（按修改时间排序），之后命中时刷新修改时间并移到队尾，
+    写入后总大小超过上限则从队首删除。folder 为空时使用 COVER_CACHE_DIR。
+    """
+
+    def __init__(self, folder=None, max_bytes=COVER_CACHE_MAX_BYTES):
+        self._folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None
+        self._total = 0
+
+    @property
+    def folder(self):
+        return Path(self._folder or COVER_CACHE_DIR)
+
+    def _load_index(self):
+        if self._index is None:
+            entries = []
+            try:
+                with os.scandir(self.folder) as it:
+                    for entry in it:
+                        if entry.is_file() and entry.name.endswith(".img"):
+                            st = entry.stat()
+                            entries.append((st.st_mtime, entry.name, st.st_size))
+            except OSError:
+                pass
+            entries.sort()
+            self._index = {name: size for _, name, size in entries}
+            self._total = sum(self._index.values())
+        return self._index
+
+    @staticmethod
+    def key_for(url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest() + ".img"
+
+    def get(self, url):
+        """返回缓存的图片字节，没有时返回 None。"""
+        name = self.key_for(url)
+        path = self.folder / name
+        with self._lock:
+            index = self._load_index()
+            if name not in index:
+                return None
+            try:
+                data = path.read_bytes()
+                os.utime(path)
+            except OSError:
+                self._total -= index.pop(name)
+                return None
+            index[name] = index.pop(name)
+        return data
+
+    def put(self, url, data):
+        name = self.key_for(url)
+        with self._lock:
+            index = self._load_index()
+            try:
+                self.folder.mkdir(parents=True, exist_ok=True)
+                tmp = self.folder / (name + ".tmp")
+                tmp.write_bytes(data)
+                os.replace(tmp, self.folder / name)
+            except OSError:
+                return
+            self._total += len(data) - index.pop(name, 0)
+            index[name] = len(data)
+            while self._total > self.max_bytes and len(index) > 1:
+                oldest = next(iter(index))
+                self._total -= index.pop(oldest)
+                try:
+                    (self.folder / oldest).unlink()
+                except OSError:
+                    pass
+
+    def total_bytes(self):
+        with self._lock:
+            self._load_index()
+            return self._total
+
+
+COVER_CACHE = CoverCache()
+
+
+def fetch_cover_bytes(url, proxy="", cache=None):
+    """先查磁盘缓存，未命中时下载并写入缓存。失败时抛出异常。"""
+    cache = cache or COVER_CACHE
+    data = cache.get(url)
+    if data is not None:
+        return data
+    proxies = {"http": proxy, "https": proxy} if proxy else None
+    resp = requests.get(url, headers=std_headers(), timeout=10, proxies=proxies)
+    resp.raise_for_status()
+    data = resp.content
+    cache.put(url, data)
+    return data
+
+
+def decode_cover(data, width, height):
+    """按显示尺寸解码图片（保持比例，不超过 width x height），失败时返回空 QImage。
+
+    JPEG 等格式可以在解码时直接缩小，比解码原图再缩放省内存。可在非界面线程调用。
+    """
+    buf = QBuffer()
+    buf.setData(QByteArray(data))
+    buf.open(QBuffer.ReadOnly)
+    reader = QImageReader(buf)
+    size = reader.size()
+    if size.isValid() and (size.width() > width or size.height() > height):
+        reader.setScaledSize(size.scaled(width, height, Qt.KeepAspectRatio))
+    image = reader.read()
+    if image.isNull():
+        return QImage()
+    if image.width() > width or image.height() > height:
+        image = image.scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    return image
+
+
+class CoverLoader(QObject):
+    """在后台线程池下载、解码和缩放封面，完成后在界面线程发出 loaded(key, QImage)。
+
+    同一个 key 再次请求或 cancel(key) 后，旧请求的结果会被丢弃；还没开始的请求直接取消。
+    """
+
+    loaded = pyqtSignal(str, object)
+
+    def __init__(self, cache=None, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=COVER_WORKERS, thread_name_prefix="cover")
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def request(self, key, url, width, height, proxy=""):
+        token = object()
+        with self._lock:
+            old = self._pending.pop(key, None)
+            if old:
+                old[1].cancel()
+            future = self._pool.submit(self._load, key, token, url, width, height, proxy)
+            self._pending[key] = (token, future)
+
+    def cancel(self, key):
+        with self._lock:
+            old = self._pending.pop(key, None)
+        if old:
+            old[1].cancel()
+
+    def pending(self):
+        with self._lock:
+            return set(self._pending)
+
+    def _load(self, key, token, url, width, height, proxy):
+        with self._lock:
+            if self._pending.get(key, (None,))[0] is not token:
+                return
+        try:
+            image = decode_cover(fetch_cover_bytes(url, proxy, self.cache), width, height)
+        except Exception:
+            image = QImage()
+        with self._lock:
+            if self._pending.get(key, (None,))[0] is not token:
+                return
+            del self._pending[key]
+        self.loaded.emit(key, image)
+
+    def shutdown(self):
+        with self._lock:
+            self._pending.clear()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
 # ==================== 下载 Worker ====================
 
+# 子进程模式下从 yt-dlp 进度回调里转发给主进程的字段
+YTDLP_PROGRESS_KEYS = (
+    "status", "filename", "tmpfilename", "total_bytes", "total_bytes_estimate",
+    "downloaded_bytes", "speed", "eta", "thumbnail",
+)
+
+
+def _ytdlp_child_main(url, opts, events):
+    """yt-dlp 子进程入口：把进度、输出路径和结果放进 events 队列交给主进程。"""
+    opts = dict(opts)
+    opts["logger"] = QuietYtdlpLogger()
+    opts["progress_hooks"] = [
+        lambda d: events.put(("progress", {k: d.get(k) for k in YTDLP_PROGRESS_KEYS}
+                                          | {"thumbnail": (d.get("info_dict") or {}).get("thumbnail")}))
+    ]
+    opts["post_hooks"] = [lambda path: events.put(("output", path))]
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            events.put(("result", ydl.download([url])))
+    except Exception as exc:
+        events.put(("error", format_error(exc)))
+
+
 class DownloadWorker(QThread):
-    item_started = pyqtSignal(int, str)
-    item_progress = pyqtSignal(int, float, str)
-    item_finished = pyqtSignal(int, str, str)
-    item_failed = pyqtSignal(int, str)
+    item_started = pyqtSignal(int)
+    items_progress = pyqtSignal(list)
+    item_finished = pyqtSignal(int)
+    item_failed = pyqtSignal(int)
     item_history = pyqtSignal(dict)
     log = pyqtSignal(str)
     all_done = pyqtSignal(bool)
     paused_changed = pyqtSignal(bool)
+    breaker_changed = pyqtSignal(str)
+    stages_changed = pyqtSignal(str)
 
-    def __init__(self, inputs, settings, parent=None):
+    def __init__(self, settings, task_store, scheduler, parent=None):
         super().__init__(parent)
-        self.inputs = inputs
-        self.settings = settings
-        self.cancelled = False
-        self.paused = False
-        self.skip_indices = set()
-        self.current_titles = {}
-        self.current_filename = ""
+        self.default_settings = settings
+        self._local = threading.local()
+        self.store = task_store
+        self.scheduler = scheduler
+        self.gate = PauseGate()
+        # 程序退出时的停止：可续传的临时文件一律保留，供下次启动时恢复续传
+        self.shutting_down = False
+        # 单个任务的取消标记和 yt-dlp 子进程，按任务序号索引
+        self._task_lock = threading.Lock()
+        self.task_cancel_events = {}
+        self.task_processes = {}
+        self.stall_watchdogs = {}
+        self.breaker = CircuitBreaker(on_change=self.on_breaker_changed)
+        self.limiter = HostLimiter(settings.get("api_concurrency", 2), settings.get("cdn_concurrency", 16))
+        # 已发出接口请求、还没有结果的任务 -> (主机, 占用的名额)；yt-dlp 开始下载即视为接口成功
+        self.api_pending = {}
+        self.stream_bytes = {}
+        self.progress = ProgressAggregator(self.items_progress.emit)
+        # 流水线各阶段：提前解析（yt-dlp 元数据）→ 下载 → 后处理（合并、弹幕、媒体信息）
+        self.stages = {
+            "resolve": StageMetrics("解析", RESOLVE_WORKERS),
+            "download": StageMetrics("下载", MAX_CONCURRENT_DOWNLOADS),
+            "post": StageMetrics("后处理", POST_WORKERS),
+        }
+        self.resolved = {}
+        self.post_jobs = {}
+        self.merge_targets = {}
+        self.post_slots = threading.BoundedSemaphore(POST_QUEUE_LIMIT)
+        self.ffmpeg_slots = threading.Semaphore(ffmpeg_worker_count(settings))
+        self.resolver_wakeup = threading.Event()
+
+    @property
+    def settings(self):
+        """当前线程所处理任务加入队列时的设置快照；调度线程上为整批的默认设置。"""
+        return getattr(self._local, "settings", None) or self.default_settings
+
+    @settings.setter
+    def settings(self, value):
+        """只在队列空闲时调用，同时按新设置调整各主机的并发上限和 ffmpeg 进程数。"""
+        self.default_settings = value
+        self.limiter.configure(value.get("api_concurrency", 2), value.get("cdn_concurrency", 16))
+        self.ffmpeg_slots = threading.Semaphore(ffmpeg_worker_count(value))
+
+    @property
+    def cancelled(self):
+        return self.gate.cancelled
+
+    @property
+    def paused(self):
+        return self.gate.paused
 
     def cancel(self):
-        self.cancelled = True
-        self.paused = False
+        self.gate.cancel()
+        self.scheduler.close()
+        self.resolver_wakeup.set()
+        with self._task_lock:
+            processes = list(self.task_processes.values())
+        for proc in processes:
+            proc.terminate()
+
+    def shutdown(self):
+        """退出程序时停止下载。调用方先断开队列日志，任务在日志里保持未完成，下次启动时恢复。"""
+        self.shutting_down = True
+        self.cancel()
+
+    def cancel_task(self, index):
+        """只取消一个任务：等待中的直接标记取消，运行中的设置取消标记并结束其子进程。"""
+        status = self.store.status(index)
+        if status == TaskStatus.WAITING:
+            self.fail_item(index, "已取消", TaskStatus.CANCELLED)
+            self.gate.interrupt()
+            return True
+        if status != TaskStatus.RUNNING:
+            return False
+        with self._task_lock:
+            event = self.task_cancel_events.setdefault(index, threading.Event())
+            proc = self.task_processes.get(index)
+        event.set()
+        if proc is not None:
+            proc.terminate()
+        self.gate.interrupt()
+        return True
+
+    def task_cancelled(self, index):
+        if self.cancelled:
+            return True
+        event = self.task_cancel_events.get(index)
+        return event is not None and event.is_set()
+
+    def register_temp_file(self, index, path, resumable=True):
+        """登记任务产生的临时文件，取消时只清理这些文件。"""
+        self.store.register_temp_file(index, path, resumable)
+
+    def cleanup_task_files(self, index):
+        """按策略清理单个任务登记过的临时文件（含 yt-dlp 的 .ytdl 和分片文件）。
+
+        设置了 keep_partial_on_cancel 时（以及程序退出时）保留可续传的文件，之后可以接着下载。
+        """
+        keep_partial = self.shutting_down or bool(self.settings.get("keep_partial_on_cancel"))
+        for path, resumable in self.store.pop_temp_files(index).items():
+            if resumable and keep_partial:
+                continue
+            path = Path(path)
+            candidates = [path, path.with_name(path.name + ".ytdl")]
+            try:
+                candidates.extend(path.parent.glob(glob.escape(path.name) + "-Frag*"))
+            except OSError:
+                pass
+            for candidate in candidates:
+                try:
+                    candidate.unlink()
+                except OSError:
+                    pass
 
     def pause(self):
-        if not self.cancelled and not self.paused:
-            self.paused = True
+        if self.gate.pause():
             self.paused_changed.emit(True)
 
     def resume(self):
-        if self.paused:
-            self.paused = False
+        if self.gate.resume():
             self.paused_changed.emit(False)
 
-    def skip_index(self, index):
-        self.skip_indices.add(index)
-
     def wait_while_paused(self, index):
-        while self.paused and not self.cancelled:
-            time.sleep(0.2)
-        return not self.cancelled and index not in self.skip_indices
+        self.gate.wait(abort=lambda: self.store.status(index) != TaskStatus.WAITING)
+        return not self.cancelled and self.store.status(index) == TaskStatus.WAITING
+
+    def wait_for_resume(self, index):
+        """下载中途暂停：更新状态文字并阻塞到继续，取消（整批或单个任务）时抛出异常。"""
+        self.emit_progress(index, -1, "已暂停")
+        if not self.gate.wait(abort=lambda: self.task_cancelled(index)) or self.task_cancelled(index):
+            raise RuntimeError("用户取消下载")
+        self.emit_progress(index, -1, "继续下载...")
+
+    def concurrency(self):
+        try:
+            value = int(self.settings.get("concurrent_downloads", 1))
+        except (TypeError, ValueError):
+            value = 1
+        return max(1, min(MAX_CONCURRENT_DOWNLOADS, value))
 
     def run(self):
-        ok = True
+        """常驻调度循环：有空位就从调度队列取任务，队列每次清空时发送 all_done。
+
+        线程一直运行到取消（或退出程序），期间随时可以往调度队列加任务。
+        """
+        crashed = False
+        self.progress.start()
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix="download")
+        self.resolve_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=RESOLVE_WORKERS, thread_name_prefix="resolve")
+        self.post_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=POST_WORKERS, thread_name_prefix="postprocess")
+        resolver = threading.Thread(target=self._resolve_loop, name="Resolver", daemon=True)
+        resolver.start()
         try:
             Path(self.settings["download_dir"]).mkdir(parents=True, exist_ok=True)
-            concurrent = max(1, int(self.settings.get("concurrent_downloads", 1)))
-            if concurrent == 1:
-                for index, raw in enumerate(self.inputs):
-                    status = self._process_one(index, raw)
-                    if status == "cancelled":
-                        ok = False
-                        break
-                    if status == "failed":
-                        ok = False
-            else:
-                ok = self._run_concurrent(concurrent)
+            while True:
+                index = self.scheduler.acquire(self.concurrency())
+                if index is None:
+                    break
+                if index == SCHEDULER_IDLE:
+                    self.progress.flush()
+                    self.emit_stages()
+                    self.all_done.emit(self.scheduler.last_batch_ok)
+                    continue
+                self.stages["download"].limit = self.concurrency()
+                self.stages["download"].enqueue()
+                executor.submit(self._run_task, index)
+                self.resolver_wakeup.set()
+        except Exception as exc:
+            crashed = True
+            write_crash_log(type(exc), exc, exc.__traceback__, source="DownloadWorker")
+            try:
+                self.log.emit(f"下载线程异常: {format_error(exc)}")
+            except Exception:
+                pass
+            self.cancel()
+        executor.shutdown(wait=True)
+        self.post_executor.shutdown(wait=True)
+        resolver.join(timeout=2)
+        self.resolve_executor.shutdown(wait=True, cancel_futures=True)
+
+        try:
+            self.progress.stop()
+            if self.cancelled:
+                for task in self.store.tasks:
+                    if task.status == TaskStatus.WAITING:
+                        self.fail_item(task.index, "已取消", TaskStatus.CANCELLED)
+                    if task.status == TaskStatus.CANCELLED and task.temp_files:
+                        self.cleanup_task_files(task.index)
+            if self.cancelled or crashed:
+                self.all_done.emit(False)
+        except Exception as exc:
+            write_crash_log(type(exc), exc, exc.__traceback__, source="DownloadWorker.all_done")
+
+    def emit_stages(self):
+        """把各阶段的统计推送给界面（状态栏）。"""
+        self.stages_changed.emit(" · ".join(stage.summary() for stage in self.stages.values()))
+
+    def _run_task(self, index):
+        """下载阶段：在线程池中执行单个任务。下载完成后转交后处理线程池，立即归还下载名额。"""
+        status = "failed"
+        task = self.store.get(index)
+        self._local.settings = task.settings if task else None
+        try:
+            with self.stages["download"].run():
+                self.emit_stages()
+                status = self._process_one(index)
         except Exception as exc:
-            write_crash_log(type(exc), exc, exc.__traceback__, source="DownloadWorker")
-            ok = False
+            write_crash_log(type(exc), exc, exc.__traceback__, source="DownloadWorker.task")
             try:
-                self.log.emit(f"下载线程异常: {format_error(exc)}")
+                self.log.emit(f"并发下载异常: {format_error(exc)}")
             except Exception:
                 pass
-
+        finally:
+            self._local.settings = None
+            with self._task_lock:
+                self.stall_watchdogs.pop(index, None)
+            if status == "post":
+                # 后处理队列已满时在这里等待，避免下载跑得比合并快太多
+                self.post_slots.acquire()
+                self.stages["post"].enqueue()
+                self.scheduler.release(handoff=True)
+                self.post_executor.submit(self._run_post, index)
+            else:
+                with self._task_lock:
+                    self.task_cancel_events.pop(index, None)
+                self.scheduler.release(ok=status not in ("failed", "cancelled"))
+            self.emit_stages()
+
+    def _run_post(self, index):
+        """后处理阶段：在后处理线程池中合并分段、下载弹幕并写历史记录。"""
+        status = "failed"
+        task = self.store.get(index)
+        self._local.settings = task.settings if task else None
         try:
-            if self.cancelled:
-                self.cleanup_temp_files()
-            self.all_done.emit(ok and not self.cancelled)
+            with self.stages["post"].run():
+                self.emit_stages()
+                status = self._post_process(index, *self.post_jobs.pop(index))
         except Exception as exc:
-            write_crash_log(type(exc), exc, exc.__traceback__, source="DownloadWorker.all_done")
+            write_crash_log(type(exc), exc, exc.__traceback__, source="DownloadWorker.post")
+            self.fail_item(index, format_error(exc))
+        finally:
+            self._local.settings = None
+            with self._task_lock:
+                self.task_cancel_events.pop(index, None)
+            self.post_slots.release()
+            self.scheduler.finish_post(ok=status == "ok")
+            self.emit_stages()
+
+    def _resolve_loop(self):
+        """提前解析：为排在最前面的几个 yt-dlp 任务预先取得视频信息，下载阶段直接使用。"""
+        while not self.cancelled:
+            try:
+                upcoming = set() if self.paused else set(self.scheduler.peek(RESOLVE_LOOKAHEAD))
+                with self._task_lock:
+                    for index in [i for i in self.resolved
+                                  if self.store.status(i) in TASK_FINAL_STATUSES]:
+                        self.resolved.pop(index).cancel()
+                    pending = [i for i in upcoming if i not in self.resolved]
+                    for index in pending:
+                        task = self.store.get(index)
+                        url = normalize_input(task.url)
+                        settings = task.settings or self.default_settings
+                        if (not url or settings.get("ytdlp_subprocess")
+                                or (is_bilibili_url(url) and settings.get("custom_format"))):
+                            continue
+                        self.stages["resolve"].enqueue()
+                        self.resolved[index] = self.resolve_executor.submit(self._resolve_task, index, url)
+            except RuntimeError:
+                # 线程池已关闭
+                return
+            except Exception as exc:
+                write_crash_log(type(exc), exc, exc.__traceback__, source="DownloadWorker.resolve")
+            self.resolver_wakeup.wait(0.5)
+            self.resolver_wakeup.clear()
+
+    def _resolve_task(self, index, url):
+        task = self.store.get(index)
+        self._local.settings = task.settings if task else None
+        try:
+            with self.stages["resolve"].run():
+                if self.store.status(index) != TaskStatus.WAITING or self.archived_entry(url) is not None:
+                    return None
+                host = BILI_API_HOST if is_bilibili_url(url) else None
+                with self.api_call(index, host):
+                    opts = self.build_ytdlp_options(index)
+                    opts.pop("progress_hooks", None)
+                    opts.pop("post_hooks", None)
+                    with yt_dlp.YoutubeDL(opts) as ydl:
+                        return ydl.extract_info(url, download=False, process=False)
+        finally:
+            self._local.settings = None
+
+    def take_resolved(self, index):
+        """取出提前解析的结果；解析还在进行时等它完成。解析失败返回 None，由下载阶段重新解析。"""
+        with self._task_lock:
+            future = self.resolved.pop(index, None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception:
+            return None
 
-    def _process_one(self, index, raw):
-        """处理单个下载任务。返回: 'ok' | 'failed' | 'cancelled' | 'skipped'。"""
+    def _process_one(self, index):
+        """下载单个任务。返回: 'post'（已下载，待后处理）| 'failed' | 'cancelled' | 'skipped' | 'retry'。"""
         if self.cancelled:
             return "cancelled"
-        if index in self.skip_indices:
-            self.item_failed.emit(index, "已从队列删除")
-            return "skipped"
         if not self.wait_while_paused(index):
-            if self.cancelled:
-                return "cancelled"
-            self.item_failed.emit(index, "已从队列删除")
-            return "skipped"
+            return "cancelled" if self.cancelled else "skipped"
 
-        url = normalize_input(raw)
+        task = self.store.get(index)
+        url = normalize_input(task.url) if task else ""
         if not url:
             return "skipped"
 
-        self.current_titles[index] = url
-        self.item_started.emit(index, url)
+        if not self.start_item(index, url):
+            return "skipped"
+        archived = self.archived_entry(url)
+        if archived is not None:
+            self.finish_item(index, archived.get("path") or "", note="已下载过，跳过")
+            self.log.emit(f"已下载过，跳过: {url}")
+            return "skipped"
         self.log.emit(f"开始处理: {url}")
-        started_at = int(time.time())
         try:
             if self.should_use_bili_selected_format(url):
                 outputs = self.download_bili_legacy(index, url)
-                output_detail = self.output_detail(outputs)
             else:
-                output = self.download_with_ytdlp(index, url)
-                output_detail = self.output_detail([output])
-            # 下载弹幕
-            if self.settings.get("download_danmaku") and is_bilibili_url(url):
-                self.item_progress.emit(index, 100, "正在下载弹幕...")
-                output_base = self._output_base_for_danmaku(output_detail)
-                if output_base:
-                    if fetch_bili_danmaku_for_url(url, output_base, self.settings):
-                        self.log.emit(f"弹幕已保存: {output_base}.danmaku.xml")
-                    else:
-                        self.log.emit("弹幕下载失败或无弹幕")
-            self.item_finished.emit(index, output_detail, "完成")
-            self.log.emit(f"完成: {output_detail}")
-            self.emit_history(index, url, output_detail, "completed", "", started_at)
-            return "ok"
+                outputs = [self.download_with_ytdlp(index, url)]
+            self.post_jobs[index] = (url, outputs, "")
+            return "post"
         except Exception as exc:
-            if self.cancelled:
-                self.item_failed.emit(index, "已取消")
-                self.emit_history(index, url, "", "cancelled", "已取消", started_at)
+            if self.task_cancelled(index):
+                self.cleanup_task_files(index)
+                self.fail_item(index, "已取消", TaskStatus.CANCELLED)
+                self.emit_history(index, url, "", "cancelled", "已取消")
                 return "cancelled"
             if self.should_try_bili_fallback(url, exc):
                 self.log.emit("yt-dlp 被 B站 412 拦截，尝试公开视频兜底接口...")
                 try:
                     outputs = self.download_bili_legacy(index, url)
-                    output_text = self.output_detail(outputs)
-                    if self.settings.get("download_danmaku"):
-                        self.item_progress.emit(index, 100, "正在下载弹幕...")
-                        output_base = self._output_base_for_danmaku(output_text)
-                        if output_base and fetch_bili_danmaku_for_url(url, output_base, self.settings):
-                            self.log.emit(f"弹幕已保存: {output_base}.danmaku.xml")
-                    self.item_finished.emit(index, output_text, "完成（公开视频兜底）")
-                    self.log.emit(f"兜底完成: {output_text}")
-                    self.emit_history(index, url, output_text, "completed", "", started_at)
-                    return "ok"
+                    self.post_jobs[index] = (url, outputs, "公开视频兜底")
+                    return "post"
                 except Exception as fallback_exc:
-                    if self.cancelled:
-                        self.item_failed.emit(index, "已取消")
-                        self.emit_history(index, url, "", "cancelled", "已取消", started_at)
+                    if self.task_cancelled(index):
+                        self.cleanup_task_files(index)
+                        self.fail_item(index, "已取消", TaskStatus.CANCELLED)
+                        self.emit_history(index, url, "", "cancelled", "已取消")
                         return "cancelled"
                     err_text = format_bili_error(fallback_exc)
-                    self.item_failed.emit(index, err_text)
+                    if self.retry_later(index, fallback_exc, err_text):
+                        return "retry"
+                    self.fail_item(index, err_text)
                     self.log.emit(f"兜底失败: {err_text}")
-                    self.emit_history(index, url, "", "failed", err_text, started_at)
+                    self.emit_history(index, url, "", "failed", err_text)
                     return "failed"
             err_text = format_bili_error(exc)
-            self.item_failed.emit(index, err_text)
+            if self.retry_later(index, exc, err_text):
+                return "retry"
+            self.fail_item(index, err_text)
             self.log.emit(f"失败: {err_text}")
-            self.emit_history(index, url, "", "failed", err_text, started_at)
+            self.emit_history(index, url, "", "failed", err_text)
             return "failed"
 
-    def _run_concurrent(self, max_workers):
-        """并发下载多个任务。返回 True 表示全部成功。"""
-        ok = True
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {
-                executor.submit(self._process_one, index, raw): index
-                for index, raw in enumerate(self.inputs)
-            }
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    status = future.result()
-                    if status in ("failed", "cancelled"):
-                        ok = False
-                        if status == "cancelled":
-                            for f in futures:
-                                f.cancel()
-                except Exception as exc:
-                    write_crash_log(type(exc), exc, exc.__traceback__, source="DownloadWorker.concurrent")
-                    ok = False
-                    try:
-                        self.log.emit(f"并发下载异常: {format_error(exc)}")
-                    except Exception:
-                        pass
-        return ok
+    def _post_process(self, index, url, outputs, note):
+        """合并分段、下载弹幕、完成任务并写历史（含媒体信息探测）。返回 'ok' | 'failed' | 'cancelled'。"""
+        try:
+            target = self.merge_targets.pop(index, None)
+            if target is not None:
+                outputs = self.merge_segments(index, outputs, *target)
+            output_detail = self.output_detail(outputs)
+            if self.settings.get("download_danmaku") and is_bilibili_url(url):
+                self.emit_progress(index, 100, "正在下载弹幕...")
+                output_base = self._output_base_for_danmaku(output_detail)
+                if output_base:
+                    if fetch_bili_danmaku_for_url(url, output_base, self.settings):
+                        self.log.emit(f"弹幕已保存: {output_base}.danmaku.xml")
+                    else:
+                        self.log.emit("弹幕下载失败或无弹幕")
+            self.finish_item(index, output_detail, note=note)
+            self.log.emit(f"{'兜底完成' if note else '完成'}: {output_detail}")
+            self.emit_history(index, url, output_detail, "completed", "")
+            return "ok"
+        except Exception as exc:
+            if self.task_cancelled(index):
+                self.cleanup_task_files(index)
+                self.fail_item(index, "已取消", TaskStatus.CANCELLED)
+                self.emit_history(index, url, "", "cancelled", "已取消")
+                return "cancelled"
+            err_text = format_bili_error(exc)
+            self.fail_item(index, err_text)
+            self.log.emit(f"失败: {err_text}")
+            self.emit_history(index, url, "", "failed", err_text)
+            return "failed"
+
+    def archived_entry(self, url):
+        """按当前任务的设置查询下载存档；关闭了"跳过已下载"时总是返回 None。"""
+        if not self.settings.get("skip_archived", True):
+            return None
+        DOWNLOAD_ARCHIVE.seed(load_history, self.settings.get("download_dir"))
+        return DOWNLOAD_ARCHIVE.match(url, self.settings)
 
-    def emit_history(self, index, url, output_detail, status, error, started_at):
-        title = self.current_titles.get(index) or url
+    def emit_history(self, index, url, output_detail, status, error):
+        task = self.store.get(index)
         record = {
-            "title": title,
+            "title": (task.title if task else "") or url,
             "url": url,
             "output_detail": output_detail,
-            "output_path": extract_output_path(output_detail),
+            "output_path": (task.output_path if task and output_detail else "") or extract_output_path(output_detail),
             "status": status,
             "error": error,
-            "created_at": started_at,
+            "thumbnail": task.thumbnail if task else "",
+            "created_at": task.started_at if task else int(time.time()),
             "finished_at": int(time.time()),
         }
         output_path = record["output_path"]
@@ -1131,6 +3948,13 @@ class DownloadWorker(QThread):
                 "video_codec": info.get("video_codec", ""),
                 "audio_codec": info.get("audio_codec", ""),
             })
+        if status == "completed":
+            DOWNLOAD_ARCHIVE.record(url, parse_resolution_height(record.get("resolution")), output_path)
+            if output_path and self.settings.get("dedupe_downloads"):
+                saved, original = DEDUPER.dedupe_file(output_path)
+                if saved:
+                    self.log.emit(f"{Path(output_path).name} 与 {Path(original).name} 内容相同，"
+                                  f"已合并为链接，节省 {format_bytes(saved)}")
         self.item_history.emit(record)
 
     def output_detail(self, outputs):
@@ -1159,12 +3983,20 @@ class DownloadWorker(QThread):
             "no_warnings": True,
             "continuedl": True,
             "noprogress": True,
-            "concurrent_fragment_downloads": int(self.settings.get("fragment_threads", 4)),
+            # yt-dlp 自己管理分片连接，这里只保证单个任务不超过 CDN 连接上限
+            "concurrent_fragment_downloads": min(int(self.settings.get("fragment_threads", 4)),
+                                                 int(self.settings.get("cdn_concurrency", 16))),
             "outtmpl": str(Path(self.settings["download_dir"]) / self.settings["filename_template"]),
             "logger": QuietYtdlpLogger(),
             "http_headers": std_headers(),
             "progress_hooks": [lambda d: self.on_ytdlp_progress(index, d)],
+            "post_hooks": [lambda path: self.store.set_output_path(index, path)],
         }
+        task = self.store.get(index)
+        if (task and self.settings.get("skip_archived", True)
+                and DOWNLOAD_ARCHIVE.needs_upgrade(task.url, self.settings)):
+            # 存档里有但实际画质低于这次要求的画质：覆盖同名文件
+            opts["overwrites"] = True
         custom_format = (self.settings.get("custom_format") or "").strip()
         if custom_format:
             opts["format"] = custom_format
@@ -1207,15 +4039,24 @@ class DownloadWorker(QThread):
         return apply_cookie_and_proxy_options(opts, self.settings)
 
     def on_ytdlp_progress(self, index, data):
-        if self.cancelled:
+        if self.task_cancelled(index):
             raise RuntimeError("用户取消下载")
         status = data.get("status")
         filename = data.get("filename") or data.get("tmpfilename") or ""
-        if filename:
-            self.current_filename = filename
         if status == "downloading":
+            self.register_temp_file(index, data.get("tmpfilename"))
+            self.store.set_thumbnail(index, data.get("thumbnail") or (data.get("info_dict") or {}).get("thumbnail"))
+            if self.paused:
+                raise DownloadPaused()
             total = data.get("total_bytes") or data.get("total_bytes_estimate") or 0
             downloaded = data.get("downloaded_bytes") or 0
+            self.api_finished(index)
+            watchdog = self.stall_watchdogs.get(index)
+            if watchdog is not None:
+                last = self.stream_bytes.get(index, {}).get(filename, (0, 0))[0]
+                watchdog.feed(max(0, downloaded - last))
+                if watchdog.stalled():
+                    raise DownloadStalled()
             percent = downloaded / total * 100 if total else 0
             speed = data.get("speed") or 0
             eta = data.get("eta")
@@ -1224,19 +4065,217 @@ class DownloadWorker(QThread):
                 detail += f"  {speed / 1024 / 1024:.2f} MB/s"
             if eta is not None:
                 detail += f"  ETA {eta}s"
-            self.item_progress.emit(index, percent, detail)
+            # DASH 视频/音频分别下载，按文件累计字节数，任务总大小 = 各流之和
+            streams = self.stream_bytes.setdefault(index, {})
+            streams[filename] = (downloaded, total)
+            sum_done = sum(d for d, _ in streams.values())
+            sum_total = sum(t for _, t in streams.values())
+            self.emit_progress(index, percent, detail, sum_done, sum_total, speed)
         elif status == "finished":
-            self.item_progress.emit(index, 100, "下载完成，正在合并/整理")
+            self.store.mark_stage(index, "postprocessing")
+            self.emit_progress(index, 100, "下载完成，正在合并/整理")
         elif status == "error":
-            self.item_progress.emit(index, 0, "下载错误")
+            self.emit_progress(index, 0, "下载错误")
+
+    def emit_progress(self, index, percent, detail, downloaded=0, total=0, speed=0):
+        """写入单个任务的进度，界面通知由聚合器按固定频率批量发送。percent < 0 表示只更新说明文字。"""
+        self.store.update_progress(index, percent, detail, downloaded, total, speed)
+        self.progress.mark(index)
+
+    def start_item(self, index, url):
+        """把等待中的任务切换为下载中。任务已被删除时返回 False。"""
+        if not self.store.start(index, title=url):
+            return False
+        self.item_started.emit(index)
+        return True
+
+    def finish_item(self, index, output_detail, note=""):
+        self.progress.discard(index)
+        self.store.finish(index, output_detail, extract_output_path(output_detail), note)
+        task = self.store.get(index)
+        if task and task.output_path:
+            LIBRARY.add(task.output_path)
+        self.item_finished.emit(index)
+
+    def fail_item(self, index, error, status=TaskStatus.FAILED):
+        self.progress.discard(index)
+        if self.store.fail(index, error, status):
+            self.item_failed.emit(index)
+
+    def retry_later(self, index, exc, err_text):
+        """可重试的错误：放回等待状态并延迟排队，不占用下载名额。返回是否已安排重试。"""
+        kind = classify_retry(exc)
+        task = self.store.get(index)
+        if kind is None or task is None or task.attempts >= RETRY_MAX_ATTEMPTS or self.cancelled:
+            return False
+        if not self.scheduler.take_retry():
+            self.log.emit("本批自动重试次数已用完，不再重试")
+            return False
+        delay = retry_delay(kind, task.attempts + 1)
+        self.progress.discard(index)
+        if not self.store.retry_later(index, err_text, f"{delay:.0f} 秒后重试"):
+            return False
+        self.scheduler.submit_later(index, delay)
+        self.item_failed.emit(index)
+        self.log.emit(f"失败，{delay:.0f} 秒后第 {task.attempts} 次重试: {err_text}")
+        return True
+
+    def on_breaker_changed(self, host, state, remaining):
+        if state == CircuitBreaker.OPEN:
+            text = f"{host} 风控熔断，{remaining:.0f} 秒后试探"
+            self.log.emit(f"{host} 连续返回风控，暂停接口请求 {remaining:.0f} 秒")
+        elif state == CircuitBreaker.HALF_OPEN:
+            text = f"{host} 熔断试探中"
+        else:
+            text = ""
+            self.log.emit(f"{host} 已恢复正常")
+        self.breaker_changed.emit(text)
+
+    @contextlib.contextmanager
+    def api_call(self, index, host):
+        """包住一次接口请求：熔断期间先等待，再占用该主机的接口名额，结束后把结果记入熔断器。
+
+        host 为 None 时不做处理。
+        """
+        if host is None:
+            yield
+            return
+        abort = lambda: self.task_cancelled(index)
+        if self.breaker.state(host) != CircuitBreaker.CLOSED:
+            self.emit_progress(index, -1, "接口风控冷却中，等待恢复...")
+        if not self.breaker.acquire(host, abort=abort):
+            raise RuntimeError("用户取消下载")
+        sem = self.limiter.acquire(host, abort=abort)
+        if not sem:
+            self.breaker.record(host, RuntimeError("用户取消下载"))
+            raise RuntimeError("用户取消下载")
+        self.api_pending[index] = (host, sem)
+        try:
+            yield
+        except BaseException as exc:
+            self.api_finished(index, exc)
+            raise
+        self.api_finished(index)
+
+    def api_finished(self, index, exc=None):
+        """接口请求有了结果：归还接口名额并记入熔断器。重复调用无效果。"""
+        pending = self.api_pending.pop(index, None)
+        if pending is None:
+            return
+        host, sem = pending
+        self.limiter.release(sem)
+        self.breaker.record(host, exc)
+
+    @contextlib.contextmanager
+    def host_slot(self, index, url):
+        """下载连接占用目标主机（CDN）的一个名额。"""
+        sem = self.limiter.acquire(urlparse(url).hostname or "", abort=lambda: self.task_cancelled(index))
+        if not sem:
+            raise RuntimeError("用户取消下载")
+        try:
+            yield
+        finally:
+            self.limiter.release(sem)
+
+    def stall_watchdog(self, index):
+        """为任务创建低速监测器；设置为 0 时返回 None。"""
+        floor = int(self.settings.get("stall_speed_floor_kb", 0) or 0) * 1024
+        if floor <= 0:
+            return None
+        watchdog = StallWatchdog(floor)
+        with self._task_lock:
+            self.stall_watchdogs[index] = watchdog
+        return watchdog
+
+    def on_stall(self, index, watchdog):
+        """记录一次低速重连；超过 STALL_MAX_RECONNECTS 次后不再监测，按当前速度下完。"""
+        count = self.store.record_stall(index)
+        self.log.emit(f"任务 {index + 1} 速度持续低于下限，重新连接（第 {count} 次）")
+        self.emit_progress(index, -1, f"速度过低，重新连接（第 {count} 次）")
+        if count >= STALL_MAX_RECONNECTS:
+            watchdog.floor = 0
+        watchdog.reset()
 
     def download_with_ytdlp(self, index, url):
-        self.current_filename = ""
-        with yt_dlp.YoutubeDL(self.build_ytdlp_options(index)) as ydl:
-            result = ydl.download([url])
+        self.stream_bytes.pop(index, None)
+        watchdog = self.stall_watchdog(index)
+        info = self.take_resolved(index)
+        # 已提前解析的任务不再请求接口
+        host = BILI_API_HOST if is_bilibili_url(url) and info is None else None
+        while True:
+            try:
+                with self.api_call(index, host):
+                    if self.settings.get("ytdlp_subprocess"):
+                        result = self.run_ytdlp_subprocess(index, url)
+                    else:
+                        with yt_dlp.YoutubeDL(self.build_ytdlp_options(index)) as ydl:
+                            if info is not None:
+                                ydl.process_ie_result(info, download=True)
+                                result = 0
+                            else:
+                                result = ydl.download([url])
+                break
+            except DownloadPaused:
+                # 连接已断开，继续后重新下载；continuedl 会从 .part 文件末尾续传
+                self.wait_for_resume(index)
+                info = None
+                host = BILI_API_HOST if is_bilibili_url(url) else None
+                if watchdog is not None:
+                    watchdog.reset()
+            except DownloadStalled:
+                self.on_stall(index, watchdog)
         if result:
             raise RuntimeError(f"yt-dlp 返回错误码: {result}")
-        return self.current_filename or self.settings["download_dir"]
+        task = self.store.get(index)
+        return (task.output_path if task else "") or self.settings["download_dir"]
+
+    def run_ytdlp_subprocess(self, index, url):
+        """在独立进程中运行 yt-dlp。
+
+        取消或暂停时直接结束子进程，解析和 ffmpeg 合并阶段也能在 1 秒内停下。
+        """
+        opts = self.build_ytdlp_options(index)
+        for key in ("logger", "progress_hooks", "post_hooks"):
+            opts.pop(key, None)
+        ctx = multiprocessing.get_context("spawn")
+        events = ctx.Queue()
+        proc = ctx.Process(target=_ytdlp_child_main, args=(url, opts, events), daemon=True)
+        proc.start()
+        with self._task_lock:
+            self.task_processes[index] = proc
+        try:
+            while True:
+                try:
+                    kind, payload = events.get(timeout=0.2)
+                except queue.Empty:
+                    if self.task_cancelled(index):
+                        raise RuntimeError("用户取消下载")
+                    if self.paused:
+                        raise DownloadPaused()
+                    if not proc.is_alive():
+                        try:
+                            kind, payload = events.get(timeout=0.5)
+                        except queue.Empty:
+                            raise RuntimeError(f"yt-dlp 子进程异常退出（退出码 {proc.exitcode}）")
+                    else:
+                        continue
+                if kind == "progress":
+                    self.on_ytdlp_progress(index, payload)
+                elif kind == "output":
+                    self.store.set_output_path(index, payload)
+                elif kind == "error":
+                    raise RuntimeError(payload)
+                elif kind == "result":
+                    return payload
+        finally:
+            with self._task_lock:
+                self.task_processes.pop(index, None)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join(1)
+                if proc.is_alive():
+                    proc.kill()
+            proc.join(1)
 
     def request_session(self):
         """构建带 Cookie 和代理的下载 session。"""
@@ -1249,7 +4288,9 @@ class DownloadWorker(QThread):
             raise RuntimeError("无法从链接中识别 BV 号或 av 号。")
         video_id = url  # bili_view/bili_playurl 内部会解析
         page_num = selected_page_number(url)
-        data = bili_view(video_id, self.settings)
+        with self.api_call(index, BILI_API_HOST):
+            data = bili_view(video_id, self.settings)
+        self.store.set_thumbnail(index, data.get("pic"))
         pages = data.get("pages") or []
         if not pages:
             raise RuntimeError("没有找到可下载的分 P。")
@@ -1271,14 +4312,16 @@ class DownloadWorker(QThread):
             self.log.emit("未配置 Cookie，兜底接口尝试 360P 低清晰度...")
         else:
             qn = QUALITY_QN.get(quality, 80) if quality != "best" else 80
-        play_data = bili_playurl(video_id, cid, qn, self.settings, page=page_num)
+        with self.api_call(index, BILI_API_HOST):
+            play_data = bili_playurl(video_id, cid, qn, self.settings, page=page_num)
         durl = play_data.get("durl") or []
         if not durl:
             # 如果有 Cookie 且返回了 dash，尝试用 fnval=0 重新请求 durl
             dash = play_data.get("dash")
             if dash:
                 self.log.emit("返回了 DASH 格式，尝试请求 durl 直链...")
-                play_data = bili_playurl(video_id, cid, qn, self.settings, page=page_num, fnval=0)
+                with self.api_call(index, BILI_API_HOST):
+                    play_data = bili_playurl(video_id, cid, qn, self.settings, page=page_num, fnval=0)
                 durl = play_data.get("durl") or []
             if not durl:
                 raise RuntimeError(
@@ -1302,78 +4345,277 @@ class DownloadWorker(QThread):
         else:
             filename = f"{title}.mp4"
         output_path = unique_path(download_dir / filename)
-        outputs = []
-        total_bytes = 0
-        for i, d in enumerate(durl):
-            video_url = d.get("url")
-            if not video_url:
-                continue
-            if self.cancelled:
-                raise RuntimeError("用户取消下载")
-            self.item_progress.emit(index, 0, f"下载分段 {i+1}/{len(durl)}")
-            resp = session.get(video_url, headers={"Referer": "https://www.bilibili.com/"}, stream=True, timeout=30)
-            resp.raise_for_status()
-            size = int(d.get("size") or 0)
-            downloaded = 0
-            part_path = output_path.with_suffix(f".part{i}") if len(durl) > 1 else output_path.with_suffix(".part")
-            with open(part_path, "wb") as f:
-                for chunk in resp.iter_content(chunk_size=1024 * 256):
-                    if self.cancelled:
-                        raise RuntimeError("用户取消下载")
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        total_bytes += len(chunk)
-                        if size:
-                            pct = downloaded / size * 100
-                            self.item_progress.emit(index, pct, f"分段 {i+1}/{len(durl)}  {pct:.1f}%")
-            if len(durl) > 1:
-                outputs.append(str(part_path))
-            else:
-                part_path.replace(output_path)
-                outputs.append(str(output_path))
+        try:
+            outputs = []
+            total_bytes = 0
+            total_size = sum(int(d.get("size") or 0) for d in durl)
+            for i, d in enumerate(durl):
+                video_url = d.get("url")
+                if not video_url:
+                    continue
+                if self.task_cancelled(index):
+                    raise RuntimeError("用户取消下载")
+                self.emit_progress(index, -1, f"下载分段 {i+1}/{len(durl)}")
+                size = int(d.get("size") or 0)
+                part_path = output_path.with_suffix(f".part{i}") if len(durl) > 1 else output_path.with_suffix(".part")
+                self.register_temp_file(index, part_path)
+
+                def on_chunk(downloaded, i=i, size=size, done_before=total_bytes):
+                    if size:
+                        pct = downloaded / size * 100
+                        self.emit_progress(index, pct, f"分段 {i+1}/{len(durl)}  {pct:.1f}%",
+                                           done_before + downloaded, total_size)
+
+                task = self.store.get(index)
+                resume = bool(task and task.restored)
+                mirrors = [video_url] + [u for u in (d.get("backup_url") or []) if u]
+                total_bytes += self.download_stream(index, session, mirrors, part_path, on_chunk, resume)
+                if len(durl) > 1:
+                    outputs.append(str(part_path))
+                else:
+                    part_path.replace(output_path)
+                    LIBRARY.add(output_path)
+                    outputs.append(str(output_path))
+        except BaseException:
+            # 文件没写出来，撤销预留，重试时还能用同一个文件名续传
+            LIBRARY.release(output_path)
+            raise
         if len(durl) > 1 and FFMPEG_EXE.exists():
-            concat_path = output_path.with_suffix(".concat.txt")
-            with open(concat_path, "w", encoding="utf-8") as f:
-                for o in outputs:
-                    f.write(f"file '{o}'\n")
-            try:
-                subprocess.run(
-                    [str(FFMPEG_EXE), "-y", "-f", "concat", "-safe", "0", "-i", str(concat_path),
-                     "-c", "copy", str(output_path)],
-                    check=True,
-                    timeout=300,
-                    creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
-                )
-                for o in outputs:
-                    try:
-                        Path(o).unlink()
-                    except Exception:
-                        pass
+            # 分段由后处理阶段合并，下载名额先让给下一个任务
+            duration = sum(int(d.get("length") or 0) for d in durl) / 1000
+            self.merge_targets[index] = (output_path, duration)
+            self.emit_progress(index, 100, "下载完成，等待合并")
+        else:
+            self.emit_progress(index, 100, "完成")
+        return outputs
+
+    def merge_segments(self, index, outputs, output_path, duration=0):
+        """用 ffmpeg concat 合并分段，成功后删除分段文件；失败时保留分段原样返回。
+
+        duration 为分段总时长（秒），用于把 ffmpeg 的处理进度换算成百分比。
+        """
+        self.store.mark_stage(index, "postprocessing")
+        self.emit_progress(index, 100, "等待合并...")
+        concat_path = output_path.with_suffix(".concat.txt")
+        self.register_temp_file(index, concat_path, resumable=False)
+        with open(concat_path, "w", encoding="utf-8") as f:
+            for o in outputs:
+                f.write(f"file '{o}'\n")
+
+        def on_progress(seconds):
+            if duration > 0:
+                pct = min(100.0, seconds / duration * 100)
+                self.emit_progress(index, pct, f"合并中 {pct:.0f}%")
+
+        input_bytes = sum(Path(o).stat().st_size for o in outputs if Path(o).exists())
+        try:
+            with self.ffmpeg_slots:
+                self.emit_progress(index, 0 if duration > 0 else 100, "正在合并分段...")
+                run_ffmpeg(["-y", "-f", "concat", "-safe", "0", "-i", str(concat_path),
+                            "-c", "copy", str(output_path)],
+                           input_bytes=input_bytes, on_progress=on_progress,
+                           abort=lambda: self.task_cancelled(index))
+            LIBRARY.add(output_path)
+            for o in outputs:
                 try:
-                    concat_path.unlink()
+                    Path(o).unlink()
                 except Exception:
                     pass
-                outputs = [str(output_path)]
+            try:
+                concat_path.unlink()
             except Exception:
                 pass
-        self.item_progress.emit(index, 100, "完成")
-        return outputs
+            return [str(output_path)]
+        except Exception as exc:
+            if self.task_cancelled(index):
+                raise
+            self.log.emit(f"合并分段失败，保留分段文件: {format_error(exc)}")
+            return outputs
+
+    def download_stream(self, index, session, urls, part_path, on_chunk, resume=False):
+        """流式下载到 part_path，返回写入的字节数。urls 为主地址和备用镜像（也可以传单个地址）。
+
+        暂停时停止读取并断开连接；继续后用 Range 请求从已写入的字节处续传，
+        服务器不支持 Range（返回 200）时从头重新下载。resume=True 时接着已有的
+        part_path 续传（用于从队列日志恢复的任务）。速度持续低于下限时由监测
+        线程断开连接，从当前位置换下一个镜像续传。
+        """
+        urls = [urls] if isinstance(urls, str) else list(urls)
+        mirror = 0
+        watchdog = self.stall_watchdog(index)
+        downloaded = 0
+        if resume and part_path.exists():
+            downloaded = part_path.stat().st_size
+        with open(part_path, "r+b" if downloaded else "wb") as f:
+            f.seek(downloaded)
+            while True:
+                headers = {"Referer": "https://www.bilibili.com/"}
+                if downloaded:
+                    headers["Range"] = f"bytes={downloaded}-"
+                with self.host_slot(index, urls[mirror]):
+                    resp = session.get(urls[mirror], headers=headers, stream=True, timeout=30)
+                    paused = False
+                    stalled = threading.Event()
+                    watching = threading.Event()
+                    try:
+                        if downloaded and resp.status_code == 416:
+                            # 续传起点已是文件末尾
+                            return downloaded
+                        resp.raise_for_status()
+                        if downloaded and resp.status_code != 206:
+                            f.seek(0)
+                            f.truncate()
+                            downloaded = 0
+                        if watchdog is not None:
+                            watchdog.reset()
+                            watchdog.feed(0)
+                            watching.set()
+                            threading.Thread(
+                                target=self._watch_stream, args=(watchdog, resp, watching, stalled),
+                                name="StallWatchdog", daemon=True,
+                            ).start()
+                        try:
+                            for chunk in resp.iter_content(chunk_size=1024 * 256):
+                                if self.task_cancelled(index):
+                                    raise RuntimeError("用户取消下载")
+                                if self.paused:
+                                    paused = True
+                                    break
+                                if chunk:
+                                    f.write(chunk)
+                                    downloaded += len(chunk)
+                                    if watchdog is not None:
+                                        watchdog.feed(len(chunk))
+                                    on_chunk(downloaded)
+                        except Exception:
+                            # 监测线程关闭连接后读取会报错，按低速重连处理
+                            if not stalled.is_set():
+                                raise
+                    finally:
+                        watching.clear()
+                        resp.close()
+                if stalled.is_set():
+                    f.flush()
+                    self.on_stall(index, watchdog)
+                    mirror = (mirror + 1) % len(urls)
+                    continue
+                if not paused:
+                    return downloaded
+                f.flush()
+                self.wait_for_resume(index)
+
+    @staticmethod
+    def _watch_stream(watchdog, resp, watching, stalled):
+        """每秒检查一次吞吐量，低于下限时关闭连接，让阻塞在读取上的下载线程返回。"""
+        interval = min(1.0, watchdog.window / 4)
+        while watching.is_set():
+            time.sleep(interval)
+            if watching.is_set() and watchdog.stalled():
+                stalled.set()
+                resp.close()
+                return
 
-    def cleanup_temp_files(self):
-        """清理临时文件。"""
-        try:
-            download_dir = Path(self.settings["download_dir"])
-            if not download_dir.exists():
+
+# ==================== 链接导入 Worker ====================
+
+class LinkImportWorker(QThread):
+    """逐行读取链接列表文件，提取、规范化并去重后分批交给界面加入队列。
+
+    known_keys 为队列和历史中已有视频的 input_key 集合；短链接先解析再去重。
+    界面处理完一批后调用 ack()，最多只有两批在途，避免大文件一次堆满界面线程的事件队列。
+    """
+
+    batch_ready = pyqtSignal(list)
+    progress = pyqtSignal(int, int, int)
+    summary = pyqtSignal(dict)
+    failed = pyqtSignal(str)
+
+    def __init__(self, path, known_keys, proxy="", parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.known_keys = known_keys
+        self.proxy = proxy
+        self._in_flight = threading.Semaphore(2)
+
+    def ack(self):
+        self._in_flight.release()
+
+    def _emit_batch(self, urls):
+        while not self._in_flight.acquire(timeout=0.2):
+            if self.isInterruptionRequested():
                 return
-            for pattern in ["*.part", "*.part0", "*.part1", "*.ytdl", "*.temp", "*.concat.txt"]:
-                for f in download_dir.glob(pattern):
-                    try:
-                        f.unlink()
-                    except Exception:
-                        pass
-        except Exception:
-            pass
+        self.batch_ready.emit(urls)
+
+    def run(self):
+        stats = {"lines": 0, "links": 0, "added": 0, "duplicates": 0, "invalid": 0}
+        seen = self.known_keys
+        batch = []
+
+        def flush():
+            for url in SHORT_LINKS.expand(batch, self.proxy):
+                key = input_key(url)
+                if key in seen:
+                    stats["duplicates"] += 1
+                    continue
+                seen.add(key)
+                pending.append(url)
+            batch.clear()
+
+        pending = []
+        try:
+            total = os.path.getsize(self.path)
+            done = 0
+            with open(self.path, "rb") as f:
+                for raw in f:
+                    if self.isInterruptionRequested():
+                        break
+                    done += len(raw)
+                    stats["lines"] += 1
+                    line = raw.decode("utf-8-sig" if stats["lines"] == 1 else "utf-8", errors="replace")
+                    links = extract_links(line)
+                    if not links and line.strip():
+                        stats["invalid"] += 1
+                    stats["links"] += len(links)
+                    batch.extend(links)
+                    if len(batch) >= IMPORT_BATCH_SIZE:
+                        flush()
+                    if len(pending) >= IMPORT_BATCH_SIZE:
+                        stats["added"] += len(pending)
+                        self._emit_batch(pending)
+                        pending = []
+                        self.progress.emit(done, total, stats["added"])
+            flush()
+            if pending:
+                stats["added"] += len(pending)
+                self._emit_batch(pending)
+            self.progress.emit(total, total, stats["added"])
+            stats["interrupted"] = self.isInterruptionRequested()
+            self.summary.emit(stats)
+        except Exception as exc:
+            self.failed.emit(format_error(exc))
+
+
+# ==================== 去重 Worker ====================
+
+class DedupeWorker(QThread):
+    """在后台整理下载目录中的重复文件，见 FileDeduper.dedupe_folder。"""
+
+    progress = pyqtSignal(int, int)
+    summary = pyqtSignal(dict)
+    failed = pyqtSignal(str)
+
+    def __init__(self, folder, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+
+    def run(self):
+        try:
+            stats = DEDUPER.dedupe_folder(self.folder, should_stop=self.isInterruptionRequested,
+                                          on_progress=self.progress.emit)
+            stats["interrupted"] = self.isInterruptionRequested()
+            self.summary.emit(stats)
+        except Exception as exc:
+            self.failed.emit(format_error(exc))
 
 
 # ==================== Cookie 检测 Worker ====================
@@ -1879,23 +5121,8 @@ class DroppablePlainTextEdit(QPlainTextEdit):
             event.ignore()
             return
 
-        dropped = " ".join(texts)
-        candidates = split_inputs(dropped)
-        normalized = []
-        for c in candidates:
-            c = c.strip()
-            if not c:
-                continue
-            # 浏览器拖拽有时会带标题和 URL 一起，取看起来像链接或 BV/av 号的部分
-            if c.startswith("http://") or c.startswith("https://"):
-                normalized.append(c)
-            elif re.fullmatch(r"BV[0-9A-Za-z]{10,}", c) or re.fullmatch(r"[aA][vV]\d+", c):
-                normalized.append(normalize_input(c))
-            else:
-                # 尝试从一行文本中提取 URL
-                m = re.search(r"(https?://\S+)", c)
-                if m:
-                    normalized.append(m.group(1))
+        # 浏览器拖拽有时会带标题和 URL 一起，取看起来像链接或 BV/av 号的部分
+        normalized = extract_links(" ".join(texts))
 
         if not normalized:
             event.ignore()
@@ -1910,22 +5137,199 @@ class DroppablePlainTextEdit(QPlainTextEdit):
         event.acceptProposedAction()
 
 
+# ==================== 历史封面网格 ====================
+
+class HistoryCoverGrid(QListWidget):
+    """历史记录的封面网格。只在网格可见时为可见格子请求封面，滚出可见区域后取消还没完成的请求。
+
+    封面由 CoverLoader 按格子尺寸在后台解码；内存中最多保留 limit 张，超出时释放最久未显示的。
+    每个格子有独立的编号，新增、删除记录时只改动对应的格子，其它格子已解码的封面保留。
+    """
+
+    CELL = QSize(192, 108)
+    ID_ROLE = Qt.UserRole + 1
+
+    def __init__(self, loader, limit=HISTORY_GRID_CACHE_LIMIT, parent=None):
+        super().__init__(parent)
+        self.setViewMode(QListView.IconMode)
+        self.setResizeMode(QListView.Adjust)
+        self.setMovement(QListView.Static)
+        self.setUniformItemSizes(True)
+        self.setWordWrap(True)
+        self.setIconSize(self.CELL)
+        self.setGridSize(QSize(self.CELL.width() + 16, self.CELL.height() + 48))
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.loader = loader
+        self.limit = limit
+        self.proxy = ""
+        self._next_id = 0
+        self._items = {}  # 格子编号 -> QListWidgetItem
+        self._covers = OrderedDict()  # 已显示封面的格子编号，按最近显示排序
+        self._placeholder = QPixmap(self.CELL)
+        self._placeholder.fill(QColor(226, 232, 240))
+        self._load_timer = QTimer(self)
+        self._load_timer.setSingleShot(True)
+        self._load_timer.setInterval(60)
+        self._load_timer.timeout.connect(self.load_visible)
+        self.verticalScrollBar().valueChanged.connect(lambda _value: self._load_timer.start())
+        self.loader.loaded.connect(self.on_cover_loaded)
+
+    @staticmethod
+    def _key(item_id):
+        return f"grid:{item_id}"
+
+    def _cancel_pending(self, keep=()):
+        keep = {self._key(item_id) for item_id in keep}
+        for key in self.loader.pending():
+            if key.startswith("grid:") and key not in keep:
+                self.loader.cancel(key)
+
+    def _make_item(self, record):
+        title = record.get("title") or record.get("url") or "-"
+        item = QListWidgetItem(QIcon(self._placeholder), title)
+        item.setToolTip(title)
+        item.setData(Qt.UserRole, record.get("thumbnail") or "")
+        item.setData(self.ID_ROLE, self._next_id)
+        self._items[self._next_id] = item
+        self._next_id += 1
+        return item
+
+    def set_records(self, records, proxy=""):
+        self._cancel_pending()
+        self._covers.clear()
+        self._items.clear()
+        self.proxy = proxy
+        self.clear()
+        for r in records:
+            self.addItem(self._make_item(r))
+        self._load_timer.start()
+
+    def insert_record(self, row, record):
+        self.insertItem(row, self._make_item(record))
+        self._load_timer.start()
+
+    def remove_row(self, row):
+        item = self.takeItem(row)
+        if item is None:
+            return
+        item_id = item.data(self.ID_ROLE)
+        self._items.pop(item_id, None)
+        self._covers.pop(item_id, None)
+        self.loader.cancel(self._key(item_id))
+        self._load_timer.start()
+
+    def visible_rows(self):
+        """可见格子的行号范围：取视口左上角和右下角所在的格子，落在空白处时按网格尺寸推算。"""
+        count = self.count()
+        if not count:
+            return []
+        area = self.viewport().rect()
+        grid = self.gridSize()
+        # 格子在网格单元里居中，边缘是空白，沿第一列的中线往下找
+        x = area.left() + min(grid.width() // 2, area.width() - 1)
+        first = -1
+        for dy in range(2, grid.height() + 2, 8):
+            first = self.indexAt(QPoint(x, area.top() + dy)).row()
+            if first >= 0:
+                break
+        first = max(first, 0)
+        last = self.indexAt(area.bottomRight() - QPoint(2, 2)).row()
+        if last < 0:
+            columns = max(1, area.width() // max(1, grid.width()))
+            last = first + columns * (area.height() // max(1, grid.height()) + 2) - 1
+        return list(range(first, min(last, count - 1) + 1))
+
+    def load_visible(self):
+        if not self.isVisible():
+            return
+        visible = {}
+        for row in self.visible_rows():
+            item = self.item(row)
+            visible[item.data(self.ID_ROLE)] = item
+        self._cancel_pending(keep=visible)
+        pending = self.loader.pending()
+        for item_id, item in visible.items():
+            if item_id in self._covers:
+                self._covers.move_to_end(item_id)
+                continue
+            url = item.data(Qt.UserRole)
+            if url and self._key(item_id) not in pending:
+                self.loader.request(self._key(item_id), url, self.CELL.width(), self.CELL.height(), self.proxy)
+
+    def on_cover_loaded(self, key, image):
+        if not key.startswith("grid:") or image.isNull():
+            return
+        item_id = int(key[len("grid:"):])
+        item = self._items.get(item_id)
+        if item is None:
+            return
+        self._covers[item_id] = True
+        item.setIcon(QIcon(QPixmap.fromImage(image)))
+        while len(self._covers) > self.limit:
+            old, _ = self._covers.popitem(last=False)
+            if old in self._items:
+                self._items[old].setIcon(QIcon(self._placeholder))
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._load_timer.start()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self._load_timer.start()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self._load_timer.stop()
+        self._cancel_pending()
+
+
 # ==================== 主窗口 ====================
 
 class MainWindow(QMainWindow):
+    # 后台解析完短链接后把链接和当时的设置快照送回界面线程加入队列
+    short_links_expanded = pyqtSignal(list, dict)
+
     def __init__(self):
         super().__init__()
+        self.short_links_expanded.connect(self.on_short_links_expanded)
         self.settings, load_err = load_settings()
         if load_err:
             print(f"设置加载失败，使用默认设置: {load_err}")
         self.worker = None
         self.preview_worker = None
+        self.import_worker = None
+        # 文件导入期间队列即使暂时跑空也不结束这一批：后续批次继续追加，完成提示等导入结束后再给
+        self.import_active = False
+        self.import_appending = False
+        self.pending_all_done = None
+        self.dedupe_worker = None
+        self.cover_loader = CoverLoader(parent=self)
+        self.cover_loader.loaded.connect(self.on_cover_loaded)
+        # 下载目录被外部改动（手动删除、改名）时延迟一秒重新扫描，保持 LIBRARY 索引准确
+        self.library_watcher = QFileSystemWatcher(self)
+        self.library_watcher.directoryChanged.connect(self.on_library_dir_changed)
+        self.library_dirty = set()
+        self.library_rescan_timer = QTimer(self)
+        self.library_rescan_timer.setSingleShot(True)
+        self.library_rescan_timer.setInterval(1000)
+        self.library_rescan_timer.timeout.connect(self.rescan_library)
+        self.watch_download_dir(self.settings.get("download_dir"))
         self.cookie_check_worker = None
         self.preview_request_id = 0
         self._force_quit = False
         self.preview_pending = False
         self.preview_formats = []
         self.history_records = load_history()
+        restored_entries = load_queue_journal()
+        self.journal = QueueJournal()
+        self.journal.start()
+        self.task_store = TaskStore(journal=self.journal)
+        self.scheduler = TaskScheduler(self.task_store)
+        self.pending_log_lines = []
+        self.log_flush_timer = QTimer(self)
+        self.log_flush_timer.setSingleShot(True)
+        self.log_flush_timer.timeout.connect(self.flush_log_lines)
         self.preview_timer = QTimer(self)
         self.preview_timer.setSingleShot(True)
         self.preview_timer.timeout.connect(self.start_preview)
@@ -1947,8 +5351,17 @@ class MainWindow(QMainWindow):
         self.refresh_history()
         self.init_tray_icon()
         self._setup_shortcuts()
+        self.breaker_label = QLabel()
+        self.breaker_label.setStyleSheet("color: #f59e0b;")
+        self.breaker_label.setVisible(False)
+        self.statusBar().addPermanentWidget(self.breaker_label)
+        self.stages_label = QLabel()
+        self.stages_label.setVisible(False)
+        self.statusBar().addPermanentWidget(self.stages_label)
         self.statusBar().showMessage("就绪")
         self.sound_player.play("click")
+        if restored_entries:
+            QTimer.singleShot(0, lambda: self.restore_queue(restored_entries))
 
     def _app_icon_path(self):
         """返回应用图标路径，优先使用 icon.png，其次 icon.ico。"""
@@ -2466,6 +5879,7 @@ class MainWindow(QMainWindow):
 
         self.log_edit = QPlainTextEdit()
         self.log_edit.setReadOnly(True)
+        self.log_edit.setMaximumBlockCount(LOG_VIEW_MAX_LINES)
         self.log_edit.setMinimumHeight(60)
         self.log_edit.setMaximumHeight(140)
         queue_layout.addWidget(self.log_edit)
@@ -2517,6 +5931,10 @@ class MainWindow(QMainWindow):
         self.history_export_json_btn = QPushButton("导出 JSON")
         self.history_export_json_btn.setObjectName("secondaryBtn")
         self.history_export_json_btn.clicked.connect(lambda: self.export_history("json"))
+        self.history_dedupe_btn = QPushButton("合并重复文件")
+        self.history_dedupe_btn.setObjectName("secondaryBtn")
+        self.history_dedupe_btn.setToolTip("把下载目录中内容完全相同的文件换成硬链接，只占一份空间")
+        self.history_dedupe_btn.clicked.connect(self.dedupe_download_dir)
         action_row.addWidget(self.history_refresh_btn)
         action_row.addWidget(self.history_redownload_btn)
         action_row.addWidget(self.history_open_file_btn)
@@ -2525,7 +5943,13 @@ class MainWindow(QMainWindow):
         action_row.addWidget(self.history_clear_btn)
         action_row.addWidget(self.history_export_csv_btn)
         action_row.addWidget(self.history_export_json_btn)
+        action_row.addWidget(self.history_dedupe_btn)
         action_row.addStretch()
+        self.history_grid_btn = QPushButton("封面视图")
+        self.history_grid_btn.setObjectName("secondaryBtn")
+        self.history_grid_btn.setCheckable(True)
+        self.history_grid_btn.toggled.connect(self.toggle_history_grid)
+        action_row.addWidget(self.history_grid_btn)
         layout.addLayout(action_row)
 
         self.history_table = QTableWidget(0, 7)
@@ -2546,7 +5970,12 @@ class MainWindow(QMainWindow):
         self.history_table.setContextMenuPolicy(Qt.CustomContextMenu)
         self.history_table.customContextMenuRequested.connect(self.show_history_context_menu)
         self.history_table.doubleClicked.connect(self.on_history_double_clicked)
-        layout.addWidget(self.history_table, 1)
+        self.history_grid = HistoryCoverGrid(self.cover_loader)
+        self.history_grid.itemDoubleClicked.connect(lambda _item: self.open_history_file())
+        self.history_view_stack = QStackedWidget()
+        self.history_view_stack.addWidget(self.history_table)
+        self.history_view_stack.addWidget(self.history_grid)
+        layout.addWidget(self.history_view_stack, 1)
         self.content_stack.addWidget(page)
 
     # ---------- 设置页 ----------
@@ -2635,11 +6064,39 @@ class MainWindow(QMainWindow):
         dl_grid.addWidget(self.thread_combo, 1, 3)
 
         self.concurrent_spin = QSpinBox()
-        self.concurrent_spin.setRange(1, 8)
+        self.concurrent_spin.setRange(1, MAX_CONCURRENT_DOWNLOADS)
         self.concurrent_spin.setToolTip("同时下载多个视频的任务数（1=顺序下载，建议 2~4）")
         dl_grid.addWidget(QLabel("任务并发"), 4, 0)
         dl_grid.addWidget(self.concurrent_spin, 4, 1)
 
+        self.stall_floor_spin = QSpinBox()
+        self.stall_floor_spin.setRange(0, 10240)
+        self.stall_floor_spin.setSuffix(" KB/s")
+        self.stall_floor_spin.setSpecialValueText("关闭")
+        self.stall_floor_spin.setToolTip(
+            f"最近 {STALL_WINDOW_SECONDS} 秒平均速度低于此值时断开重连（换备用线路续传），0=关闭")
+        dl_grid.addWidget(QLabel("低速重连"), 4, 2)
+        dl_grid.addWidget(self.stall_floor_spin, 4, 3)
+
+        self.api_concurrency_spin = QSpinBox()
+        self.api_concurrency_spin.setRange(1, 8)
+        self.api_concurrency_spin.setToolTip("同时向 B站接口发出的请求数，过高容易触发 -509 频率限制")
+        dl_grid.addWidget(QLabel("接口并发"), 5, 0)
+        dl_grid.addWidget(self.api_concurrency_spin, 5, 1)
+
+        self.cdn_concurrency_spin = QSpinBox()
+        self.cdn_concurrency_spin.setRange(1, MAX_HOST_CONNECTIONS)
+        self.cdn_concurrency_spin.setToolTip("每个视频服务器（CDN）同时打开的下载连接数上限")
+        dl_grid.addWidget(QLabel("CDN 连接"), 5, 2)
+        dl_grid.addWidget(self.cdn_concurrency_spin, 5, 3)
+
+        self.ffmpeg_workers_spin = QSpinBox()
+        self.ffmpeg_workers_spin.setRange(0, POST_WORKERS)
+        self.ffmpeg_workers_spin.setSpecialValueText("自动")
+        self.ffmpeg_workers_spin.setToolTip("同时运行的 ffmpeg 合并进程数，0=按 CPU 核数；ffmpeg 以低优先级运行")
+        dl_grid.addWidget(QLabel("合并进程"), 6, 0)
+        dl_grid.addWidget(self.ffmpeg_workers_spin, 6, 1)
+
         self.custom_format_edit = QLineEdit()
         self.custom_format_edit.setReadOnly(True)
         self.custom_format_edit.setPlaceholderText("在预览格式表选中一行后点击\"使用这个格式\"")
@@ -2688,9 +6145,21 @@ class MainWindow(QMainWindow):
         self.thumbnail_check = QCheckBox("下载封面")
         self.subtitle_check = QCheckBox("下载字幕")
         self.danmaku_check = QCheckBox("下载弹幕(B站)")
+        self.ytdlp_subprocess_check = QCheckBox("独立进程运行 yt-dlp")
+        self.ytdlp_subprocess_check.setToolTip("取消任务时可立即结束解析和合并，启动略慢")
+        self.keep_partial_check = QCheckBox("取消时保留未完成文件")
+        self.keep_partial_check.setToolTip("保留 .part 等可续传的临时文件，重试时接着下载")
+        self.skip_archived_check = QCheckBox("跳过已下载")
+        self.skip_archived_check.setToolTip("下载目录或历史中已有同一视频且画质不低于这次设置时不再下载")
+        self.dedupe_check = QCheckBox("合并重复文件")
+        self.dedupe_check.setToolTip("下载完成后如果目录里已有内容相同的文件，换成硬链接节省空间")
         extra_row.addWidget(self.thumbnail_check)
         extra_row.addWidget(self.subtitle_check)
         extra_row.addWidget(self.danmaku_check)
+        extra_row.addWidget(self.ytdlp_subprocess_check)
+        extra_row.addWidget(self.keep_partial_check)
+        extra_row.addWidget(self.skip_archived_check)
+        extra_row.addWidget(self.dedupe_check)
         extra_row.addStretch()
         extra_layout.addLayout(extra_row)
         layout.addWidget(extra_card)
@@ -3086,11 +6555,20 @@ class MainWindow(QMainWindow):
         self.set_combo_value(self.quality_combo, self.settings.get("quality", "best"))
         self.set_combo_value(self.cookie_mode_combo, self.settings.get("cookie_mode", "none"))
         self.set_combo_value(self.thread_combo, int(self.settings.get("fragment_threads", 4)))
+        self.concurrent_spin.setValue(int(self.settings.get("concurrent_downloads", 1)))
+        self.stall_floor_spin.setValue(int(self.settings.get("stall_speed_floor_kb", 20)))
+        self.api_concurrency_spin.setValue(int(self.settings.get("api_concurrency", 2)))
+        self.cdn_concurrency_spin.setValue(int(self.settings.get("cdn_concurrency", 16)))
+        self.ffmpeg_workers_spin.setValue(int(self.settings.get("ffmpeg_workers", 0)))
         self.set_combo_value(self.codec_combo, self.settings.get("codec_preference", "auto"))
         self.set_combo_value(self.audio_quality_combo, self.settings.get("audio_quality", "auto"))
         self.thumbnail_check.setChecked(bool(self.settings.get("download_thumbnail", False)))
         self.subtitle_check.setChecked(bool(self.settings.get("download_subtitle", False)))
         self.danmaku_check.setChecked(bool(self.settings.get("download_danmaku", False)))
+        self.ytdlp_subprocess_check.setChecked(bool(self.settings.get("ytdlp_subprocess", False)))
+        self.keep_partial_check.setChecked(bool(self.settings.get("keep_partial_on_cancel", False)))
+        self.skip_archived_check.setChecked(bool(self.settings.get("skip_archived", True)))
+        self.dedupe_check.setChecked(bool(self.settings.get("dedupe_downloads")))
         self.sakura_check.setChecked(bool(self.settings.get("fx_sakura", True)))
         self.neon_check.setChecked(bool(self.settings.get("fx_neon", True)))
         self.sound_check.setChecked(bool(self.settings.get("fx_sound", True)))
@@ -3114,11 +6592,19 @@ class MainWindow(QMainWindow):
             "filename_template": self.template_edit.text().strip() or DEFAULT_SETTINGS["filename_template"],
             "fragment_threads": self.thread_combo.currentData(),
             "concurrent_downloads": self.concurrent_spin.value(),
+            "stall_speed_floor_kb": self.stall_floor_spin.value(),
+            "api_concurrency": self.api_concurrency_spin.value(),
+            "cdn_concurrency": self.cdn_concurrency_spin.value(),
+            "ffmpeg_workers": self.ffmpeg_workers_spin.value(),
             "codec_preference": self.codec_combo.currentData(),
             "audio_quality": self.audio_quality_combo.currentData(),
             "download_thumbnail": self.thumbnail_check.isChecked(),
             "download_subtitle": self.subtitle_check.isChecked(),
             "download_danmaku": self.danmaku_check.isChecked(),
+            "ytdlp_subprocess": self.ytdlp_subprocess_check.isChecked(),
+            "keep_partial_on_cancel": self.keep_partial_check.isChecked(),
+            "skip_archived": self.skip_archived_check.isChecked(),
+            "dedupe_downloads": self.dedupe_check.isChecked(),
             "fx_sakura": self.sakura_check.isChecked(),
             "fx_neon": self.neon_check.isChecked(),
             "fx_sound": self.sound_check.isChecked(),
@@ -3248,14 +6734,13 @@ class MainWindow(QMainWindow):
     # ---------- 预览 ----------
 
     def schedule_preview(self):
-        if self.worker and self.worker.isRunning():
-            return
+        # 短链接在输入时就开始后台解析，开始下载时通常已经有结果
+        SHORT_LINKS.prefetch(split_inputs(self.input_edit.toPlainText()),
+                             (self.settings.get("proxy") or "").strip())
         self.preview_pending = True
         self.preview_timer.start(800)
 
     def start_preview(self, force=False):
-        if self.worker and self.worker.isRunning():
-            return
         if self.sound_player:
             self.sound_player.play("click")
         text = self.input_edit.toPlainText()
@@ -3267,6 +6752,13 @@ class MainWindow(QMainWindow):
         if not force and not self.preview_pending:
             return
         self.preview_pending = False
+        settings = self.collect_settings()
+        running = self.preview_worker if self.preview_worker and self.preview_worker.isRunning() else None
+        if running and running.matches(url, settings):
+            # 同一链接正在解析，等待它的结果即可
+            return
+        if running:
+            running.abort()
         self.preview_request_id += 1
         rid = self.preview_request_id
         self.preview_btn.setEnabled(False)
@@ -3274,7 +6766,7 @@ class MainWindow(QMainWindow):
         self.preview_note_label.setText("如果是批量链接，这里预览第一个。")
         self.formats_table.setRowCount(0)
         self.use_format_btn.setEnabled(False)
-        self.preview_worker = PreviewWorker(rid, url, self.collect_settings(), self)
+        self.preview_worker = PreviewWorker(rid, url, settings, self)
         self.preview_worker.info_ready.connect(self.on_preview_ready)
         self.preview_worker.failed.connect(self.on_preview_failed)
         self.preview_worker.finished.connect(self.on_preview_finished)
@@ -3300,6 +6792,7 @@ class MainWindow(QMainWindow):
         if thumb_url:
             self._load_thumbnail(thumb_url)
         else:
+            self.cover_loader.cancel("preview")
             self.cover_label.setText("暂无封面")
             self.cover_label.setPixmap(QPixmap())
         self.fill_formats_table(self.preview_formats)
@@ -3322,23 +6815,45 @@ class MainWindow(QMainWindow):
         QMessageBox.warning(self, "解析失败", f"无法解析该链接：\n\n{msg}\n\n请检查：\n1. 链接是否正确\n2. 是否需要配置 Cookie\n3. 网络是否连接正常")
 
     def on_preview_finished(self):
-        self.preview_btn.setEnabled(True)
+        # 被取代的旧预览结束时新预览可能还在进行
+        if self.sender() in (None, self.preview_worker):
+            self.preview_btn.setEnabled(True)
 
     def _load_thumbnail(self, url):
-        try:
-            proxy = (self.settings.get("proxy") or "").strip()
-            proxies = {"http": proxy, "https": proxy} if proxy else None
-            resp = requests.get(url, headers=std_headers(), timeout=10, proxies=proxies)
-            resp.raise_for_status()
-            pixmap = QPixmap()
-            pixmap.loadFromData(resp.content)
-            if not pixmap.isNull():
-                self.cover_label.setPixmap(pixmap.scaled(220, 124, Qt.KeepAspectRatio, Qt.SmoothTransformation))
-                return
-        except Exception:
-            pass
-        self.cover_label.setText("封面加载失败")
+        """在后台加载预览封面，结果由 on_cover_loaded 显示。"""
         self.cover_label.setPixmap(QPixmap())
+        self.cover_label.setText("封面加载中...")
+        proxy = (self.settings.get("proxy") or "").strip()
+        size = self.cover_label.size()
+        self.cover_loader.request("preview", url, size.width(), size.height(), proxy)
+
+    def watch_download_dir(self, folder):
+        folder = str(folder or "")
+        watched = self.library_watcher.directories()
+        if folder in watched or not folder or not os.path.isdir(folder):
+            return
+        if watched:
+            self.library_watcher.removePaths(watched)
+        self.library_watcher.addPath(folder)
+
+    def on_library_dir_changed(self, folder):
+        self.library_dirty.add(folder)
+        self.library_rescan_timer.start()
+
+    def rescan_library(self):
+        folders, self.library_dirty = self.library_dirty, set()
+        for folder in folders:
+            if LIBRARY.indexed(folder):
+                threading.Thread(target=LIBRARY.rescan, args=(folder,), daemon=True).start()
+
+    def on_cover_loaded(self, key, image):
+        if key != "preview":
+            return
+        if image.isNull():
+            self.cover_label.setText("封面加载失败")
+            self.cover_label.setPixmap(QPixmap())
+            return
+        self.cover_label.setPixmap(QPixmap.fromImage(image))
 
     def fill_formats_table(self, formats):
         self.formats_table.setRowCount(0)
@@ -3445,6 +6960,8 @@ class MainWindow(QMainWindow):
         self.select_all_pages_btn.setEnabled(True)
 
     def clear_preview(self):
+        if self.preview_worker and self.preview_worker.isRunning():
+            self.preview_worker.abort()
         self.preview_title_label.setText("粘贴链接后自动解析")
         self.preview_uploader_label.setText("-")
         self.preview_duration_label.setText("-")
@@ -3453,6 +6970,7 @@ class MainWindow(QMainWindow):
         self.preview_source_label.setText("-")
         self.preview_url_label.setText("-")
         self.preview_note_label.setText("-")
+        self.cover_loader.cancel("preview")
         self.cover_label.setText("暂无封面")
         self.cover_label.setPixmap(QPixmap())
         self.formats_table.setRowCount(0)
@@ -3503,28 +7021,97 @@ class MainWindow(QMainWindow):
         self.statusBar().showMessage("已清空输入", 2000)
 
     def import_links_from_file(self):
-        """从 .txt 文件导入链接列表。"""
+        """从 .txt 文件导入链接列表：后台逐行读取，去重后直接加入下载队列，不经过输入框。"""
+        if self.import_worker and self.import_worker.isRunning():
+            QMessageBox.information(self, "提示", "上一个文件还在导入中。")
+            return
+        if self.worker_cancelling():
+            QMessageBox.warning(self, "提示", "正在取消当前任务，请稍候再试。")
+            return
         path, _ = QFileDialog.getOpenFileName(
             self, "导入链接文件", "", "文本文件 (*.txt);;所有文件 (*)"
         )
         if not path:
             return
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                content = f.read()
-            urls = split_inputs(content)
-            if not urls:
-                QMessageBox.information(self, "提示", "文件中未找到有效链接。")
-                return
-            existing = self.input_edit.toPlainText().strip()
-            if existing:
-                self.input_edit.setPlainText(existing + "\n" + "\n".join(urls))
-            else:
-                self.input_edit.setPlainText("\n".join(urls))
-            self.statusBar().showMessage(f"已导入 {len(urls)} 条链接", 3000)
-            self.append_log(f"从文件导入 {len(urls)} 条链接: {path}")
-        except Exception as exc:
-            QMessageBox.warning(self, "导入失败", f"读取文件失败：\n{format_error(exc)}")
+        if not self.prepare_downloads():
+            return
+        known = self.known_input_keys()
+        proxy = (self.settings.get("proxy") or "").strip()
+        self.import_links_btn.setEnabled(False)
+        self.append_log(f"开始从文件导入链接: {path}")
+        self.import_active = True
+        self.import_appending = False
+        self.import_worker = LinkImportWorker(path, known, proxy, self)
+        self.import_worker.batch_ready.connect(self.on_import_batch)
+        self.import_worker.progress.connect(self.on_import_progress)
+        self.import_worker.summary.connect(self.on_import_summary)
+        self.import_worker.failed.connect(
+            lambda msg: QMessageBox.warning(self, "导入失败", f"读取文件失败：\n{msg}"))
+        self.import_worker.finished.connect(self.on_import_finished)
+        self.import_worker.start()
+
+    def known_input_keys(self):
+        """队列中等待/下载中的任务和历史中已完成的视频，用于导入时去重。"""
+        keys = self.queued_input_keys()
+        for record in load_history():
+            if record.get("status") == "completed" and record.get("url"):
+                keys.add(input_key(record["url"]))
+        return keys
+
+    def on_import_batch(self, urls):
+        # 第一批可以开始新的一批任务，之后的批次总是追加到同一批
+        self.enqueue_urls(urls, dedupe=False, append=self.import_appending)
+        self.import_appending = True
+        if self.sender() is not None:
+            self.sender().ack()
+
+    def on_import_progress(self, done, total, added):
+        pct = done / total * 100 if total else 100
+        self.statusBar().showMessage(f"导入链接 {pct:.0f}%，已加入 {added} 个任务")
+
+    def on_import_finished(self):
+        self.import_links_btn.setEnabled(True)
+        self.import_active = False
+        ok, self.pending_all_done = self.pending_all_done, None
+        if ok is not None and not self.queue_busy():
+            self.on_all_done(ok)
+
+    def on_import_summary(self, stats):
+        text = (f"读取 {stats['lines']} 行，识别 {stats['links']} 个链接：加入队列 {stats['added']} 个，"
+                f"跳过重复 {stats['duplicates']} 个，无法识别 {stats['invalid']} 行")
+        if stats.get("interrupted"):
+            text = "导入已中断。" + text
+        self.append_log(text)
+        self.statusBar().showMessage(text, 8000)
+        if not stats["links"]:
+            QMessageBox.information(self, "提示", "文件中未找到有效链接。")
+
+    def dedupe_download_dir(self):
+        if self.dedupe_worker and self.dedupe_worker.isRunning():
+            return
+        folder = self.dir_edit.text().strip() or str(DEFAULT_DOWNLOAD_DIR)
+        if not os.path.isdir(folder):
+            QMessageBox.information(self, "提示", f"下载目录不存在：\n{folder}")
+            return
+        self.history_dedupe_btn.setEnabled(False)
+        self.append_log(f"开始合并重复文件: {folder}")
+        self.dedupe_worker = DedupeWorker(folder, self)
+        self.dedupe_worker.progress.connect(
+            lambda done, total: self.statusBar().showMessage(f"检查重复文件 {done}/{total}"))
+        self.dedupe_worker.summary.connect(self.on_dedupe_summary)
+        self.dedupe_worker.failed.connect(
+            lambda msg: QMessageBox.warning(self, "合并失败", f"合并重复文件失败：\n{msg}"))
+        self.dedupe_worker.finished.connect(lambda: self.history_dedupe_btn.setEnabled(True))
+        self.dedupe_worker.start()
+
+    def on_dedupe_summary(self, stats):
+        linked, saved = DEDUPER.totals()
+        text = (f"检查 {stats['checked']} 个大小相同的文件，合并 {stats['linked']} 个，"
+                f"节省 {format_bytes(stats['saved_bytes'])}（累计 {linked} 个，{format_bytes(saved)}）")
+        if stats.get("interrupted"):
+            text = "合并已中断。" + text
+        self.append_log(text)
+        self.statusBar().showMessage(text, 8000)
 
     # ---------- 下载 ----------
 
@@ -3540,9 +7127,18 @@ class MainWindow(QMainWindow):
             pass
         return ""
 
+    def queue_busy(self):
+        """下载队列是否还有等待或运行中的任务。"""
+        return bool(self.worker and self.worker.isRunning() and not self.worker.cancelled
+                    and self.scheduler.busy)
+
+    def worker_cancelling(self):
+        """上一批已取消但下载线程还没退出。"""
+        return bool(self.worker and self.worker.isRunning() and self.worker.cancelled)
+
     def start_downloads(self):
-        if self.worker and self.worker.isRunning():
-            QMessageBox.warning(self, "提示", "当前已有下载任务在进行。")
+        if self.worker_cancelling():
+            QMessageBox.warning(self, "提示", "正在取消当前任务，请稍候再试。")
             return
         if self.sound_player:
             self.sound_player.play("start")
@@ -3551,6 +7147,35 @@ class MainWindow(QMainWindow):
         if not urls:
             QMessageBox.information(self, "提示", "请输入要下载的链接。")
             return
+        if not self.prepare_downloads():
+            return
+        urls = [normalize_input(u) for u in urls]
+        proxy = (self.settings.get("proxy") or "").strip()
+        pending = SHORT_LINKS.prefetch(urls, proxy)
+        if not pending:
+            # 短链接都已缓存，不会发请求
+            self.enqueue_urls(SHORT_LINKS.expand(urls, proxy))
+            return
+        self.statusBar().showMessage(f"正在解析 {len(pending)} 个短链接...")
+        settings = dict(self.settings)
+
+        def expand():
+            expanded = SHORT_LINKS.expand(urls, proxy)
+            try:
+                self.short_links_expanded.emit(expanded, settings)
+            except RuntimeError:
+                pass  # 窗口已关闭
+
+        threading.Thread(target=expand, name="shortlink-expand", daemon=True).start()
+
+    def on_short_links_expanded(self, urls, settings):
+        if self._force_quit:
+            return
+        self.statusBar().clearMessage()
+        self.enqueue_urls(urls, settings=settings)
+
+    def prepare_downloads(self):
+        """加入队列前保存设置、创建下载目录并检查 Cookie；返回是否继续。"""
         self.settings = self.collect_settings()
         ok, err = save_settings(self.settings)
         if not ok:
@@ -3560,7 +7185,8 @@ class MainWindow(QMainWindow):
             Path(download_dir).mkdir(parents=True, exist_ok=True)
         except Exception as e:
             QMessageBox.warning(self, "目录创建失败", f"无法创建下载目录：\n{download_dir}\n\n{e}")
-            return
+            return False
+        self.watch_download_dir(download_dir)
         cookie_err = self.check_cookie_settings()
         if cookie_err:
             ret = QMessageBox.question(
@@ -3569,39 +7195,122 @@ class MainWindow(QMainWindow):
                 QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes,
             )
             if ret != QMessageBox.Yes:
+                return False
+        return True
+
+    def queued_input_keys(self):
+        """队列中等待或下载中的任务的 input_key 集合。"""
+        keys = set()
+        if self.queue_busy():
+            for task in self.task_store.tasks:
+                if task.status in (TaskStatus.WAITING, TaskStatus.RUNNING):
+                    keys.add(input_key(task.url))
+        return keys
+
+    def dedupe_inputs(self, urls):
+        """去掉本次输入中重复的链接，以及队列里已在等待或下载中的同一视频（按规范键判断，不请求接口）。"""
+        seen = self.queued_input_keys()
+        unique = []
+        for url in urls:
+            key = input_key(url)
+            if key in seen:
+                continue
+            seen.add(key)
+            unique.append(url)
+        return unique
+
+    def enqueue_urls(self, urls, dedupe=True, settings=None, append=False):
+        """把链接加入下载队列：队列空闲时开始新的一批，运行中则直接追加到队尾。
+
+        dedupe=False 用于调用方已经去过重的情况（如文件导入），省去逐个比对队列；
+        settings 为这些任务的设置快照，默认用当前设置；append=True 时即使队列已经跑空
+        也追加到当前这一批（文件导入的后续批次），不清空表格。
+        """
+        if dedupe:
+            unique = self.dedupe_inputs(urls)
+            if len(unique) < len(urls):
+                self.append_log(f"已跳过 {len(urls) - len(unique)} 个重复链接")
+            if not unique:
+                self.statusBar().showMessage("这些视频已在队列中", 3000)
                 return
+            urls = unique
+        busy = self.queue_busy() or append
+        if not busy:
+            self.table.setSortingEnabled(False)
+            self.table.setRowCount(0)
+            self.task_store.reset(())
+            self.scheduler.reset()
+            self.progress_bar.setValue(0)
+        indexes = self.task_store.add(urls, settings or self.settings)
+        self.table.setRowCount(len(self.task_store))
+        for index in indexes:
+            self.render_task(index)
+            self.scheduler.submit(index)
+        if busy:
+            self.append_log(f"已加入队列: {len(indexes)} 个任务")
+        self.begin_queue(busy)
+
+    def restore_task_order(self):
+        """空闲期间表格可能被排序过，关闭排序并重绘，恢复为行号即任务序号。"""
+        self.table.setSortingEnabled(False)
+        for index in range(len(self.task_store)):
+            self.render_task(index)
+
+    def restore_queue(self, entries):
+        """把队列日志中上次未完成的任务作为新的一批重新加入并继续下载。"""
+        if self.queue_busy():
+            return
         self.table.setSortingEnabled(False)
         self.table.setRowCount(0)
-        for i, url in enumerate(urls):
-            url = normalize_input(url)
-            self.table.insertRow(i)
-            self.set_cell(i, 0, url)
-            self.set_cell(i, 1, "等待")
-            self.set_cell(i, 2, "0%")
-            self.set_cell(i, 3, "")
-        self.start_btn.setEnabled(False)
+        self.task_store.reset(())
+        self.scheduler.reset()
+        self.progress_bar.setValue(0)
+        for entry in entries:
+            index = self.task_store.add([entry["url"]], entry.get("settings") or self.settings)[0]
+            task = self.task_store.get(index)
+            task.priority = entry.get("priority") or 0
+            task.restored = True
+            for path, resumable in (entry.get("temp_files") or {}).items():
+                self.task_store.register_temp_file(index, path, resumable)
+            done, total = entry.get("downloaded") or 0, entry.get("total") or 0
+            if total:
+                self.task_store.update_progress(index, done / total * 100, "已恢复，等待续传", done, total)
+            self.table.setRowCount(index + 1)
+            self.render_task(index)
+            self.scheduler.submit(index)
+        self.append_log(f"已恢复上次未完成的 {len(entries)} 个任务")
+        self.begin_queue(False)
+
+    def begin_queue(self, was_busy):
+        """切换到运行状态，必要时启动常驻下载线程。从空闲开始时同步最新设置。"""
+        if not was_busy and self.worker and self.worker.isRunning():
+            self.worker.settings = self.settings
+        self.start_btn.setText("加入队列")
         self.pause_btn.setEnabled(True)
         self.cancel_btn.setEnabled(True)
         self.set_controls_enabled(False)
-        self.progress_bar.setValue(0)
         self.statusBar().showMessage("下载中...")
-        self.worker = DownloadWorker(urls, self.settings, self)
-        self.worker.item_started.connect(self.on_item_started)
-        self.worker.item_progress.connect(self.on_item_progress)
-        self.worker.item_finished.connect(self.on_item_finished)
-        self.worker.item_failed.connect(self.on_item_failed)
-        self.worker.item_history.connect(self.on_item_history)
-        self.worker.log.connect(self.append_log)
-        self.worker.all_done.connect(self.on_all_done)
-        self.worker.paused_changed.connect(self.on_queue_paused_changed)
-        self.worker.start()
+        if not (self.worker and self.worker.isRunning()):
+            self.worker = DownloadWorker(self.settings, self.task_store, self.scheduler, self)
+            self.worker.item_started.connect(self.on_item_started)
+            self.worker.items_progress.connect(self.on_items_progress)
+            self.worker.item_finished.connect(self.on_item_finished)
+            self.worker.item_failed.connect(self.on_item_failed)
+            self.worker.item_history.connect(self.on_item_history)
+            self.worker.log.connect(self.append_log)
+            self.worker.all_done.connect(self.on_all_done)
+            self.worker.paused_changed.connect(self.on_queue_paused_changed)
+            self.worker.breaker_changed.connect(self.on_breaker_changed)
+            self.worker.stages_changed.connect(self.on_stages_changed)
+            self.worker.start()
+        self._update_progress_bar()
+        self.update_window_title()
 
     def set_controls_enabled(self, enabled):
-        self.input_edit.setEnabled(enabled)
-        self.preview_btn.setEnabled(enabled)
-        self.use_format_btn.setEnabled(enabled and bool(self.formats_table.selectionModel().selectedRows()))
-        self.add_pages_btn.setEnabled(enabled and self.pages_table.isVisible())
-        self.select_all_pages_btn.setEnabled(enabled and self.pages_table.isVisible())
+        """下载设置在一批任务运行期间锁定；输入框、预览和格式/分 P 选择始终可用，以便随时追加任务。"""
+        self.use_format_btn.setEnabled(bool(self.formats_table.selectionModel().selectedRows()))
+        self.add_pages_btn.setEnabled(self.pages_table.isVisible())
+        self.select_all_pages_btn.setEnabled(self.pages_table.isVisible())
         self.dir_btn.setEnabled(enabled)
         self.cookie_mode_combo.setEnabled(enabled)
         self.cookie_file_btn.setEnabled(enabled)
@@ -3610,11 +7319,19 @@ class MainWindow(QMainWindow):
         self.audio_quality_combo.setEnabled(enabled)
         self.thread_combo.setEnabled(enabled)
         self.concurrent_spin.setEnabled(enabled)
+        self.stall_floor_spin.setEnabled(enabled)
+        self.api_concurrency_spin.setEnabled(enabled)
+        self.cdn_concurrency_spin.setEnabled(enabled)
+        self.ffmpeg_workers_spin.setEnabled(enabled)
         self.proxy_edit.setEnabled(enabled)
         self.template_edit.setEnabled(enabled)
         self.thumbnail_check.setEnabled(enabled)
         self.subtitle_check.setEnabled(enabled)
         self.danmaku_check.setEnabled(enabled)
+        self.ytdlp_subprocess_check.setEnabled(enabled)
+        self.keep_partial_check.setEnabled(enabled)
+        self.skip_archived_check.setEnabled(enabled)
+        self.dedupe_check.setEnabled(enabled)
         self.qr_login_btn.setEnabled(enabled)
         self.check_cookie_btn.setEnabled(enabled)
 
@@ -3625,54 +7342,72 @@ class MainWindow(QMainWindow):
         else:
             self.table.setItem(row, col, QTableWidgetItem(text))
 
-    def on_item_started(self, index, url):
-        if index >= self.table.rowCount():
+    def render_task(self, index):
+        """按 TaskStore 中的状态刷新队列表的一行（运行期间行号即任务序号）。"""
+        task = self.task_store.get(index)
+        if task is None or index >= self.table.rowCount():
+            return
+        self.set_cell(index, 0, task.title or task.url)
+        self.table.item(index, 0).setData(Qt.UserRole, index)
+        self.set_cell(index, 1, task.status_label())
+        if task.status == TaskStatus.WAITING:
+            progress = task.detail or "0%"
+        elif task.status == TaskStatus.DONE:
+            progress = "100%"
+        elif task.status == TaskStatus.REMOVED:
+            progress = "-"
+        elif task.finished:
+            progress = task.error
+        else:
+            progress = task.detail or f"{task.percent:.1f}%"
+        self.set_cell(index, 2, progress)
+        self.set_cell(index, 3, task.output_detail)
+
+    def task_index_at_row(self, row):
+        """表格行号 → 任务序号（排序后两者可能不同）。"""
+        item = self.table.item(row, 0)
+        if item is None:
+            return -1
+        index = item.data(Qt.UserRole)
+        return index if isinstance(index, int) else -1
+
+    def on_item_started(self, index):
+        task = self.task_store.get(index)
+        if task is None:
             return
-        self.set_cell(index, 0, url)
-        self.set_cell(index, 1, "下载中")
-        self.set_cell(index, 2, "0%")
-        self.statusBar().showMessage(f"下载中: {url}")
+        self.render_task(index)
+        self.statusBar().showMessage(f"下载中: {task.url}")
         self.update_window_title()
 
-    def on_item_progress(self, index, percent, detail):
-        if index >= self.table.rowCount():
-            return
-        self.set_cell(index, 2, detail)
-        if percent >= 0:
-            # 计算总进度 = 已完成任务数/总数 + 当前任务百分比/总数
-            total = self.table.rowCount() or 1
-            finished = sum(1 for r in range(total) if self.table.item(r, 1) and self.table.item(r, 1).text() in ("完成", "完成（公开视频兜底）"))
-            current = max(0.0, min(100.0, percent)) / 100.0
-            overall = (finished + current) / total * 100
-            self.progress_bar.setValue(int(overall))
-            self.update_window_title()
+    def on_items_progress(self, batch):
+        """处理下载线程批量推送的进度通知：batch 为有变化的任务序号列表。"""
+        for index in batch:
+            if self.task_store.status(index) == TaskStatus.RUNNING:
+                self.render_task(index)
+        self._update_progress_bar()
 
-    def on_item_finished(self, index, output_detail, status_text):
-        if index >= self.table.rowCount():
+    def on_item_finished(self, index):
+        task = self.task_store.get(index)
+        if task is None:
             return
-        if self.sound_player and (status_text or "完成") == "完成":
+        if self.sound_player and not task.note:
             self.sound_player.play("success2")
-        self.set_cell(index, 1, status_text or "完成")
-        self.set_cell(index, 2, "100%")
-        self.set_cell(index, 3, output_detail)
+        self.render_task(index)
         self._update_progress_bar()
         self.update_window_title()
 
-    def on_item_failed(self, index, error):
-        if index >= self.table.rowCount():
+    def on_item_failed(self, index):
+        task = self.task_store.get(index)
+        if task is None:
             return
-        if self.sound_player:
+        if self.sound_player and task.status == TaskStatus.FAILED:
             self.sound_player.play("fail")
-        self.set_cell(index, 1, "失败")
-        self.set_cell(index, 2, error)
+        self.render_task(index)
         self._update_progress_bar()
         self.update_window_title()
 
     def _update_progress_bar(self):
-        total = self.table.rowCount() or 1
-        finished = sum(1 for r in range(total) if self.table.item(r, 1) and self.table.item(r, 1).text() in ("完成", "完成（公开视频兜底）", "失败"))
-        overall = finished / total * 100
-        self.progress_bar.setValue(int(overall))
+        self.progress_bar.setValue(int(self.task_store.overall_percent()))
 
     def update_window_title(self):
         """根据当前下载状态更新窗口标题和标题栏标签。"""
@@ -3684,9 +7419,8 @@ class MainWindow(QMainWindow):
                 self.title_label.setText(title)
             self._update_mascot_by_state("idle")
             return
-        running = self.worker and self.worker.isRunning() and not self.worker.cancelled
-        if running:
-            done = sum(1 for r in range(total) if self.table.item(r, 1) and self.table.item(r, 1).text() in ("完成", "完成（公开视频兜底）", "失败"))
+        if self.queue_busy():
+            done = self.task_store.finished_count()
             if self.worker.paused:
                 title = f"{self.base_window_title} - 已暂停 ({done}/{total})"
                 self._update_mascot_by_state("paused")
@@ -3697,8 +7431,8 @@ class MainWindow(QMainWindow):
             if hasattr(self, "title_label"):
                 self.title_label.setText(title)
             return
-        failed = sum(1 for r in range(total) if self.table.item(r, 1) and self.table.item(r, 1).text() == "失败")
-        cancelled = sum(1 for r in range(total) if self.table.item(r, 1) and self.table.item(r, 1).text() == "已取消")
+        failed = self.task_store.count(TaskStatus.FAILED)
+        cancelled = self.task_store.count(TaskStatus.CANCELLED)
         if cancelled:
             title = f"{self.base_window_title} - 已取消"
             self._update_mascot_by_state("cancelled")
@@ -3727,14 +7461,37 @@ class MainWindow(QMainWindow):
         self.mascot_bubble.setText(random.choice(lines.get(state, lines["idle"])))
 
     def on_item_history(self, record):
+        """新记录插到表格和封面网格的最前面，不重建整个历史页。"""
         append_history_record(record)
         self.history_records = load_history()
-        self.refresh_history()
+        if not self.history_records:
+            return
+        sorting = self.history_table.isSortingEnabled()
+        self.history_table.setSortingEnabled(False)
+        self.history_table.insertRow(0)
+        self.fill_history_row(0, self.history_records[0])
+        # 历史记录有条数上限，超出的旧记录已从文件里删除
+        while self.history_table.rowCount() > len(self.history_records):
+            self.history_table.removeRow(self.history_table.rowCount() - 1)
+        self.history_table.setSortingEnabled(sorting)
+        self.history_grid.insert_record(0, self.history_records[0])
+        while self.history_grid.count() > len(self.history_records):
+            self.history_grid.remove_row(self.history_grid.count() - 1)
 
     def on_all_done(self, ok):
+        if self.queue_busy():
+            # 通知发出后又有新任务加入，这一批还没结束
+            return
+        if self.import_active:
+            # 文件还在导入，后面还会有任务加入；导入结束后再收尾
+            self.pending_all_done = ok
+            return
+        self.pending_all_done = None
+        if self.worker and self.worker.paused:
+            self.worker.resume()
         if self.sound_player:
             self.sound_player.play("complete" if ok else "fail")
-        self.start_btn.setEnabled(True)
+        self.start_btn.setText("开始下载吧")
         self.pause_btn.setEnabled(False)
         self.cancel_btn.setEnabled(False)
         self.pause_btn.setText("暂停一下")
@@ -3743,13 +7500,10 @@ class MainWindow(QMainWindow):
         self.update_window_title()
         # 打开目录：取第一个成功任务的目录
         output_dir = ""
-        for r in range(self.table.rowCount()):
-            detail = self.table.item(r, 3)
-            if detail and detail.text():
-                p = Path(detail.text())
-                if p.exists():
-                    output_dir = str(p.parent)
-                    break
+        for task in self.task_store.tasks:
+            if task.status == TaskStatus.DONE and task.output_path and Path(task.output_path).exists():
+                output_dir = str(Path(task.output_path).parent)
+                break
         if not output_dir:
             output_dir = self.settings.get("download_dir") or DEFAULT_DOWNLOAD_DIR
         if ok:
@@ -3765,11 +7519,10 @@ class MainWindow(QMainWindow):
             if reply == QMessageBox.Open:
                 open_path_in_explorer(output_dir)
         else:
-            failed_rows = [r for r in range(self.table.rowCount())
-                           if self.table.item(r, 1) and self.table.item(r, 1).text() == "失败"]
+            failed_count = self.task_store.count(TaskStatus.FAILED)
             msg = "任务结束（有失败或取消）"
-            if failed_rows:
-                msg += f"\n失败任务数：{len(failed_rows)}"
+            if failed_count:
+                msg += f"\n失败任务数：{failed_count}"
             self.statusBar().showMessage(msg.replace("\n", " "))
             self.show_tray_message("下载结束", "有任务失败或被取消")
 
@@ -3783,6 +7536,9 @@ class MainWindow(QMainWindow):
     def cancel_downloads(self):
         if self.sound_player:
             self.sound_player.play("click")
+        if self.import_worker and self.import_worker.isRunning():
+            # 取消整批任务时也停止导入，剩下的链接不再加入
+            self.import_worker.requestInterruption()
         if self.worker and self.worker.isRunning():
             self.statusBar().showMessage("正在取消...")
             self.worker.cancel()
@@ -3804,6 +7560,14 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage("队列已暂停")
         self.update_window_title()
 
+    def on_stages_changed(self, text):
+        self.stages_label.setText(text)
+        self.stages_label.setVisible(self.queue_busy())
+
+    def on_breaker_changed(self, text):
+        self.breaker_label.setText(text)
+        self.breaker_label.setVisible(bool(text))
+
     def on_queue_paused_changed(self, paused):
         if paused:
             self.pause_btn.setText("继续下载")
@@ -3813,11 +7577,21 @@ class MainWindow(QMainWindow):
 
     def append_log(self, msg):
         ts = time.strftime("%H:%M:%S")
-        line = f"[{ts}] {msg}"
-        self.log_edit.appendPlainText(line)
+        self.pending_log_lines.append(f"[{ts}] {msg}")
+        if not self.log_flush_timer.isActive():
+            self.log_flush_timer.start(LOG_VIEW_FLUSH_MS)
         write_runtime_log(msg)
 
+    def flush_log_lines(self):
+        """把积攒的日志一次性追加到日志区，超出 LOG_VIEW_MAX_LINES 的旧行自动丢弃。"""
+        if not self.pending_log_lines:
+            return
+        lines = self.pending_log_lines[-LOG_VIEW_MAX_LINES:]
+        self.pending_log_lines = []
+        self.log_edit.appendPlainText("\n".join(lines))
+
     def log_edit_clear(self):
+        self.pending_log_lines = []
         self.log_edit.clear()
 
     # ---------- 任务表右键 ----------
@@ -3835,7 +7609,20 @@ class MainWindow(QMainWindow):
         act_copy_output = menu.addAction("复制输出路径")
         menu.addSeparator()
         act_retry = menu.addAction("重试")
+        act_cancel = menu.addAction("取消此任务")
         act_remove = menu.addAction("从队列删除（仅等待中）")
+        menu.addSeparator()
+        act_top = menu.addAction("置顶")
+        act_bottom = menu.addAction("移到队尾")
+        priority_menu = menu.addMenu("优先级")
+        priority_actions = {
+            priority_menu.addAction(label): value for label, value in TASK_PRIORITY_LEVELS.items()
+        }
+        status = self.task_store.status(self.task_index_at_row(row))
+        waiting = status == TaskStatus.WAITING
+        act_cancel.setEnabled(status in (TaskStatus.WAITING, TaskStatus.RUNNING))
+        for act in (act_top, act_bottom, priority_menu.menuAction()):
+            act.setEnabled(waiting)
         action = menu.exec_(self.table.viewport().mapToGlobal(pos))
         if action == act_open:
             self.open_task_file(row)
@@ -3849,17 +7636,29 @@ class MainWindow(QMainWindow):
             self.copy_task_output(row)
         elif action == act_retry:
             self.retry_task(row)
+        elif action == act_cancel:
+            self.cancel_task(row)
         elif action == act_remove:
             self.remove_waiting_task(row)
+        elif action == act_top:
+            self.reorder_task(row, self.scheduler.move_to_top)
+        elif action == act_bottom:
+            self.reorder_task(row, self.scheduler.move_to_bottom)
+        elif action in priority_actions:
+            value = priority_actions[action]
+            self.reorder_task(row, lambda index: self.scheduler.set_priority(index, value))
 
     def on_task_double_clicked(self, index):
         self.open_task_file(index.row())
 
-    def task_output_path(self, row):
+    def task_at_row(self, row):
         if row < 0 or row >= self.table.rowCount():
-            return ""
-        item = self.table.item(row, 3)
-        return item.text().strip() if item else ""
+            return None
+        return self.task_store.get(self.task_index_at_row(row))
+
+    def task_output_path(self, row):
+        task = self.task_at_row(row)
+        return task.output_path if task else ""
 
     def open_task_file(self, row):
         path = self.task_output_path(row)
@@ -3878,11 +7677,10 @@ class MainWindow(QMainWindow):
         open_path_in_explorer(path)
 
     def copy_task_error(self, row):
-        if row < 0 or row >= self.table.rowCount():
+        task = self.task_at_row(row)
+        if task is None:
             return
-        item = self.table.item(row, 2)
-        text = item.text() if item else ""
-        QApplication.clipboard().setText(text)
+        QApplication.clipboard().setText(task.error)
         self.statusBar().showMessage("已复制错误信息", 3000)
 
     def copy_cell(self, row, pos):
@@ -3898,33 +7696,54 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage("已复制输出路径", 3000)
 
     def retry_task(self, row):
-        if row < 0 or row >= self.table.rowCount():
+        """把已结束的任务放回调度队列重新下载，运行中也可以直接重试。"""
+        index = self.task_index_at_row(row)
+        task = self.task_store.get(index)
+        if task is None or not task.url:
             return
-        if self.worker and self.worker.isRunning():
-            QMessageBox.warning(self, "提示", "当前还有下载任务在进行，请等待完成或取消后再重试。")
+        if not task.finished:
+            QMessageBox.information(self, "提示", "该任务还在队列中。")
             return
-        url_item = self.table.item(row, 0)
-        if not url_item:
+        if self.worker_cancelling():
+            QMessageBox.warning(self, "提示", "正在取消当前任务，请稍候再试。")
             return
-        url = url_item.text().strip()
-        if not url:
+        busy = self.queue_busy()
+        if not busy:
+            self.settings = self.collect_settings()
+            self.scheduler.reset()
+            self.restore_task_order()
+            task.settings = self.settings
+        self.task_store.requeue(index)
+        self.scheduler.submit(index)
+        self.render_task(index)
+        self.append_log(f"重新加入队列: {task.url}")
+        self.begin_queue(busy)
+
+    def cancel_task(self, row):
+        """只取消选中的任务，其余任务继续下载，空出的并发槽位立即被下一个任务使用。"""
+        index = self.task_index_at_row(row)
+        if not self.queue_busy() or not self.worker.cancel_task(index):
+            QMessageBox.information(self, "提示", "该任务不在下载队列中。")
             return
-        self.input_edit.setPlainText(url)
-        self.switch_page(0)
-        self.start_downloads()
+        self.append_log(f"已请求取消任务: {self.task_store.get(index).url}")
+        self.statusBar().showMessage("正在取消任务...", 3000)
 
-    def remove_waiting_task(self, row):
-        if row < 0 or row >= self.table.rowCount():
+    def reorder_task(self, row, action):
+        """对等待中的任务执行置顶/移到队尾/调整优先级。"""
+        index = self.task_index_at_row(row)
+        if not action(index):
             return
-        status_item = self.table.item(row, 1)
-        status_text = status_item.text() if status_item else ""
-        if status_text not in {"等待", "已暂停"}:
-            QMessageBox.information(self, "提示", "只能删除等待中或已暂停的任务。")
+        self.render_task(index)
+        self.statusBar().showMessage("已调整队列顺序", 3000)
+
+    def remove_waiting_task(self, row):
+        index = self.task_index_at_row(row)
+        if not self.task_store.remove_waiting(index):
+            QMessageBox.information(self, "提示", "只能删除等待中的任务。")
             return
-        if self.worker:
-            self.worker.skip_index(row)
-        self.set_cell(row, 1, "已删除")
-        self.set_cell(row, 2, "-")
+        self.render_task(index)
+        self._update_progress_bar()
+        self.update_window_title()
         self.statusBar().showMessage("已从队列删除", 3000)
 
     # ---------- 历史 ----------
@@ -3935,40 +7754,63 @@ class MainWindow(QMainWindow):
         for r in self.history_records:
             row = self.history_table.rowCount()
             self.history_table.insertRow(row)
-            self.history_table.setItem(row, 0, QTableWidgetItem(r.get("title") or "-"))
-            status = r.get("status") or "-"
-            if status == "completed":
-                status = "完成"
-            elif status == "failed":
-                status = "失败"
-            elif status == "cancelled":
-                status = "已取消"
-            self.history_table.setItem(row, 1, QTableWidgetItem(status))
-            self.history_table.setItem(row, 2, QTableWidgetItem(format_bytes(r.get("file_size"))))
-            self.history_table.setItem(row, 3, QTableWidgetItem(str(r.get("duration") or "-")))
-            self.history_table.setItem(row, 4, QTableWidgetItem(r.get("resolution") or "-"))
-            ts = r.get("finished_at")
-            time_str = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts)) if ts else "-"
-            self.history_table.setItem(row, 5, QTableWidgetItem(time_str))
-            path = r.get("output_path") or ""
-            if path and not Path(path).exists():
-                path = f"{path}  (文件已移动或删除)"
-            self.history_table.setItem(row, 6, QTableWidgetItem(path))
+            self.fill_history_row(row, r)
+        proxy = (self.settings.get("proxy") or "").strip()
+        self.history_grid.set_records(self.history_records, proxy)
         self.statusBar().showMessage(f"历史记录: {len(self.history_records)} 条")
 
+    def fill_history_row(self, row, r):
+        self.history_table.setItem(row, 0, QTableWidgetItem(r.get("title") or "-"))
+        status = r.get("status") or "-"
+        if status == "completed":
+            status = "完成"
+        elif status == "failed":
+            status = "失败"
+        elif status == "cancelled":
+            status = "已取消"
+        self.history_table.setItem(row, 1, QTableWidgetItem(status))
+        self.history_table.setItem(row, 2, QTableWidgetItem(format_bytes(r.get("file_size"))))
+        self.history_table.setItem(row, 3, QTableWidgetItem(str(r.get("duration") or "-")))
+        self.history_table.setItem(row, 4, QTableWidgetItem(r.get("resolution") or "-"))
+        ts = r.get("finished_at")
+        time_str = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts)) if ts else "-"
+        self.history_table.setItem(row, 5, QTableWidgetItem(time_str))
+        path = r.get("output_path") or ""
+        if path and not LIBRARY.exists(path):
+            path = f"{path}  (文件已移动或删除)"
+        self.history_table.setItem(row, 6, QTableWidgetItem(path))
+
+    def toggle_history_grid(self, checked):
+        """在表格和封面网格之间切换，保持选中的记录。"""
+        if checked:
+            row = self.history_table.currentRow()
+            self.history_view_stack.setCurrentWidget(self.history_grid)
+            if row >= 0:
+                self.history_grid.setCurrentRow(row)
+        else:
+            row = self.history_grid.currentRow()
+            self.history_view_stack.setCurrentWidget(self.history_table)
+            if row >= 0:
+                self.history_table.selectRow(row)
+
+    def current_history_row(self):
+        if self.history_view_stack.currentWidget() is self.history_grid:
+            return self.history_grid.currentRow()
+        return self.history_table.currentRow()
+
     def history_status_text(self, status):
         mapping = {"completed": "完成", "failed": "失败", "cancelled": "已取消"}
         return mapping.get(status, status or "-")
 
     def current_history_record(self):
-        row = self.history_table.currentRow()
+        row = self.current_history_row()
         if row < 0 or row >= len(self.history_records):
             return None, -1
         return self.history_records[row], row
 
     def copy_history_link(self, row=None):
         if row is None:
-            row = self.history_table.currentRow()
+            row = self.current_history_row()
         if row < 0 or row >= len(self.history_records):
             return
         url = self.history_records[row].get("url") or ""
@@ -3985,12 +7827,12 @@ class MainWindow(QMainWindow):
         if not url:
             QMessageBox.warning(self, "提示", "该历史记录没有可用的链接。")
             return
-        if self.worker and self.worker.isRunning():
-            QMessageBox.warning(self, "提示", "当前还有下载任务在进行，请等待完成或取消后再重试。")
-            return
         self.input_edit.setPlainText(url)
         self.switch_page(0)
-        self.start_downloads()
+        if self.worker_cancelling() or not self.prepare_downloads():
+            return
+        # 明确要求重新下载，不查下载存档
+        self.enqueue_urls([normalize_input(url)], settings=dict(self.settings, skip_archived=False))
 
     def open_history_file(self):
         record, _ = self.current_history_record()
@@ -4026,7 +7868,10 @@ class MainWindow(QMainWindow):
         )
         if ret == QMessageBox.Yes:
             remove_history_record(row)
-            self.refresh_history()
+            self.history_records = load_history()
+            self.history_table.removeRow(row)
+            self.history_grid.remove_row(row)
+            self.statusBar().showMessage(f"历史记录: {len(self.history_records)} 条")
 
     def clear_all_history(self):
         ret = QMessageBox.question(
@@ -4162,19 +8007,33 @@ class MainWindow(QMainWindow):
                 QSystemTrayIcon.Information, 3000,
             )
             return
-        if self.worker and self.worker.isRunning():
+        if self.queue_busy():
             ret = QMessageBox.question(
                 self, "确认退出",
-                "有下载任务正在进行，确定退出吗？",
+                "有下载任务正在进行，确定退出吗？\n未完成的任务会在下次启动时继续下载。",
                 QMessageBox.Yes | QMessageBox.No, QMessageBox.No,
             )
             if ret != QMessageBox.Yes:
                 event.ignore()
                 return
-            self.worker.cancel()
+        if self.worker and self.worker.isRunning():
+            # 先把最新进度写进队列日志再断开：停止过程中的"已取消"不记入日志，
+            # 等待和运行中的任务保持未完成状态，下次启动时由 restore_queue 恢复
+            self.journal.flush()
+            self.task_store.journal = None
+            self.worker.shutdown()
             self.worker.wait(3000)
         if self.preview_worker and self.preview_worker.isRunning():
+            self.preview_worker.abort()
             self.preview_worker.wait(2000)
+        if self.import_worker and self.import_worker.isRunning():
+            self.import_worker.requestInterruption()
+            self.import_worker.wait(2000)
+        if self.dedupe_worker and self.dedupe_worker.isRunning():
+            self.dedupe_worker.requestInterruption()
+            self.dedupe_worker.wait(2000)
+        self.cover_loader.shutdown()
+        SHORT_LINKS.save()
         if self.cookie_check_worker and self.cookie_check_worker.isRunning():
             self.cookie_check_worker.wait(2000)
         ok, err = save_settings(self.collect_settings())
@@ -4182,12 +8041,15 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage(f"设置保存失败: {err}", 5000)
         if self.tray_icon:
             self.tray_icon.hide()
+        self.journal.stop()
+        shutdown_runtime_log()
         event.accept()
 
 
 # ==================== 入口 ====================
 
 def main():
+    multiprocessing.freeze_support()
     install_excepthooks()
     DEFAULT_DOWNLOAD_DIR.mkdir(exist_ok=True)
     app = QApplication(sys.argv)
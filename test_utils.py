@@ -5,20 +5,65 @@
 """
 
 import sys
+import threading
+import time
 from pathlib import Path
 
+import pytest
+
 # 确保能导入项目主模块
 sys.path.insert(0, str(Path(__file__).resolve().parent))
 
+import gui_download_qt
 from gui_download_qt import (
+    SCHEDULER_IDLE,
+    BiliApiError,
+    CircuitBreaker,
+    CoverCache,
+    DownloadArchive,
+    DownloadPaused,
+    DownloadWorker,
+    FileDeduper,
+    HostLimiter,
+    LibraryIndex,
+    LinkImportWorker,
+    MediaProbeCache,
+    PauseGate,
+    PreviewCancelled,
+    PreviewWorker,
+    ProgressAggregator,
+    QueueJournal,
+    ShortLinkResolver,
+    StageMetrics,
+    StallWatchdog,
+    TaskScheduler,
+    TaskState,
+    TaskStatus,
+    TaskStore,
+    av_to_bv,
+    bv_to_av,
+    canonical_video_key,
+    classify_retry,
+    clean_bili_url,
+    decode_cover,
     extract_aid,
+    fold_queue_journal,
+    load_queue_journal,
     extract_bvid,
+    extract_links,
     extract_video_id,
+    ffmpeg_timeout,
     format_bytes,
     format_duration,
     format_error,
+    input_key,
     is_bilibili_url,
     normalize_input,
+    parse_ffprobe_json,
+    parse_media_info_text,
+    parse_ffmpeg_progress_line,
+    retry_delay,
+    run_ffmpeg,
     sanitize_filename,
     selected_page_number,
     split_inputs,
@@ -234,3 +279,1181 @@ class TestFormatError:
     def test_empty_message(self):
         exc = ValueError()
         assert format_error(exc) == "ValueError"
+
+
+class TestClassifyRetry:
+    def test_risk_control(self):
+        assert classify_retry(BiliApiError(-352, "风控校验失败")) == "risk"
+        assert classify_retry(BiliApiError(-509, "请求过于频繁")) == "risk"
+        assert classify_retry(RuntimeError("HTTP Error 412: Precondition Failed")) == "risk"
+
+    def test_fatal_not_retried(self):
+        for code in (-404, -403, -799):
+            assert classify_retry(BiliApiError(code, "x")) is None
+        assert classify_retry(RuntimeError("HTTP Error 404: Not Found")) is None
+
+    def test_network(self):
+        assert classify_retry(gui_download_qt.requests.ConnectionError("reset")) == "network"
+        assert classify_retry(RuntimeError("ERROR: Read timed out.")) == "network"
+        assert classify_retry(ValueError("bad format")) is None
+
+    def test_api_error_keeps_code_in_message(self):
+        exc = BiliApiError(-352, "风控校验失败")
+        assert exc.code == -352 and "-352" in str(exc)
+
+    def test_delay_backoff_with_jitter(self):
+        for attempt in (1, 2, 3):
+            full = gui_download_qt.RETRY_BASE_DELAYS["network"] * 2 ** (attempt - 1)
+            assert full / 2 <= retry_delay("network", attempt) <= full
+        assert retry_delay("risk", 50) <= gui_download_qt.RETRY_MAX_DELAY
+
+
+# ---------- TaskStore ----------
+
+class TestTaskStore:
+    def test_counts(self):
+        store = TaskStore(["a", "b", "c"])
+        store.start(0)
+        store.finish(0, "out.mp4")
+        store.fail(1, "boom")
+        store.fail(2, "已取消", TaskStatus.CANCELLED)
+        assert store.count(TaskStatus.DONE) == 1
+        assert store.count(TaskStatus.FAILED) == 1
+        assert store.count(TaskStatus.CANCELLED) == 1
+        assert store.finished_count() == 3
+        assert store.overall_percent() == 100
+
+    def test_repeated_status_is_noop(self):
+        store = TaskStore(["a"])
+        assert store.fail(0, "boom")
+        assert not store.fail(0, "boom again")
+        assert store.count(TaskStatus.FAILED) == 1
+        assert store.get(0).error == "boom"
+
+    def test_start_only_from_waiting(self):
+        store = TaskStore(["a", "b"])
+        assert store.remove_waiting(1)
+        assert not store.start(1)
+        assert store.start(0, title="标题")
+        assert not store.remove_waiting(0)
+        assert store.get(0).title == "标题"
+
+    def test_equal_shares_without_sizes(self):
+        store = TaskStore(["a", "b"])
+        store.start(0)
+        store.update_progress(0, 50, "50%")
+        assert store.overall_percent() == 25
+        assert store.get(0).detail == "50%"
+
+    def test_weighted_by_bytes(self):
+        store = TaskStore(["a", "b"])
+        store.start(0)
+        store.start(1)
+        store.update_progress(0, 100, downloaded=900, total=900)
+        store.update_progress(1, 0, downloaded=0, total=100)
+        assert store.overall_percent() == 90
+
+    def test_unknown_size_uses_average_weight(self):
+        store = TaskStore(["a", "b"])
+        store.start(0)
+        store.update_progress(0, 50, downloaded=500, total=1000)
+        # 第二个任务大小未知，按平均 1000 字节估算
+        assert store.overall_percent() == 25
+
+    def test_text_only_update_keeps_numbers(self):
+        store = TaskStore(["a"])
+        store.start(0)
+        store.update_progress(0, 40, "40%", 400, 1000)
+        store.update_progress(0, -1, "合并中")
+        task = store.get(0)
+        assert (task.percent, task.downloaded, task.detail) == (40, 400, "合并中")
+
+    def test_progress_ignored_after_final(self):
+        store = TaskStore(["a"])
+        store.finish(0, "out.mp4", "out.mp4")
+        store.update_progress(0, 10, downloaded=10, total=100)
+        assert store.overall_percent() == 100
+        assert store.get(0).output_path == "out.mp4"
+
+    def test_add_while_running(self):
+        store = TaskStore(["a"])
+        store.start(0)
+        assert store.add(["b", "c"]) == [1, 2]
+        assert store.count(TaskStatus.WAITING) == 2
+        store.finish(0, "out.mp4")
+        assert round(store.overall_percent()) == 33
+
+    def test_requeue_resets_progress(self):
+        store = TaskStore(["a"])
+        assert not store.requeue(0)
+        store.start(0)
+        store.update_progress(0, 50, downloaded=50, total=100)
+        store.fail(0, "boom")
+        assert store.requeue(0)
+        task = store.get(0)
+        assert task.status == TaskStatus.WAITING
+        assert (task.error, task.downloaded, task.total) == ("", 0, 0)
+        assert store.count(TaskStatus.FAILED) == 0
+        assert store.overall_percent() == 0
+
+
+class TestTaskState:
+    def test_slots(self):
+        task = TaskState(0, "https://example.com")
+        assert not hasattr(task, "__dict__")
+
+    def test_status_label(self):
+        task = TaskState(0, "u")
+        assert task.status_label() == "等待"
+        task.status = TaskStatus.DONE
+        task.note = "公开视频兜底"
+        assert task.status_label() == "完成（公开视频兜底）"
+
+
+# ---------- ProgressAggregator ----------
+
+class TestProgressAggregator:
+    def test_coalesces_per_task(self):
+        batches = []
+        agg = ProgressAggregator(batches.append)
+        agg.mark(1)
+        agg.mark(0)
+        agg.mark(1)
+        agg.flush()
+        assert batches == [[0, 1]]
+
+    def test_empty_flush_sends_nothing(self):
+        batches = []
+        agg = ProgressAggregator(batches.append)
+        agg.flush()
+        assert batches == []
+
+    def test_discard(self):
+        batches = []
+        agg = ProgressAggregator(batches.append)
+        agg.mark(0)
+        agg.discard(0)
+        agg.flush()
+        assert batches == []
+
+    def test_stop_flushes_pending(self):
+        batches = []
+        agg = ProgressAggregator(batches.append, interval=60)
+        agg.start()
+        agg.mark(3)
+        agg.stop()
+        assert batches == [[3]]
+
+
+# ---------- PauseGate ----------
+
+class TestPauseGate:
+    def test_wait_returns_immediately_when_running(self):
+        assert PauseGate().wait(timeout=0) is True
+
+    def test_pause_and_resume_flags(self):
+        gate = PauseGate()
+        assert gate.pause() is True
+        assert gate.pause() is False
+        assert gate.paused
+        assert gate.wait(timeout=0.01) is False
+        assert gate.resume() is True
+        assert gate.resume() is False
+        assert not gate.paused
+
+    def test_resume_wakes_waiters(self):
+        gate = PauseGate()
+        gate.pause()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(gate.wait(timeout=5)))
+                   for _ in range(3)]
+        for t in threads:
+            t.start()
+        gate.resume()
+        for t in threads:
+            t.join(timeout=5)
+        assert results == [True, True, True]
+
+    def test_cancel_wakes_waiters_and_blocks_pause(self):
+        gate = PauseGate()
+        gate.pause()
+        results = []
+        t = threading.Thread(target=lambda: results.append(gate.wait(timeout=5)))
+        t.start()
+        gate.cancel()
+        t.join(timeout=5)
+        assert results == [False]
+        assert gate.cancelled and not gate.paused
+        assert gate.pause() is False
+
+    def test_interrupt_rechecks_abort(self):
+        gate = PauseGate()
+        gate.pause()
+        flag = threading.Event()
+        results = []
+        t = threading.Thread(target=lambda: results.append(gate.wait(timeout=5, abort=flag.is_set)))
+        t.start()
+        flag.set()
+        gate.interrupt()
+        t.join(timeout=5)
+        assert results == [False]
+        assert gate.paused
+
+
+# ---------- 暂停后续传 ----------
+
+class _StubResponse:
+    def __init__(self, data, start, status_code):
+        self.data = data
+        self.start = start
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(self.start, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class _StubSession:
+    """记录 Range 头的假 session；honor_range=False 时模拟不支持 Range 的服务器。"""
+
+    def __init__(self, data, honor_range):
+        self.data = data
+        self.honor_range = honor_range
+        self.ranges = []
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        value = (headers or {}).get("Range")
+        self.ranges.append(value)
+        if value and self.honor_range:
+            return _StubResponse(self.data, int(value[len("bytes="):-1]), 206)
+        return _StubResponse(self.data, 0, 200)
+
+
+def _make_worker(tmp_path):
+    store = TaskStore(["u"])
+    store.start(0)
+    return DownloadWorker({"download_dir": str(tmp_path)}, store, TaskScheduler(store))
+
+
+def _pause_once(worker):
+    """第一次回调时暂停，稍后在另一个线程里继续。"""
+    state = {"done": False}
+
+    def hook(*_):
+        if not state["done"]:
+            state["done"] = True
+            worker.pause()
+            threading.Timer(0.05, worker.resume).start()
+    return hook
+
+
+class TestPausedStreamResume:
+    DATA = bytes(range(256)) * 4096  # 1 MiB，分 4 块
+
+    def _download(self, tmp_path, honor_range):
+        worker = _make_worker(tmp_path)
+        session = _StubSession(self.DATA, honor_range)
+        part = tmp_path / "video.part"
+        written = worker.download_stream(0, session, "https://cdn/x", part, _pause_once(worker))
+        return written, part.read_bytes(), session.ranges
+
+    def test_resumes_with_range(self, tmp_path):
+        written, content, ranges = self._download(tmp_path, honor_range=True)
+        assert ranges == [None, "bytes=262144-"]
+        assert written == len(self.DATA)
+        assert content == self.DATA
+
+    def test_restarts_when_range_ignored(self, tmp_path):
+        written, content, ranges = self._download(tmp_path, honor_range=False)
+        assert ranges == [None, "bytes=262144-"]
+        assert written == len(self.DATA)
+        assert content == self.DATA
+
+    def test_ytdlp_redownloads_after_pause(self, tmp_path, monkeypatch):
+        worker = _make_worker(tmp_path)
+        pause = _pause_once(worker)
+        calls = []
+
+        class FakeYoutubeDL:
+            def __init__(self, opts):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def download(self, urls):
+                calls.append(urls)
+                if len(calls) == 1:
+                    pause()
+                    raise DownloadPaused()
+                return 0
+
+        monkeypatch.setattr(gui_download_qt.yt_dlp, "YoutubeDL", FakeYoutubeDL)
+        monkeypatch.setattr(worker, "build_ytdlp_options", lambda index: {})
+        assert worker.download_with_ytdlp(0, "https://example.com/v") == str(tmp_path)
+        assert len(calls) == 2
+
+
+# ---------- 低速重连 ----------
+
+class TestStallWatchdog:
+    def test_needs_full_window(self):
+        dog = StallWatchdog(floor=100, window=10)
+        dog.feed(0, now=0)
+        assert not dog.stalled(now=5)
+        assert dog.stalled(now=10)
+
+    def test_sliding_window_rate(self):
+        dog = StallWatchdog(floor=100, window=10)
+        dog.feed(0, now=0)
+        for t in range(1, 21):
+            dog.feed(2000 if t <= 10 else 50, now=t)
+        assert not dog.stalled(now=10)
+        # 最近 10 秒只有 500 字节，低于 100 B/s
+        assert dog.stalled(now=20)
+
+    def test_disabled_and_reset(self):
+        assert not StallWatchdog(floor=0, window=1).stalled(now=100)
+        dog = StallWatchdog(floor=100, window=10)
+        dog.feed(0, now=0)
+        dog.reset()
+        assert not dog.stalled(now=50)
+
+
+class _TricklingResponse(_StubResponse):
+    """发完第一块后就不再发数据，直到连接被关闭（模拟被限速的连接）。"""
+
+    def __init__(self, data, start, status_code):
+        super().__init__(data, start, status_code)
+        self.closed = threading.Event()
+
+    def iter_content(self, chunk_size):
+        yield self.data[self.start:self.start + chunk_size]
+        self.closed.wait(5)
+
+    def close(self):
+        self.closed.set()
+
+
+class _MirrorSession:
+    def __init__(self, data):
+        self.data = data
+        self.calls = []
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        value = (headers or {}).get("Range")
+        self.calls.append((url, value))
+        start = int(value[len("bytes="):-1]) if value else 0
+        if url == "https://slow/x":
+            return _TricklingResponse(self.data, start, 206 if value else 200)
+        return _StubResponse(self.data, start, 206 if value else 200)
+
+
+class TestStalledStreamReconnect:
+    def test_switches_mirror_and_resumes(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(gui_download_qt, "STALL_WINDOW_SECONDS", 0.2)
+        worker = _make_worker(tmp_path)
+        worker.default_settings["stall_speed_floor_kb"] = 1024
+        data = TestPausedStreamResume.DATA
+        session = _MirrorSession(data)
+        part = tmp_path / "video.part"
+        written = worker.download_stream(0, session, ["https://slow/x", "https://fast/x"],
+                                         part, lambda *_: None)
+        assert session.calls == [("https://slow/x", None), ("https://fast/x", "bytes=262144-")]
+        assert written == len(data)
+        assert part.read_bytes() == data
+        assert worker.store.get(0).stalls == 1
+
+
+# ---------- 接口熔断 ----------
+
+RISK = BiliApiError(-352, "风控校验失败")
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold_and_half_opens(self):
+        changes = []
+        breaker = CircuitBreaker(threshold=2, cooldown=0.2, on_change=lambda *a: changes.append(a[1]))
+        host = "api.example.com"
+        breaker.record(host, RISK)
+        breaker.record(host, RuntimeError("HTTP Error 404"))
+        assert breaker.state(host) == CircuitBreaker.CLOSED
+        breaker.record(host, RISK)
+        assert breaker.state(host) == CircuitBreaker.OPEN
+        started = time.monotonic()
+        assert breaker.acquire(host)
+        assert time.monotonic() - started >= 0.15
+        assert breaker.state(host) == CircuitBreaker.HALF_OPEN
+        breaker.record(host)
+        assert breaker.state(host) == CircuitBreaker.CLOSED
+        assert changes == [CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN, CircuitBreaker.CLOSED]
+
+    def test_single_probe_while_half_open(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0)
+        host = "h"
+        breaker.record(host, RISK)
+        assert breaker.acquire(host)
+        got = []
+        t = threading.Thread(target=lambda: got.append(breaker.acquire(host)))
+        t.start()
+        t.join(timeout=0.2)
+        assert got == []
+        breaker.record(host)
+        t.join(timeout=5)
+        assert got == [True]
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0)
+        breaker.record("h", RISK)
+        assert breaker.acquire("h")
+        breaker.cooldown = 60
+        breaker.record("h", RISK)
+        assert breaker.state("h") == CircuitBreaker.OPEN
+        assert breaker.acquire("h", abort=lambda: True) is False
+
+    def test_successes_reset_failure_count(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        for _ in range(3):
+            breaker.record("h", RISK)
+            breaker.record("h")
+        assert breaker.state("h") == CircuitBreaker.CLOSED
+
+
+class TestHostLimiter:
+    def test_separate_limits_per_kind(self):
+        limiter = HostLimiter(api_limit=1, cdn_limit=2)
+        assert HostLimiter.kind("api.bilibili.com") == "api"
+        assert HostLimiter.kind("upos-sz-mirrorcos.bilivideo.com") == "cdn"
+        api = limiter.acquire("api.bilibili.com")
+        assert limiter.acquire("api.bilibili.com", abort=lambda: True) is False
+        cdn = [limiter.acquire("cdn.example.com") for _ in range(2)]
+        assert all(cdn)
+        assert limiter.acquire("cdn.example.com", abort=lambda: True) is False
+        # 不同主机各自计数
+        assert limiter.acquire("other.example.com")
+        limiter.release(api)
+        assert limiter.acquire("api.bilibili.com", abort=lambda: True)
+
+    def test_api_slot_released_on_error(self, tmp_path):
+        worker = _make_worker(tmp_path)
+        worker.limiter.configure(1, 1)
+        with pytest.raises(RuntimeError):
+            with worker.api_call(0, "api.example.com"):
+                raise RuntimeError("boom")
+        with worker.api_call(0, "api.example.com"):
+            assert worker.api_pending[0][0] == "api.example.com"
+        assert worker.api_pending == {}
+
+
+# ---------- 单任务取消 ----------
+
+class TestCancelTask:
+    def test_cancel_waiting_task(self, tmp_path):
+        store = TaskStore(["a", "b"])
+        worker = DownloadWorker({"download_dir": str(tmp_path)}, store, TaskScheduler(store))
+        assert worker.cancel_task(1) is True
+        assert store.status(1) == TaskStatus.CANCELLED
+        assert store.status(0) == TaskStatus.WAITING
+        assert worker.cancel_task(1) is False
+
+    def test_cancel_running_stream_removes_only_its_files(self, tmp_path):
+        worker = _make_worker(tmp_path)
+        other = tmp_path / "other.part"
+        other.write_bytes(b"keep")
+        part = tmp_path / "video.part"
+        worker.register_temp_file(0, part)
+        session = _StubSession(TestPausedStreamResume.DATA, honor_range=True)
+        with pytest.raises(RuntimeError):
+            worker.download_stream(0, session, "https://cdn/x", part,
+                                   lambda *_: worker.cancel_task(0))
+        assert worker.task_cancelled(0) and not worker.task_cancelled(1)
+        worker.cleanup_task_files(0)
+        assert not part.exists()
+        assert other.read_bytes() == b"keep"
+
+    def test_keep_partial_policy(self, tmp_path):
+        worker = _make_worker(tmp_path)
+        worker.default_settings["keep_partial_on_cancel"] = True
+        part = tmp_path / "video.part"
+        concat = tmp_path / "video.concat.txt"
+        part.write_bytes(b"x")
+        concat.write_text("file", encoding="utf-8")
+        worker.register_temp_file(0, part)
+        worker.register_temp_file(0, concat, resumable=False)
+        worker.cleanup_task_files(0)
+        assert part.exists() and not concat.exists()
+        assert worker.store.get(0).temp_files == {}
+
+    def test_cancel_while_paused_wakes_task(self, tmp_path):
+        worker = _make_worker(tmp_path)
+        worker.pause()
+        errors = []
+
+        def run():
+            try:
+                worker.wait_for_resume(0)
+            except RuntimeError as exc:
+                errors.append(str(exc))
+        t = threading.Thread(target=run)
+        t.start()
+        time.sleep(0.05)
+        worker.cancel_task(0)
+        t.join(timeout=1)
+        assert errors == ["用户取消下载"]
+        assert worker.paused
+
+
+# ---------- TaskScheduler ----------
+
+def _drain(scheduler, limit=10):
+    order = []
+    while True:
+        index = scheduler.acquire(limit)
+        if index == SCHEDULER_IDLE:
+            return order
+        order.append(index)
+        scheduler.store.start(index)
+        scheduler.store.finish(index, "")
+        scheduler.release()
+
+
+class TestTaskScheduler:
+    def _make(self, n):
+        store = TaskStore([f"u{i}" for i in range(n)])
+        scheduler = TaskScheduler(store)
+        for i in range(n):
+            scheduler.submit(i)
+        return scheduler
+
+    def test_fifo_by_default(self):
+        assert _drain(self._make(3)) == [0, 1, 2]
+
+    def test_priority_and_reorder(self):
+        scheduler = self._make(4)
+        scheduler.set_priority(2, 1)
+        scheduler.move_to_top(3)
+        scheduler.move_to_bottom(0)
+        assert _drain(scheduler) == [3, 2, 1, 0]
+
+    def test_skips_removed_tasks(self):
+        scheduler = self._make(2)
+        scheduler.store.remove_waiting(0)
+        assert _drain(scheduler) == [1]
+
+    def test_idle_reported_once_per_batch(self):
+        scheduler = self._make(1)
+        assert scheduler.busy
+        assert scheduler.acquire(1) == 0
+        scheduler.release()
+        assert scheduler.acquire(1) == SCHEDULER_IDLE
+        assert not scheduler.busy
+        index = scheduler.store.add(["late"])[0]
+        scheduler.submit(index)
+        assert scheduler.acquire(1) == index
+
+    def test_limit_blocks_until_release(self):
+        scheduler = self._make(2)
+        assert scheduler.acquire(1) == 0
+        got = []
+        t = threading.Thread(target=lambda: got.append(scheduler.acquire(1)))
+        t.start()
+        t.join(timeout=0.1)
+        assert got == []
+        scheduler.release()
+        t.join(timeout=5)
+        assert got == [1]
+
+    def test_close_wakes_acquire(self):
+        scheduler = TaskScheduler(TaskStore())
+        got = []
+        t = threading.Thread(target=lambda: got.append(scheduler.acquire(1)))
+        t.start()
+        scheduler.close()
+        t.join(timeout=5)
+        assert got == [None]
+
+    def test_batch_result_reported_with_idle(self):
+        scheduler = self._make(2)
+        assert scheduler.acquire(2) == 0
+        assert scheduler.acquire(2) == 1
+        scheduler.release(ok=False)
+        scheduler.release()
+        assert scheduler.acquire(2) == SCHEDULER_IDLE
+        assert scheduler.last_batch_ok is False
+        index = scheduler.store.add(["next"])[0]
+        scheduler.submit(index)
+        assert scheduler.acquire(2) == index
+        scheduler.release()
+        assert scheduler.acquire(2) == SCHEDULER_IDLE
+        assert scheduler.last_batch_ok is True
+
+    def test_delayed_retry_does_not_hold_slot(self):
+        scheduler = self._make(2)
+        assert scheduler.acquire(1) == 0
+        scheduler.store.start(0)
+        assert scheduler.store.retry_later(0, "err", "稍后重试")
+        assert scheduler.store.get(0).attempts == 1
+        assert scheduler.submit_later(0, 0.2)
+        scheduler.release()
+        # 名额立即给了下一个任务
+        assert scheduler.acquire(1) == 1
+        scheduler.store.start(1)
+        scheduler.store.finish(1, "")
+        scheduler.release()
+        started = time.monotonic()
+        assert scheduler.acquire(1) == 0
+        assert time.monotonic() - started >= 0.1
+        scheduler.release()
+        assert scheduler.acquire(1) == SCHEDULER_IDLE
+
+    def test_cancelled_delayed_task_lets_batch_finish(self):
+        scheduler = self._make(1)
+        assert scheduler.acquire(1) == 0
+        scheduler.store.start(0)
+        scheduler.store.retry_later(0, "err", "")
+        scheduler.submit_later(0, 60)
+        scheduler.release()
+        scheduler.store.fail(0, "已取消", TaskStatus.CANCELLED)
+        assert scheduler.acquire(1) == SCHEDULER_IDLE
+
+    def test_peek_follows_pop_order(self):
+        scheduler = self._make(4)
+        scheduler.move_to_top(2)
+        scheduler.store.remove_waiting(0)
+        assert scheduler.peek(2) == [2, 1]
+        assert scheduler.acquire(4) == 2
+
+    def test_handoff_frees_slot_but_keeps_batch_open(self):
+        scheduler = self._make(2)
+        assert scheduler.acquire(1) == 0
+        scheduler.release(handoff=True)
+        assert scheduler.acquire(1) == 1
+        scheduler.release()
+        got = []
+        t = threading.Thread(target=lambda: got.append(scheduler.acquire(1)))
+        t.start()
+        t.join(timeout=0.1)
+        assert got == []
+        scheduler.finish_post(ok=False)
+        t.join(timeout=5)
+        assert got == [SCHEDULER_IDLE]
+        assert scheduler.last_batch_ok is False
+
+    def test_retry_budget_per_batch(self, monkeypatch):
+        monkeypatch.setattr(gui_download_qt, "RETRY_BATCH_BUDGET", 2)
+        scheduler = self._make(1)
+        assert scheduler.take_retry() and scheduler.take_retry()
+        assert not scheduler.take_retry()
+        _drain(scheduler)
+        assert scheduler.take_retry()
+
+
+class TestStageMetrics:
+    def test_counts_and_summary(self):
+        stage = StageMetrics("后处理", 4)
+        stage.enqueue()
+        stage.enqueue()
+        assert stage.summary() == "后处理 0/4 排队 2"
+        with stage.run():
+            assert stage.summary() == "后处理 1/4 排队 1"
+        with pytest.raises(ValueError):
+            with stage.run():
+                raise ValueError()
+        assert (stage.done, stage.failed, stage.active, stage.queued) == (1, 1, 0, 0)
+        assert stage.average_seconds() >= 0
+
+
+# ---------- ffmpeg 后处理 ----------
+
+class TestFfmpegProgress:
+    def test_parse_progress_line(self):
+        assert parse_ffmpeg_progress_line("out_time_us=2500000\n") == 2.5
+        assert parse_ffmpeg_progress_line("out_time_ms=1000000") == 1.0
+        assert parse_ffmpeg_progress_line("out_time_us=N/A") is None
+        assert parse_ffmpeg_progress_line("progress=continue") is None
+
+    def test_timeout_scales_with_size(self):
+        assert ffmpeg_timeout(0) == gui_download_qt.FFMPEG_TIMEOUT_BASE
+        assert ffmpeg_timeout(10 * gui_download_qt.FFMPEG_MIN_THROUGHPUT) == (
+            gui_download_qt.FFMPEG_TIMEOUT_BASE + 10)
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="用 shell 脚本模拟 ffmpeg")
+    def test_run_reports_progress_and_errors(self, tmp_path, monkeypatch):
+        fake = tmp_path / "ffmpeg"
+        fake.write_text("#!/bin/sh\necho out_time_us=1000000\necho out_time_us=2000000\n"
+                        "echo progress=end\necho boom >&2\nexit ${FAKE_EXIT:-0}\n")
+        fake.chmod(0o755)
+        monkeypatch.setattr(gui_download_qt, "FFMPEG_EXE", fake)
+        seen = []
+        run_ffmpeg(["-i", "x"], on_progress=seen.append)
+        assert seen == [1.0, 2.0]
+        monkeypatch.setenv("FAKE_EXIT", "1")
+        with pytest.raises(RuntimeError, match="boom"):
+            run_ffmpeg(["-i", "x"])
+
+
+# ---------- 媒体信息探测 ----------
+
+class TestMediaProbe:
+    def test_parse_ffprobe_json_prefers_default_video(self):
+        data = {
+            "format": {"duration": "201.45", "bit_rate": "2500000"},
+            "streams": [
+                {"codec_type": "video", "codec_name": "mjpeg", "width": 1920, "height": 1080,
+                 "disposition": {"attached_pic": 1}},
+                {"codec_type": "video", "codec_name": "avc", "width": 640, "height": 360,
+                 "avg_frame_rate": "0/0", "r_frame_rate": "25/1", "disposition": {"default": 0}},
+                {"codec_type": "video", "codec_name": "hevc", "width": 1280, "height": 720,
+                 "avg_frame_rate": "30000/1001", "disposition": {"default": 1}},
+                {"codec_type": "audio", "codec_name": "aac", "sample_rate": "48000"},
+            ],
+        }
+        info = parse_ffprobe_json(data)
+        assert info["duration"] == "00:03:21.45"
+        assert info["bitrate"] == 2500
+        assert (info["video_codec"], info["width"], info["height"]) == ("hevc", 1280, 720)
+        assert round(info["fps"], 2) == 29.97
+        assert (info["audio_codec"], info["audio_sample_rate"]) == ("aac", 48000)
+
+    def test_parse_text_fallback(self):
+        text = (
+            "  Duration: 00:01:02.00, start: 0.000000, bitrate: 1200 kb/s\n"
+            "  Stream #0:0(und): Video: h264 (High) (avc1 / 0x31637661), yuv420p(tv, bt709), "
+            "640x360 [SAR 1:1 DAR 16:9], 800 kb/s, 29.97 fps, 29.97 tbr, 16k tbn (default)\n"
+            "  Stream #0:1(und): Audio: aac (LC) (mp4a / 0x6134706D), 44100 Hz, stereo, fltp, 128 kb/s\n"
+            "  Stream #0:2(und): Video: hevc (Main), yuv420p(tv), 1920x1080, 25 tbr, 90k tbn\n"
+        )
+        info = parse_media_info_text(text)
+        assert info["duration"] == "00:01:02.00"
+        assert (info["video_codec"], info["width"], info["height"], info["fps"]) == ("hevc", 1920, 1080, 25.0)
+        assert (info["audio_codec"], info["audio_sample_rate"]) == ("aac", 44100)
+
+    def test_cache_hits_until_file_changes(self, tmp_path):
+        media = tmp_path / "a.mp4"
+        media.write_bytes(b"x" * 10)
+        calls = []
+
+        def probe(path):
+            calls.append(path)
+            return {"video_codec": "h264"}
+
+        cache = MediaProbeCache(tmp_path / "cache.json", probe=probe)
+        assert cache.info(media) == {"video_codec": "h264", "file_size": 10}
+        assert cache.info(media)["file_size"] == 10
+        assert len(calls) == 1
+        # 换一个实例从磁盘加载，仍然命中
+        assert MediaProbeCache(tmp_path / "cache.json", probe=probe).info(media)["video_codec"] == "h264"
+        assert len(calls) == 1
+        media.write_bytes(b"x" * 20)
+        assert cache.info(media)["file_size"] == 20
+        assert len(calls) == 2
+        assert cache.info(tmp_path / "missing.mp4") == {}
+
+
+# ---------- av/BV 互转 ----------
+
+class TestAvBvCodec:
+    @pytest.mark.parametrize("aid, bvid", [
+        (170001, "BV17x411w7KC"),
+        (1054803170, "BV1mH4y1u7UA"),
+        (1, "BV1xx411c7mQ"),
+    ])
+    def test_round_trip(self, aid, bvid):
+        assert av_to_bv(aid) == bvid
+        assert bv_to_av(bvid) == aid
+
+    def test_rejects_invalid_bvid(self):
+        with pytest.raises(ValueError):
+            bv_to_av("BV1xx")
+
+    @pytest.mark.parametrize("aid", [0, -5, 2 ** 51])
+    def test_rejects_out_of_range_aid(self, aid):
+        with pytest.raises(ValueError):
+            av_to_bv(aid)
+
+    def test_canonical_key_matches_av_and_bv(self):
+        key = canonical_video_key("https://www.bilibili.com/video/av170001?p=2")
+        assert key == ("BV17x411w7KC", 2)
+        assert canonical_video_key("https://m.bilibili.com/video/BV17x411w7KC?p=2") == key
+        assert canonical_video_key("av170001") == ("BV17x411w7KC", 1)
+        assert canonical_video_key("https://example.com/v.mp4") is None
+        # 其他网站路径里的 av 号、超出范围的 av 号不算 B站视频
+        assert canonical_video_key("https://example.com/nav/av12") is None
+        assert canonical_video_key("https://example.com/?u=www.bilibili.com/video/av12") is None
+        assert canonical_video_key(f"av{2 ** 51}") is None
+        assert canonical_video_key("www.bilibili.com/video/av170001") == ("BV17x411w7KC", 1)
+
+    def test_input_key_falls_back_to_url(self):
+        assert input_key("BV17x411w7KC") == input_key("https://www.bilibili.com/video/av170001")
+        assert input_key("https://example.com/v.mp4") == "https://example.com/v.mp4"
+
+
+# ---------- 短链接解析 ----------
+
+class TestShortLinkResolver:
+    def test_clean_bili_url_drops_tracking(self):
+        url = "https://www.bilibili.com/video/av170001?p=3&share_source=copy_web&vd_source=abc"
+        assert clean_bili_url(url) == "https://www.bilibili.com/video/BV17x411w7KC?p=3"
+        assert clean_bili_url("https://live.bilibili.com/123") == "https://live.bilibili.com/123"
+
+    def test_expand_resolves_concurrently_and_caches(self, tmp_path):
+        calls = []
+
+        def follow(url, proxy=""):
+            calls.append(url)
+            time.sleep(0.1)
+            if url.endswith("bad"):
+                raise RuntimeError("timeout")
+            return f"https://www.bilibili.com/video/{url.rsplit('/', 1)[1]}"
+
+        resolver = ShortLinkResolver(tmp_path / "links.json", follow=follow)
+        urls = [f"https://b23.tv/BV1{i:09d}" for i in range(20)] + ["https://b23.tv/bad", "BV17x411w7KC"]
+        start = time.monotonic()
+        result = resolver.expand(urls)
+        assert time.monotonic() - start < 1.5
+        assert result[0] == "https://www.bilibili.com/video/BV1000000000"
+        assert result[-2:] == ["https://b23.tv/bad", "BV17x411w7KC"]
+        # 查询参数不影响缓存命中，新实例从磁盘读取
+        again = ShortLinkResolver(tmp_path / "links.json", follow=follow)
+        assert again.expand(["https://b23.tv/BV1000000000?share_medium=android"]) == [result[0]]
+        assert calls.count("https://b23.tv/BV1000000000") == 1
+
+    def test_follow_redirects_stops_at_video_page(self, monkeypatch):
+        class Resp:
+            def __init__(self, status, location=None):
+                self.status_code = status
+                self.headers = {"Location": location} if location else {}
+
+        hops = {
+            "https://b23.tv/abc": Resp(302, "https://b23.tv/abc2"),
+            "https://b23.tv/abc2": Resp(302, "https://www.bilibili.com/video/BV17x411w7KC?p=2&spm=x"),
+        }
+        monkeypatch.setattr(gui_download_qt.requests, "head", lambda url, **kw: hops[url])
+        assert ShortLinkResolver.follow_redirects("https://b23.tv/abc") == (
+            "https://www.bilibili.com/video/BV17x411w7KC?p=2")
+
+
+# ---------- 链接导入 ----------
+
+class TestLinkImport:
+    def test_extract_links_from_share_text(self):
+        text = "【标题】 https://www.bilibili.com/video/BV17x411w7KC?p=2 av170001 随便什么 BV1xx411c7mQ"
+        assert extract_links(text) == [
+            "https://www.bilibili.com/video/BV17x411w7KC?p=2",
+            "https://www.bilibili.com/video/av170001",
+            "https://www.bilibili.com/video/BV1xx411c7mQ",
+        ]
+        assert extract_links("看看这个：https://example.com/v.mp4") == ["https://example.com/v.mp4"]
+
+    def test_streams_file_and_dedupes(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(gui_download_qt, "IMPORT_BATCH_SIZE", 3)
+        lines = ["\ufeffBV17x411w7KC", "av170001", "不是链接", ""]
+        lines += [f"https://example.com/{i}" for i in range(7)]
+        lines += ["https://example.com/0", "BV1xx411c7mQ"]
+        path = tmp_path / "links.txt"
+        path.write_text("\n".join(lines), encoding="utf-8")
+        known = {input_key("https://www.bilibili.com/video/av1")}  # 等于 BV1xx411c7mQ
+        worker = LinkImportWorker(str(path), known)
+        batches, summary = [], []
+        worker.batch_ready.connect(lambda urls: (batches.append(urls), worker.ack()))
+        worker.summary.connect(summary.append)
+        worker.run()
+        added = [u for b in batches for u in b]
+        assert added[0] == "https://www.bilibili.com/video/BV17x411w7KC"
+        assert added[1:] == [f"https://example.com/{i}" for i in range(7)]
+        assert len(batches) > 1  # 边读边分批加入
+        stats = summary[0]
+        assert (stats["lines"], stats["added"], stats["duplicates"], stats["invalid"]) == (13, 8, 3, 1)
+
+
+# ---------- 下载存档 ----------
+
+class TestDownloadArchive:
+    def test_seed_from_history_and_filenames(self, tmp_path):
+        folder = tmp_path / "dl"
+        folder.mkdir()
+        (folder / "某视频 [BV17x411w7KC].mp4").write_bytes(b"")
+        (folder / "分P [BV1xx411c7mQ_p2].mp4").write_bytes(b"")
+        (folder / "未完成 [BV1mH4y1u7UA].mp4.part").write_bytes(b"")
+        history = [
+            {"url": "https://www.bilibili.com/video/av1054803170", "status": "completed", "resolution": "1280x720"},
+            {"url": "https://example.com/failed", "status": "failed"},
+        ]
+        archive = DownloadArchive(tmp_path / "archive.txt")
+        archive.seed(lambda: history, folder)
+        assert archive.match("av170001", {"quality": "best"}) is not None
+        assert archive.match("https://www.bilibili.com/video/BV1xx411c7mQ?p=2", {"quality": "best"}) is not None
+        assert archive.match("https://www.bilibili.com/video/BV1xx411c7mQ", {"quality": "best"}) is None
+        # 历史里是 720P：要 720P 跳过，要 1080P 重新下载
+        assert archive.match("BV1mH4y1u7UA", {"quality": "720"}) is not None
+        assert archive.match("BV1mH4y1u7UA", {"quality": "1080"}) is None
+        # 历史里的 720P 满足默认的"最高画质"，不会被重新下载覆盖
+        assert archive.match("BV1mH4y1u7UA", {"quality": "best"}) is not None
+        assert not archive.needs_upgrade("BV1mH4y1u7UA", {"quality": "best"})
+        assert archive.match("https://example.com/failed", {"quality": "best"}) is None
+        lines = (tmp_path / "archive.txt").read_text(encoding="utf-8").split()
+        assert "BV1xx411c7mQ_p2" in lines and "BV17x411w7KC" in lines
+
+    def test_record_and_reload_with_ytdlp_lines(self, tmp_path):
+        path = tmp_path / "archive.txt"
+        path.write_text("bilibili BV1xx411c7mQ\nyoutube abc\n", encoding="utf-8")
+        archive = DownloadArchive(path)
+        archive.record("https://example.com/v.mp4", height=1080, path="/x/v.mp4")
+        archive.record("BV17x411w7KC", height=480)
+        reloaded = DownloadArchive(path)
+        assert reloaded.match("https://example.com/v.mp4", {"quality": "720"})["path"] == "/x/v.mp4"
+        # 最高画质：已有的下载都算满足，不会反复重下覆盖
+        assert reloaded.match("https://example.com/v.mp4", {"quality": "best"}) is not None
+        assert not reloaded.needs_upgrade("https://example.com/v.mp4", {"quality": "best"})
+        assert reloaded.match("av1", {"quality": "best"}) is not None  # yt-dlp 写的行视为最高画质
+        assert reloaded.match("BV17x411w7KC", {"quality": "1080"}) is None
+        assert reloaded.needs_upgrade("BV17x411w7KC", {"quality": "1080"})
+        assert not reloaded.needs_upgrade("BV17x411w7KC", {"quality": "480"})
+        assert path.read_text(encoding="utf-8").splitlines()[-1] == "bilibili BV17x411w7KC"
+
+
+# ---------- 下载目录索引 ----------
+
+class TestLibraryIndex:
+    def test_scans_each_directory_once(self, tmp_path):
+        (tmp_path / "a.mp4").write_bytes(b"123")
+        (tmp_path / "sub").mkdir()
+        scans = []
+        index = LibraryIndex(scan=lambda folder: scans.append(folder) or LibraryIndex.scan_dir(folder))
+        assert index.exists(tmp_path / "a.mp4")
+        assert not index.exists(tmp_path / "b.mp4")
+        assert index.exists(tmp_path / "sub")
+        assert [name for name, _, _ in index.files(tmp_path)] == ["a.mp4"]
+        assert len(scans) == 1
+
+    def test_allocate_reserves_names(self, tmp_path):
+        (tmp_path / "v.mp4").write_bytes(b"")
+        (tmp_path / "v (1).mp4").write_bytes(b"")
+        index = LibraryIndex()
+        first = index.allocate(tmp_path / "v.mp4")
+        second = index.allocate(tmp_path / "v.mp4")
+        assert first.name == "v (2).mp4" and second.name == "v (3).mp4"
+        index.release(first)
+        assert index.allocate(tmp_path / "v.mp4") == first
+        # 预留在重新扫描后仍然有效，写入后转为普通条目
+        index.rescan(tmp_path)
+        assert index.allocate(tmp_path / "v.mp4").name == "v (4).mp4"
+        second.write_bytes(b"xy")
+        index.add(second)
+        assert (second.name, 2) in [(n, size) for n, size, _ in index.files(tmp_path)]
+
+    def test_rescan_picks_up_external_changes(self, tmp_path):
+        (tmp_path / "old.mp4").write_bytes(b"")
+        index = LibraryIndex()
+        assert index.exists(tmp_path / "old.mp4")
+        (tmp_path / "old.mp4").unlink()
+        (tmp_path / "new.mp4").write_bytes(b"")
+        assert index.exists(tmp_path / "old.mp4")  # 没有重新扫描之前只信索引
+        index.rescan(tmp_path)
+        assert not index.exists(tmp_path / "old.mp4")
+        assert index.exists(tmp_path / "new.mp4")
+
+
+# ---------- 重复文件去重 ----------
+
+class TestFileDeduper:
+    def _write(self, path, head, size=2 * 1024 * 1024):
+        path.write_bytes(head + b"\0" * (size - len(head)))
+        return path
+
+    def test_links_identical_files_and_records_savings(self, tmp_path):
+        a = self._write(tmp_path / "甲.mp4", b"same")
+        b = self._write(tmp_path / "乙.mp4", b"same")
+        c = self._write(tmp_path / "丙.mp4", b"diff")
+        self._write(tmp_path / "notes.txt", b"same")
+        deduper = FileDeduper(tmp_path / "dedupe.json")
+        saved, original = deduper.dedupe_file(b)
+        assert saved == 2 * 1024 * 1024 and original == str(a)
+        assert a.samefile(b)
+        assert not a.samefile(c)
+        assert deduper.dedupe_file(c) == (0, "")
+        # 已经是硬链接的文件不会重复计入
+        assert deduper.dedupe_file(a) == (0, "")
+        assert FileDeduper(tmp_path / "dedupe.json").totals() == (1, 2 * 1024 * 1024)
+
+    def test_reflinked_files_are_not_counted_twice(self, tmp_path):
+        a = self._write(tmp_path / "a.mp4", b"same")
+        b = self._write(tmp_path / "b.mp4", b"same")
+
+        def fake_reflink(dup, orig):
+            # reflink 得到的是新文件：链接数仍为 1，修改时间也变了
+            Path(dup).write_bytes(Path(orig).read_bytes())
+            return "reflink"
+
+        deduper = FileDeduper(tmp_path / "dedupe.json", link=fake_reflink)
+        assert deduper.dedupe_folder(tmp_path)["linked"] == 1
+        again = FileDeduper(tmp_path / "dedupe.json", link=fake_reflink)
+        assert again.dedupe_folder(tmp_path) == {"checked": 2, "linked": 0, "saved_bytes": 0}
+        assert again.totals() == (1, 2 * 1024 * 1024)
+        # 之后再来的相同文件仍然会合并
+        self._write(tmp_path / "c.mp4", b"same")
+        assert again.dedupe_file(tmp_path / "c.mp4")[0] == 2 * 1024 * 1024
+        assert a.read_bytes() == b.read_bytes()
+
+    def test_full_hash_only_when_samples_match(self, tmp_path):
+        size = 4 * 1024 * 1024
+        a = self._write(tmp_path / "a.mkv", b"x", size)
+        b = tmp_path / "b.mkv"
+        data = bytearray(a.read_bytes())
+        data[size // 4] = 1  # 抽样块之外的差异只有完整摘要能发现
+        b.write_bytes(bytes(data))
+        linked = []
+        deduper = FileDeduper(tmp_path / "dedupe.json", link=lambda dup, orig: linked.append(dup) or "hardlink")
+        stats = deduper.dedupe_folder(tmp_path)
+        assert stats == {"checked": 2, "linked": 0, "saved_bytes": 0}
+        assert not linked
+        cached = FileDeduper(tmp_path / "dedupe.json")._load()["files"]
+        assert cached[str(a)]["sample"] == cached[str(b)]["sample"]
+        assert cached[str(a)]["full"] != cached[str(b)]["full"]
+
+
+# ---------- 封面缓存 ----------
+
+class TestCoverCache:
+    def test_lru_eviction_by_total_size(self, tmp_path):
+        cache = CoverCache(tmp_path / "covers", max_bytes=25)
+        cache.put("https://a/1.jpg", b"a" * 10)
+        cache.put("https://a/2.jpg", b"b" * 10)
+        assert cache.get("https://a/1.jpg") == b"a" * 10  # 1 变成最近使用
+        cache.put("https://a/3.jpg", b"c" * 10)
+        assert cache.get("https://a/2.jpg") is None
+        assert cache.get("https://a/1.jpg") == b"a" * 10
+        assert cache.total_bytes() == 20
+        # 新实例从磁盘重建索引
+        assert CoverCache(tmp_path / "covers", max_bytes=25).get("https://a/3.jpg") == b"c" * 10
+
+    def test_decode_scales_to_display_size(self):
+        from PyQt5.QtCore import QBuffer, QByteArray
+        from PyQt5.QtGui import QImage
+
+        src = QImage(400, 200, QImage.Format_RGB32)
+        src.fill(0)
+        data = QByteArray()
+        buf = QBuffer(data)
+        buf.open(QBuffer.WriteOnly)
+        src.save(buf, "PNG")
+        image = decode_cover(bytes(data), 100, 100)
+        assert (image.width(), image.height()) == (100, 50)
+        assert decode_cover(b"not an image", 100, 100).isNull()
+
+
+# ---------- 预览取消与合并 ----------
+
+class TestPreviewWorker:
+    def test_matches_same_url_and_settings(self):
+        worker = PreviewWorker(1, "BV1xx411c7mD", {"proxy": ""})
+        assert worker.matches("https://www.bilibili.com/video/BV1xx411c7mD", {"proxy": ""})
+        assert not worker.matches("BV1xx411c7mD", {"proxy": "http://127.0.0.1:1"})
+        worker.abort()
+        assert not worker.matches("BV1xx411c7mD", {"proxy": ""})
+
+    def test_aborted_worker_stops_before_request(self):
+        worker = PreviewWorker(1, "http://127.0.0.1:9/video.mp4", {})
+        failed = []
+        worker.failed.connect(lambda rid, msg: failed.append(msg))
+        worker.abort()
+        with pytest.raises(PreviewCancelled):
+            worker.fetch_with_ytdlp()
+        worker.run()
+        assert failed == []
+
+
+# ---------- 队列日志 ----------
+
+class TestQueueJournal:
+    def test_fold_drops_finished_tasks(self):
+        records = [
+            {"op": "settings", "key": "k", "value": {"quality": "1080"}},
+            {"op": "add", "i": 0, "url": "a", "s": "k", "p": 0},
+            {"op": "add", "i": 1, "url": "b", "s": "k", "p": 1},
+            {"op": "stage", "i": 0, "stage": "resolving"},
+            {"op": "progress", "i": 0, "done": 10, "total": 100},
+            {"op": "stage", "i": 1, "stage": "done"},
+        ]
+        tasks, settings = fold_queue_journal(records)
+        assert list(tasks) == [0]
+        assert tasks[0]["stage"] == "downloading"
+        assert (tasks[0]["downloaded"], tasks[0]["total"]) == (10, 100)
+        assert settings["k"] == {"quality": "1080"}
+
+    def test_store_transitions_round_trip(self, tmp_path):
+        path = tmp_path / "queue.journal"
+        journal = QueueJournal(path)
+        store = TaskStore(journal=journal)
+        store.reset(())
+        store.add(["a", "b", "c"], {"quality": "720"})
+        store.start(0)
+        store.update_progress(0, 50, downloaded=50, total=100)
+        store.start(1)
+        store.finish(1, "out.mp4")
+        store.remove_waiting(2)
+        journal.flush()
+        entries = load_queue_journal(path)
+        assert [e["url"] for e in entries] == ["a"]
+        assert entries[0]["settings"] == {"quality": "720"}
+        assert entries[0]["downloaded"] == 50
+
+    def test_progress_coalesced_per_flush(self, tmp_path):
+        path = tmp_path / "queue.journal"
+        journal = QueueJournal(path)
+        store = TaskStore(["a"], journal=journal)
+        store.journal.add(store.tasks)
+        store.start(0)
+        for done in range(1, 101):
+            store.update_progress(0, done, downloaded=done, total=100)
+        journal.flush()
+        lines = path.read_text(encoding="utf-8").splitlines()
+        assert sum('"progress"' in line for line in lines) == 1
+
+    def test_torn_last_line_ignored(self, tmp_path):
+        path = tmp_path / "queue.journal"
+        path.write_text('{"op":"add","i":0,"url":"a","s":null,"p":0}\n{"op":"stage","i":0,', encoding="utf-8")
+        assert [e["url"] for e in load_queue_journal(path)] == ["a"]
+
+    def test_compaction_keeps_unfinished(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(gui_download_qt, "QUEUE_JOURNAL_COMPACT_RECORDS", 10)
+        path = tmp_path / "queue.journal"
+        journal = QueueJournal(path)
+        store = TaskStore(journal=journal)
+        store.reset(())
+        store.add([f"u{i}" for i in range(20)])
+        for i in range(19):
+            store.start(i)
+            store.finish(i, "")
+        journal.flush()
+        assert len(path.read_text(encoding="utf-8").splitlines()) <= 2
+        assert [e["url"] for e in load_queue_journal(path)] == ["u19"]
+
+    def test_temp_files_round_trip(self, tmp_path):
+        path = tmp_path / "queue.journal"
+        journal = QueueJournal(path)
+        store = TaskStore(journal=journal)
+        store.reset(())
+        store.add(["a", "b"])
+        store.start(0)
+        store.register_temp_file(0, tmp_path / "a.part")
+        store.register_temp_file(0, tmp_path / "a.concat.txt", resumable=False)
+        store.start(1)
+        store.register_temp_file(1, tmp_path / "b.part")
+        store.finish(1, "")
+        journal.flush()
+        entries = load_queue_journal(path)
+        assert [e["url"] for e in entries] == ["a"]
+        assert entries[0]["temp_files"] == {
+            str(tmp_path / "a.part"): True, str(tmp_path / "a.concat.txt"): False,
+        }
+        assert store.get(1).temp_files == {}